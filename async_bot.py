@@ -0,0 +1,430 @@
+import asyncio
+import logging
+
+from telebot import apihelper, asyncio_filters, asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_helper import ApiTelegramException
+from telebot.types import Message
+
+import db
+import http_client
+import logs
+import metrics
+import sessions
+import tokens
+import tts_cache
+from config import (
+    ADMINS,
+    BOT_TOKEN,
+    COUNT_LAST_MSG,
+    MAX_USERS,
+    METRICS_ENABLED,
+    METRICS_HOST,
+    METRICS_PORT,
+    STT_SHORT_AUDIO_LIMIT,
+    TELEGRAM_API_URL,
+)
+from speechkit import (
+    SPEECHKIT_ERROR,
+    speech_to_text_async,
+    speech_to_text_long_async,
+    split_long_audio,
+    text_to_speech_async,
+)
+from texts import ECHO_TEXT, HELP_TEXT, START_TEXT, USERS_LIMIT_TEXT
+from utils import (
+    check_number_of_users,
+    is_gpt_token_limit_async,
+    is_stt_block_limit,
+    is_tts_symbol_limit,
+    settle_gpt_tokens,
+    settle_stt_blocks,
+)
+from voice_files import (
+    download_file_async,
+    get_file_url,
+    get_voice_duration_async,
+    iter_file_async,
+)
+from yandex_gpt import ask_gpt_helper_async
+
+# Асинхронный режим бота: запросы к Telegram, GPT и SpeechKit не блокируют потоки,
+# а работа с БД и проверки лимитов выполняются в пуле потоков через asyncio.to_thread.
+# Синхронный режим по-прежнему запускается через bot.py
+
+logs.setup()
+
+if TELEGRAM_API_URL:
+    # Bot API на другом адресе: локальный сервер Telegram или фейковый сервер loadtest
+    asyncio_helper.API_URL = TELEGRAM_API_URL + "/bot{0}/{1}"
+    apihelper.FILE_URL = TELEGRAM_API_URL + "/file/bot{0}/{1}"  # для voice_files.get_file_url
+
+bot = AsyncTeleBot(BOT_TOKEN)
+bot.add_custom_filter(asyncio_filters.StateFilter(bot))
+
+run_sync = asyncio.to_thread  # выполнение блокирующих функций вне event loop
+
+TTS_STATE = "tts"  # пользователь прислал /tts и мы ждём текст
+STT_STATE = "stt"  # пользователь прислал /stt и мы ждём ГС
+
+
+@bot.message_handler(commands=["start"])
+async def start(message: Message):
+    user_name = message.from_user.first_name
+    user_id = message.from_user.id
+
+    # Регистрируем нового пользователя, если число зарегистрированных меньше допустимого
+    if not await run_sync(sessions.add_new_user, user_id, MAX_USERS):
+        await bot.send_message(chat_id=user_id, text=USERS_LIMIT_TEXT)
+        return
+
+    # Этот блок срабатывает только для зарегистрированных пользователей
+    await bot.send_message(chat_id=user_id, text=START_TEXT.format(user_name=user_name))
+
+
+@bot.message_handler(commands=["kill_my_session"])
+async def kill_session(message: Message):
+    user_id = message.from_user.id
+    if user_id in ADMINS:
+        try:
+            for limit_type in ("total_gpt_tokens", "tts_symbols", "stt_blocks"):
+                await run_sync(sessions.update_row, user_id, limit_type, 0)
+        except Exception as e:
+            logging.error(f"Произошла ошибка {e}, сессии не обновлены")
+    else:
+        logging.info(f"{user_id} попытался обновить сессии")
+
+
+@bot.message_handler(commands=["debug"])
+async def send_logs(message: Message):
+    user_id = message.from_user.id
+    if user_id in ADMINS:
+        try:
+            # только свежий хвост лога: весь файл может быть слишком большим для Telegram
+            await bot.send_document(message.chat.id, logs.get_tail_file())
+        except (OSError, ApiTelegramException):
+            await bot.send_message(chat_id=message.chat.id, text="Логов нет!")
+    else:
+        logging.info(f"{user_id} захотел посмотреть логи")
+
+
+@bot.message_handler(commands=["help"])
+async def help_command(message: Message):
+    await bot.send_message(chat_id=message.chat.id, text=HELP_TEXT)
+
+
+@bot.message_handler(commands=["tts"])
+async def tts_handler(message: Message):
+    user_id = message.from_user.id
+    await bot.send_message(
+        chat_id=user_id,
+        text="Отправь следующим сообщением текст💬, чтобы я его озвучил!🔊",
+    )
+    await bot.set_state(user_id, TTS_STATE, message.chat.id)
+
+
+@bot.message_handler(state=TTS_STATE, content_types=["text", "voice", "audio", "photo", "sticker"])
+@metrics.timed()
+async def tts(message: Message):
+    user_id = message.from_user.id
+
+    # Проверка, что сообщение действительно текстовое
+    if message.content_type != "text":
+        await bot.send_message(chat_id=user_id, text="Отправь текстовое сообщение")
+        return
+    await bot.delete_state(user_id, message.chat.id)
+
+    # Считаем символы в тексте и резервируем их в лимите пользователя
+    tts_symbols, error_message = await run_sync(is_tts_symbol_limit, user_id, message.text)
+    if tts_symbols is None:
+        await bot.send_message(chat_id=user_id, text=error_message)
+        return
+
+    status, content = await synthesize(message.text)
+    if status:
+        await send_voice_cached(user_id, message.text, content)
+    else:
+        await run_sync(sessions.release_limit, user_id, "tts_symbols", tts_symbols)
+        await bot.send_message(chat_id=user_id, text=content)
+
+
+@metrics.timed()
+async def synthesize(text: str):
+    """
+    Функция для озвучивания текста: если такое ГС уже отправляли,
+    возвращает его file_id в Telegram вместо повторного синтеза
+    """
+    file_id = await run_sync(tts_cache.get_file_id, text)
+    if file_id:
+        return True, file_id
+    return await text_to_speech_async(text)
+
+
+@metrics.timed("telegram.send_voice")
+async def send_voice_cached(
+    chat_id: int, text: str, voice, reply_to_message_id: int | None = None
+):
+    """Функция для отправки ГС с запоминанием его file_id для повторных отправок"""
+    sent_message = await bot.send_voice(
+        chat_id, voice, reply_to_message_id=reply_to_message_id
+    )
+    if isinstance(voice, bytes):
+        await run_sync(tts_cache.remember_file_id, text, sent_message)
+
+
+@metrics.timed()
+async def recognize_voice(user_id: int, file_url: str, duration: int, stt_blocks: int):
+    """
+    Функция для распознавания ГС. Короткое ГС передаётся в SpeechKit по мере скачивания,
+    длинное скачивается целиком и распознаётся по кускам.
+    Возвращает статус, текст и реально потраченные аудиоблоки
+    """
+    if duration < STT_SHORT_AUDIO_LIMIT:
+        status, text = await speech_to_text_async(iter_file_async(file_url))
+        return status, text, stt_blocks
+
+    segments = await asyncio.to_thread(split_long_audio, await download_file_async(file_url))
+    if segments is None:
+        return False, SPEECHKIT_ERROR, stt_blocks
+    # резерв делался по длительности ГС, теперь известны куски - до распознавания резервируем ровно их блоки
+    used, error_message = await run_sync(
+        settle_stt_blocks, user_id, stt_blocks, [duration for _, duration in segments]
+    )
+    if used is None:
+        return False, error_message, stt_blocks
+    status, text = await speech_to_text_long_async(segments)
+    return status, text, used
+
+
+@bot.message_handler(commands=["stt"])
+async def stt_handler(message: Message):
+    user_id = message.from_user.id
+    await bot.send_message(
+        chat_id=user_id,
+        text="Отправь голосовое сообщение🔊, чтобы я его распознал!💬",
+    )
+    await bot.set_state(user_id, STT_STATE, message.chat.id)
+
+
+@bot.message_handler(state=STT_STATE, content_types=["text", "voice", "audio", "photo", "sticker"])
+@metrics.timed()
+async def stt(message: Message):
+    user_id = message.from_user.id
+
+    # Проверка, что сообщение действительно голосовое
+    if not message.voice:
+        await bot.send_message(chat_id=user_id, text="Пожалуйста, запиши ГС")
+        return
+    await bot.delete_state(user_id, message.chat.id)
+
+    # Считаем аудиоблоки (длительность проверяем по самому файлу) и резервируем их в лимите пользователя
+    with metrics.stage("telegram.get_file"):
+        file_info = await bot.get_file(message.voice.file_id)
+    file_url = get_file_url(file_info.file_path)
+    duration = await get_voice_duration_async(file_url, message.voice.duration)
+    stt_blocks, error_message = await run_sync(is_stt_block_limit, user_id, duration)
+    if not stt_blocks:
+        await bot.send_message(chat_id=user_id, text=error_message)
+        return
+
+    # ГС передаётся в SpeechKit по мере скачивания
+    status, text, stt_blocks = await recognize_voice(user_id, file_url, duration, stt_blocks)
+    if status:
+        await bot.send_message(chat_id=user_id, text=text, reply_to_message_id=message.id)
+    else:
+        await run_sync(sessions.release_limit, user_id, "stt_blocks", stt_blocks)
+        await bot.send_message(user_id, text)
+
+
+@bot.message_handler(content_types=["text"], func=lambda message: "привет" in message.text.lower())
+async def say_hello(message: Message):
+    user_name = message.from_user.first_name
+    await bot.send_message(chat_id=message.chat.id, text=f"{user_name}, приветики 👋!")
+
+
+@bot.message_handler(content_types=["text"], func=lambda message: "пока" in message.text.lower())
+async def say_bye(message: Message):
+    await bot.send_message(chat_id=message.chat.id, text="Пока, заходи ещё!")
+
+
+@metrics.timed()
+async def answer_with_gpt(user_id: int, last_messages: list) -> tuple[bool, str, int, int]:
+    """
+    Функция для резервирования токенов и запроса к GPT.
+    Возвращает статус, ответ (или текст ошибки), все потраченные токены и токены в ответе
+    """
+    prompt_tokens, error_message = await is_gpt_token_limit_async(user_id, last_messages)
+    if error_message:
+        return False, error_message, 0, 0
+
+    tokens_in_answer = None
+    try:
+        status_gpt, answer_gpt, tokens_in_answer = await ask_gpt_helper_async(last_messages)
+    finally:
+        # при исключении ответа нет, и резерв возвращается целиком
+        total_gpt_tokens = await run_sync(
+            settle_gpt_tokens, user_id, prompt_tokens, tokens_in_answer
+        )
+    if status_gpt:
+        tokens.remember({"role": "assistant", "text": answer_gpt}, tokens_in_answer)
+    return status_gpt, answer_gpt, total_gpt_tokens, tokens_in_answer
+
+
+@bot.message_handler(content_types=["voice"])
+@metrics.timed()
+async def handle_voice(message: Message):
+    user_id = message.from_user.id
+    try:
+        # Проверка на максимальное количество пользователей
+        status_check_users, error_message = await run_sync(check_number_of_users, user_id)
+        if not status_check_users:
+            await bot.send_message(chat_id=user_id, text=error_message)
+            return
+
+        # Проверка и резервирование аудиоблоков (длительность проверяем по самому файлу)
+        with metrics.stage("telegram.get_file"):
+            file_info = await bot.get_file(message.voice.file_id)
+        file_url = get_file_url(file_info.file_path)
+        duration = await get_voice_duration_async(file_url, message.voice.duration)
+        stt_blocks, error_message = await run_sync(is_stt_block_limit, user_id, duration)
+        if error_message:
+            await bot.send_message(chat_id=user_id, text=error_message)
+            return
+
+        # Обработка голосового сообщения: ГС передаётся в SpeechKit по мере скачивания
+        status_stt, stt_text, stt_blocks = await recognize_voice(
+            user_id, file_url, duration, stt_blocks
+        )
+        if not status_stt:
+            await run_sync(sessions.release_limit, user_id, "stt_blocks", stt_blocks)
+            await bot.send_message(chat_id=user_id, text=stt_text)
+            return
+
+        # Запись в БД (аудиоблоки уже учтены при резервировании)
+        await run_sync(
+            sessions.add_message,
+            user_id,
+            [stt_text, "user", 0, 0, stt_blocks],
+            None,
+            False,
+        )
+        last_messages, _ = await run_sync(
+            sessions.select_n_last_messages, user_id, COUNT_LAST_MSG
+        )
+
+        status_gpt, answer_gpt, total_gpt_tokens, tokens_in_answer = await answer_with_gpt(
+            user_id, last_messages
+        )
+        if not status_gpt:
+            await bot.send_message(chat_id=user_id, text=answer_gpt)
+            return
+
+        # Проверка и резервирование символов для SpeechKit
+        tts_symbols, error_message = await run_sync(is_tts_symbol_limit, user_id, answer_gpt)
+        await run_sync(
+            sessions.add_message,
+            user_id,
+            [answer_gpt, "assistant", total_gpt_tokens, tts_symbols or 0, 0],
+            tokens_in_answer,
+            False,
+        )
+        if error_message:
+            await bot.send_message(chat_id=user_id, text=error_message)
+            return
+
+        # Преобразование ответа в аудио и отправка
+        status_tts, voice_response = await synthesize(answer_gpt)
+        if status_tts:
+            await send_voice_cached(user_id, answer_gpt, voice_response, message.id)
+        else:
+            await run_sync(sessions.release_limit, user_id, "tts_symbols", tts_symbols)
+            await bot.send_message(
+                chat_id=user_id, text=answer_gpt, reply_to_message_id=message.id
+            )
+
+    except Exception as e:
+        logging.error(f"Ошибка при отправке ГС в функции handle_voice: {e}")
+        await bot.send_message(
+            chat_id=user_id,
+            text="Не получилось ответить. Попробуй записать другое сообщение",
+        )
+
+
+@bot.message_handler(content_types=["text"])
+@metrics.timed()
+async def handle_text(message: Message):
+    user_id = message.from_user.id
+    try:
+        # ВАЛИДАЦИЯ: проверяем, есть ли место для ещё одного пользователя (если пользователь новый)
+        status_check_users, error_message = await run_sync(check_number_of_users, user_id)
+        if not status_check_users:
+            await bot.send_message(user_id, error_message)
+            return
+
+        # БД: добавляем сообщение пользователя и получаем последние сообщения диалога
+        await run_sync(sessions.add_message, user_id, [message.text, "user", 0, 0, 0])
+        last_messages, _ = await run_sync(
+            sessions.select_n_last_messages, user_id, COUNT_LAST_MSG
+        )
+
+        status_gpt, answer_gpt, total_gpt_tokens, tokens_in_answer = await answer_with_gpt(
+            user_id, last_messages
+        )
+        if not status_gpt:
+            await bot.send_message(chat_id=user_id, text=answer_gpt)
+            return
+
+        await run_sync(
+            sessions.add_message,
+            user_id,
+            [answer_gpt, "assistant", total_gpt_tokens, 0, 0],
+            tokens_in_answer,
+            False,
+        )
+        await bot.send_message(chat_id=user_id, text=answer_gpt, reply_to_message_id=message.id)
+    except Exception as e:
+        logging.error(e)
+        await bot.send_message(
+            user_id, "Не получилось ответить. Попробуй написать другое сообщение"
+        )
+
+
+# обрабатываем все остальные типы сообщений
+@bot.message_handler(
+    func=lambda message: True,
+    content_types=[
+        "audio",
+        "photo",
+        "voice",
+        "video",
+        "document",
+        "text",
+        "location",
+        "contact",
+        "sticker",
+    ],
+)
+async def send_echo(message: Message):
+    await bot.send_message(
+        chat_id=message.chat.id, text=ECHO_TEXT.format(text=message.text)
+    )
+
+
+logs.bind_handlers(bot)  # записи лога из обработчиков помечены user_id и id сообщения
+
+
+async def main():
+    # Создаем базу и табличку в ней
+    await run_sync(db.create_db)
+    await run_sync(db.create_table)
+    logging.info("Асинхронный бот запущен")
+    if METRICS_ENABLED:
+        metrics.start_server(METRICS_HOST, METRICS_PORT)
+    try:
+        await bot.infinity_polling(timeout=60, request_timeout=90)
+    finally:
+        await http_client.close_async_session()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,27 +1,96 @@
+import functools
 import logging
+from contextlib import closing
 
 import telebot
+from telebot import apihelper, custom_filters
 from telebot.types import Message
 
 import db
-from config import ADMINS, BOT_TOKEN, COUNT_LAST_MSG, LOGS_PATH, MAX_USERS
-from speechkit import speech_to_text, text_to_speech
+import gpt_cache
+import logs
+import metrics
+import ratelimit
+import sessions
+import shards
+import tokens
+import tts_cache
+import webhook
+from config import (
+    ADMINS,
+    BOT_TOKEN,
+    COUNT_LAST_MSG,
+    DISPATCH_MODE,
+    GPT_STREAM,
+    MAX_USERS,
+    MAX_WORKERS,
+    METRICS_ENABLED,
+    METRICS_HOST,
+    METRICS_PORT,
+    RUN_MODE,
+    SHARD_BASE_PORT,
+    SHARD_URLS,
+    STT_SHORT_AUDIO_LIMIT,
+    TELEGRAM_API_URL,
+    TTS_PIPELINE,
+    WEBHOOK_HOST,
+    WORKER_QUEUE_SIZE,
+    WORKER_QUEUE_TIMEOUT,
+)
+from dispatcher import PooledTeleBot
+from scheduler import PRIORITY_ADMIN, PRIORITY_TEXT, PRIORITY_VOICE, gpt_scheduler
+from speechkit import (
+    SPEECHKIT_ERROR,
+    speech_to_text,
+    speech_to_text_long,
+    split_long_audio,
+    text_to_speech,
+    tts_flight,
+)
+from states import DbStateStorage
+from streaming import StreamingReply
+from tts_pipeline import TtsPipeline
+from texts import ECHO_TEXT, HELP_TEXT, START_TEXT, USERS_LIMIT_TEXT
 from utils import (
     check_number_of_users,
     is_gpt_token_limit,
     is_stt_block_limit,
     is_tts_symbol_limit,
+    settle_gpt_tokens,
+    settle_stt_blocks,
 )
-from yandex_gpt import ask_gpt_helper
-
-logging.basicConfig(
-    filename=LOGS_PATH,
-    level=logging.DEBUG,
-    format="%(asctime)s %(message)s",
-    filemode="w",
-)
+from voice_files import download_file, get_file_url, get_voice_duration, iter_file
+from yandex_gpt import ask_gpt_helper, ask_gpt_helper_stream, gpt_flight
+
+# Процессы-обработчики (SHARDS, WEBHOOK_PROCESSES) пишут лог каждый в свой файл
+if shards.get_shard_index() is not None:
+    logs.setup(f"shard{shards.get_shard_index()}")
+elif webhook.get_worker_index() is not None:
+    logs.setup(f"worker{webhook.get_worker_index()}")
+else:
+    logs.setup()
+
+if TELEGRAM_API_URL:
+    # Bot API на другом адресе: локальный сервер Telegram или фейковый сервер loadtest
+    apihelper.API_URL = TELEGRAM_API_URL + "/bot{0}/{1}"
+    apihelper.FILE_URL = TELEGRAM_API_URL + "/file/bot{0}/{1}"
+
+# Состояния (ждём текст после /tts и т.п.) хранятся в общей БД и переживают перезапуск
+if DISPATCH_MODE == "pool":
+    # Сообщения одного чата обрабатываются по очереди, разных чатов - параллельно
+    bot = PooledTeleBot(
+        BOT_TOKEN,
+        workers=MAX_WORKERS,
+        queue_size=WORKER_QUEUE_SIZE,
+        queue_timeout=WORKER_QUEUE_TIMEOUT,
+        state_storage=DbStateStorage(),
+    )
+else:
+    bot = telebot.TeleBot(BOT_TOKEN, state_storage=DbStateStorage())
+bot.add_custom_filter(custom_filters.StateFilter(bot))
 
-bot = telebot.TeleBot(BOT_TOKEN)
+TTS_STATE = "tts"  # пользователь прислал /tts и мы ждём текст
+STT_STATE = "stt"  # пользователь прислал /stt и мы ждём ГС
 
 # Создаем базу и табличку в ней
 db.create_db()
@@ -33,27 +102,16 @@ def start(message):
     user_name = message.from_user.first_name
     user_id = message.from_user.id
 
-    if not db.is_user_in_db(user_id):  # Если пользователя в базе нет
-        if (
-            len(db.get_all_users_data()) < MAX_USERS
-        ):  # Если число зарегистрированных пользователей меньше допустимого
-            db.add_new_user(user_id)  # Регистрируем нового пользователя
-        else:
-            text = "К сожалению, лимит пользователей исчерпан🙅‍♂️. Вы не сможете воспользоваться ботом😔"
+    # Регистрируем нового пользователя, если число зарегистрированных меньше допустимого.
+    # Проверка и добавление атомарны в общей БД, поэтому лимит общий для всех процессов
+    if not sessions.add_new_user(user_id, MAX_USERS):
+        text = USERS_LIMIT_TEXT
 
-            bot.send_message(chat_id=user_id, text=text)
-            return
+        bot.send_message(chat_id=user_id, text=text)
+        return
 
     # Этот блок срабатывает только для зарегистрированных пользователей
-    text = (
-        f"Привет👋🏿, {user_name}! Я бот собеседник, и мы вместе можем решить любой твой вопрос,"
-        f" или просто поговорить 🎇.\n\n"
-        "Так же я могу работать с голосовыми сообщениями просто запиши мне ГС🔊, "
-        "и я c  удовольствием поговорю с тобой🗣️.\n\n"
-        "Если возникнут вопросы используй команду /help\n"
-        "что бы проверить работоспособность бота можешь использовать команды /stt и /tts.\n\n"
-        f"Ну что, начнём?"
-    )
+    text = START_TEXT.format(user_name=user_name)
 
     bot.send_message(
         chat_id=user_id,
@@ -66,14 +124,13 @@ def kill_session(message: Message):
     user_id = message.from_user.id
     if user_id in ADMINS:
         try:
-            db.update_row(user_id, "total_gpt_tokens", 0)
-            db.update_row(user_id, "tts_symbols", 0)
-            db.update_row(user_id, "stt_blocks", 0)
+            with db.transaction():  # обнуляем все лимиты одним коммитом
+                sessions.update_row(user_id, "total_gpt_tokens", 0)
+                sessions.update_row(user_id, "tts_symbols", 0)
+                sessions.update_row(user_id, "stt_blocks", 0)
         except Exception as e:
-            print(f"Произошла ошибка {e}, сессии не обновлены")
             logging.error(f"Произошла ошибка {e}, сессии не обновлены")
     else:
-        print(f"{user_id} попытался обновить сессии")
         logging.info(f"{user_id} попытался обновить сессии")
 
 
@@ -82,49 +139,73 @@ def send_logs(message):
     user_id = message.from_user.id
     if user_id in ADMINS:
         try:
-            with open(LOGS_PATH, "rb") as f:
-                bot.send_document(message.chat.id, f)
-        except telebot.apihelper.ApiTelegramException:
+            # только свежий хвост логов всех процессов: весь файл может быть слишком большим для Telegram
+            bot.send_document(message.chat.id, logs.get_tail_file())
+        except (OSError, telebot.apihelper.ApiTelegramException):
             bot.send_message(chat_id=message.chat.id, text="Логов нет!")
     else:
-        print(f"{user_id} захотел посмотреть логи")
         logging.info(f"{user_id} захотел посмотреть логи")
 
 
-@bot.message_handler(commands=["help"])
-def help_command(message: Message):
+@bot.message_handler(commands=["stats"])
+def send_stats(message: Message):
+    user_id = message.from_user.id
+    if user_id not in ADMINS:
+        logging.info(f"{user_id} захотел посмотреть статистику")
+        return
+    cache_stats = gpt_cache.get_stats()
     text = (
-        "👋 Я твой цифровой собеседник.\n\n"
-        "Что бы воспользоваться функцией gpt помощника 🕵‍♀️ следуй инструкциям бота .\n\n"
-        "Этот бот сделан на базе нейронной сети YandexGPT Lite,  \n"
-        "а так же в нём используется технология распознавания и синтеза речи Yandex SpeechKit\n"
-        "Это мой первый опыт знакомства с gpt, "
-        "поэтому не переживай если возникла какая-то ошибка. Просто сообщи мне об этом)\n"
-        "И я постараюсь её решить.\n\n"
-        " P.S. мои контакты можно найти в описании бота"
+        f"Кэш ответов GPT: {cache_stats['size']} ответов, попаданий: {cache_stats['hits']} "
+        f"(похожих: {cache_stats['similar_hits']}), промахов: {cache_stats['misses']}\n"
     )
+    for limiter in ratelimit.limiters:
+        limiter_stats = limiter.get_stats()
+        text += (
+            f"{limiter.name}: запросов {limiter_stats['requests']}, 429: {limiter_stats['throttled']}, "
+            f"не дождались очереди: {limiter_stats['timeouts']}, "
+            f"одновременно {limiter_stats['in_flight']} из {limiter_stats['concurrency_limit']}\n"
+        )
+    for flight in (gpt_flight, tts_flight):
+        flight_stats = flight.get_stats()
+        text += (
+            f"Объединение запросов {flight.name}: вызовов {flight_stats['calls']}, "
+            f"сэкономлено {flight_stats['coalesced']}, таймаутов {flight_stats['timeouts']}, "
+            f"ошибок {flight_stats['errors']}\n"
+        )
+    if isinstance(bot, PooledTeleBot):
+        stats = bot.get_stats()
+        text += (
+            f"Потоков: {stats['workers']}\n"
+            f"В очереди: {stats['queue_depth']} (макс. в одном потоке: {stats['queue_depth_max']})\n"
+            f"Принято: {stats['submitted']}, обработано: {stats['processed']}, "
+            f"отклонено: {stats['rejected']}, с ошибкой: {stats['failed']}\n"
+            f"Ожидание в очереди: ср. {stats['wait_seconds_avg']:.2f} c, макс. {stats['wait_seconds_max']:.2f} c\n"
+            f"Обработка: ср. {stats['handle_seconds_avg']:.2f} c, макс. {stats['handle_seconds_max']:.2f} c"
+        )
     bot.send_message(chat_id=message.chat.id, text=text)
 
 
-def filter_hello(message):
-    word = "привет"
-    return word in message.text.lower()
-
-
-@bot.message_handler(content_types=["text"], func=filter_hello)
-def say_hello(message: Message):
-    user_name = message.from_user.first_name
-    bot.send_message(chat_id=message.chat.id, text=f"{user_name}, приветики 👋!")
-
-
-def filter_bye(message):
-    word = "пока"
-    return word in message.text.lower()
+@bot.message_handler(commands=["queue"])
+def send_queue(message: Message):
+    user_id = message.from_user.id
+    if user_id not in ADMINS:
+        logging.info(f"{user_id} захотел посмотреть очередь к GPT")
+        return
+    stats = gpt_scheduler.get_stats()
+    waiting = ", ".join(f"{name}: {count}" for name, count in stats["waiting_by_priority"].items())
+    text = (
+        f"Запросов к GPT выполняется: {stats['in_flight']} из {stats['slots']}\n"
+        f"Ждут: {stats['waiting']} от {stats['waiting_users']} пользователей ({waiting})\n"
+        f"Обслужено: {stats['served']}, отказано: {stats['shed']}, не дождались: {stats['timeouts']}\n"
+        f"Ожидание: ср. {stats['wait_seconds_avg']:.2f} c, макс. {stats['wait_seconds_max']:.2f} c"
+    )
+    bot.send_message(chat_id=message.chat.id, text=text)
 
 
-@bot.message_handler(content_types=["text"], func=filter_bye)
-def say_bye(message: Message):
-    bot.send_message(chat_id=message.chat.id, text="Пока, заходи ещё!")
+@bot.message_handler(commands=["help"])
+def help_command(message: Message):
+    text = HELP_TEXT
+    bot.send_message(chat_id=message.chat.id, text=text)
 
 
 @bot.message_handler(commands=['tts'])
@@ -134,9 +215,11 @@ def tts_handler(message):
         chat_id=user_id,
         text='Отправь следующим сообщением текст💬, чтобы я его озвучил!🔊'
     )
-    bot.register_next_step_handler(message, tts)
+    bot.set_state(user_id, TTS_STATE, message.chat.id)
 
 
+@bot.message_handler(state=TTS_STATE, content_types=["text", "voice", "audio", "photo", "sticker"])
+@metrics.timed()
 def tts(message):
     user_id = message.from_user.id
     text = message.text
@@ -147,23 +230,23 @@ def tts(message):
             chat_id=user_id,
             text='Отправь текстовое сообщение'
         )
-        bot.register_next_step_handler(message, tts)
         return
+    bot.delete_state(user_id, message.chat.id)
 
-        # Считаем символы в тексте и проверяем сумму потраченных символов
-    tts_symbol = is_tts_symbol_limit(message, text)
-    if tts_symbol is None:
+    # Считаем символы в тексте и резервируем их в лимите пользователя
+    tts_symbols, error_message = is_tts_symbol_limit(user_id, text)
+    if tts_symbols is None:
+        bot.send_message(chat_id=user_id, text=error_message)
         return
 
     # Получаем статус и содержимое ответа от SpeechKit
-    status, content = text_to_speech(text)
+    status, content = synthesize(text)
+    if not status:
+        sessions.release_limit(user_id, "tts_symbols", tts_symbols)
 
     # Если статус True - отправляем голосовое сообщение, иначе - сообщение об ошибке
     if status:
-        bot.send_voice(
-            chat_id=user_id,
-            voice=content
-        )
+        send_voice_cached(user_id, text, content)
     else:
         bot.send_message(
             chat_id=user_id,
@@ -171,6 +254,50 @@ def tts(message):
         )
 
 
+@metrics.timed()
+def synthesize(text: str):
+    """
+    Функция для озвучивания текста: если такое ГС уже отправляли,
+    возвращает его file_id в Telegram вместо повторного синтеза
+    """
+    file_id = tts_cache.get_file_id(text)
+    if file_id:
+        return True, file_id
+    return text_to_speech(text)
+
+
+@metrics.timed("telegram.send_voice")
+def send_voice_cached(chat_id: int, text: str, voice, reply_to_message_id: int | None = None):
+    """Функция для отправки ГС с запоминанием его file_id для повторных отправок"""
+    sent_message = bot.send_voice(chat_id, voice, reply_to_message_id=reply_to_message_id)
+    if isinstance(voice, bytes):
+        tts_cache.remember_file_id(text, sent_message)
+
+
+@metrics.timed()
+def recognize_voice(user_id: int, file_url: str, duration: int, stt_blocks: int):
+    """
+    Функция для распознавания ГС. Короткое ГС передаётся в SpeechKit по мере скачивания,
+    длинное скачивается целиком и распознаётся по кускам.
+    Возвращает статус, текст и реально потраченные аудиоблоки
+    """
+    if duration < STT_SHORT_AUDIO_LIMIT:
+        # генератор закрываем сами: при ошибке SpeechKit он может быть прочитан не до конца
+        with closing(iter_file(file_url)) as chunks:
+            status, text = speech_to_text(chunks)
+        return status, text, stt_blocks
+
+    segments = split_long_audio(download_file(file_url))
+    if segments is None:
+        return False, SPEECHKIT_ERROR, stt_blocks
+    # резерв делался по длительности ГС, теперь известны куски - до распознавания резервируем ровно их блоки
+    used, error_message = settle_stt_blocks(user_id, stt_blocks, [duration for _, duration in segments])
+    if used is None:
+        return False, error_message, stt_blocks
+    status, text = speech_to_text_long(segments)
+    return status, text, used
+
+
 @bot.message_handler(commands=['stt'])
 def stt_handler(message):
     user_id = message.from_user.id
@@ -178,9 +305,11 @@ def stt_handler(message):
         chat_id=user_id,
         text="Отправь голосовое сообщение🔊, чтобы я его распознал!💬"
     )
-    bot.register_next_step_handler(message, stt)
+    bot.set_state(user_id, STT_STATE, message.chat.id)
 
 
+@bot.message_handler(state=STT_STATE, content_types=["text", "voice", "audio", "photo", "sticker"])
+@metrics.timed()
 def stt(message):
     user_id = message.from_user.id
 
@@ -190,20 +319,26 @@ def stt(message):
             chat_id=user_id,
             text="Пожалуйста, запиши ГС"
         )
-        bot.register_next_step_handler(message, stt)
         return
+    bot.delete_state(user_id, message.chat.id)
+
+    file_id = message.voice.file_id  # получаем id голосового сообщения
+    with metrics.stage("telegram.get_file"):
+        file_info = bot.get_file(file_id)  # получаем информацию о голосовом сообщении
+    file_url = get_file_url(file_info.file_path)  # ссылка, по которой ГС можно скачать
 
-    # Считаем аудиоблоки и проверяем сумму потраченных аудиоблоков
-    stt_blocks, error = is_stt_block_limit(message, message.voice.duration)
+    # Считаем аудиоблоки (длительность проверяем по самому файлу) и резервируем их в лимите пользователя
+    duration = get_voice_duration(file_url, message.voice.duration)
+    stt_blocks, error_message = is_stt_block_limit(user_id, duration)
     if not stt_blocks:
+        bot.send_message(chat_id=user_id, text=error_message)
         return
 
-    file_id = message.voice.file_id  # получаем id голосового сообщения
-    file_info = bot.get_file(file_id)  # получаем информацию о голосовом сообщении
-    file = bot.download_file(file_info.file_path)  # скачиваем голосовое сообщение
-
-    # Получаем статус и содержимое ответа от SpeechKit
-    status, text = speech_to_text(file)  # преобразовываем голосовое сообщение в текст
+    # Получаем статус и содержимое ответа от SpeechKit, ГС передаётся туда по мере скачивания
+    # преобразовываем голосовое сообщение в текст
+    status, text, stt_blocks = recognize_voice(user_id, file_url, duration, stt_blocks)
+    if not status:
+        sessions.release_limit(user_id, "stt_blocks", stt_blocks)
 
     if status:
         bot.send_message(
@@ -215,8 +350,30 @@ def stt(message):
         bot.send_message(user_id, text)
 
 
+def filter_hello(message):
+    word = "привет"
+    return word in message.text.lower()
+
+
+@bot.message_handler(content_types=["text"], func=filter_hello)
+def say_hello(message: Message):
+    user_name = message.from_user.first_name
+    bot.send_message(chat_id=message.chat.id, text=f"{user_name}, приветики 👋!")
+
+
+def filter_bye(message):
+    word = "пока"
+    return word in message.text.lower()
+
+
+@bot.message_handler(content_types=["text"], func=filter_bye)
+def say_bye(message: Message):
+    bot.send_message(chat_id=message.chat.id, text="Пока, заходи ещё!")
+
+
 # Декоратор для обработки голосовых сообщений, полученных ботом
 @bot.message_handler(content_types=["voice"])
+@metrics.timed()
 def handle_voice(message: telebot.types.Message):
     try:
         user_id = message.from_user.id
@@ -226,51 +383,66 @@ def handle_voice(message: telebot.types.Message):
             bot.send_message(chat_id=user_id, text=error_message)
             return
 
-        # Проверка на доступность аудиоблоков
-        stt_blocks, error_message = is_stt_block_limit(user_id, message.voice.duration)
+        # Проверка и резервирование аудиоблоков (длительность проверяем по самому файлу)
+        with metrics.stage("telegram.get_file"):
+            file_info = bot.get_file(message.voice.file_id)
+        file_url = get_file_url(file_info.file_path)
+        duration = get_voice_duration(file_url, message.voice.duration)
+        stt_blocks, error_message = is_stt_block_limit(user_id, duration)
         if error_message:
             bot.send_message(chat_id=user_id, text=error_message)
             return
 
-        # Обработка голосового сообщения
-        file_id = message.voice.file_id
-        file_info = bot.get_file(file_id)
-        file = bot.download_file(file_info.file_path)
-        status_stt, stt_text = speech_to_text(file)
+        # Обработка голосового сообщения: ГС передаётся в SpeechKit по мере скачивания
+        status_stt, stt_text, stt_blocks = recognize_voice(
+            user_id, file_url, duration, stt_blocks
+        )
         if not status_stt:
+            sessions.release_limit(user_id, "stt_blocks", stt_blocks)
             bot.send_message(chat_id=user_id, text=stt_text)
             return
 
-        # Запись в БД
-        db.add_message(
-            user_id=user_id, full_message=[stt_text, "user", 0, 0, stt_blocks]
+        # Запись в БД (аудиоблоки уже учтены при резервировании)
+        sessions.add_message(
+            user_id=user_id,
+            full_message=[stt_text, "user", 0, 0, stt_blocks],
+            count_limits=False,
         )
 
-        # Проверка на доступность GPT-токенов
-        last_messages, total_spent_tokens = db.select_n_last_messages(
-            user_id, COUNT_LAST_MSG
-        )
-        total_gpt_tokens, error_message = is_gpt_token_limit(
-            last_messages, total_spent_tokens
-        )
+        # Проверка и резервирование GPT-токенов
+        last_messages, _ = sessions.select_n_last_messages(user_id, COUNT_LAST_MSG)
+        prompt_tokens, error_message = is_gpt_token_limit(user_id, last_messages)
         if error_message:
             bot.send_message(chat_id=user_id, text=error_message)
             return
 
+        if TTS_PIPELINE:
+            send_answer_voice_pipelined(message, last_messages, prompt_tokens)
+            return
+
         # Запрос к GPT и обработка ответа
-        status_gpt, answer_gpt, tokens_in_answer = ask_gpt_helper(last_messages)
+        tokens_in_answer = None
+        try:
+            status_gpt, answer_gpt, tokens_in_answer = ask_gpt(
+                user_id, PRIORITY_VOICE, last_messages
+            )
+        finally:
+            # при исключении ответа нет, и резерв возвращается целиком
+            total_gpt_tokens = settle_gpt_tokens(user_id, prompt_tokens, tokens_in_answer)
         if not status_gpt:
             bot.send_message(user_id, answer_gpt)
             return
-        total_gpt_tokens += tokens_in_answer
 
-        # Проверка на лимит символов для SpeechKit
+        # Проверка и резервирование символов для SpeechKit
         tts_symbols, error_message = is_tts_symbol_limit(user_id, answer_gpt)
 
         # Запись ответа GPT в БД
-        db.add_message(
+        tokens.remember({"role": "assistant", "text": answer_gpt}, tokens_in_answer)
+        sessions.add_message(
             user_id=user_id,
-            full_message=[answer_gpt, "assistant", total_gpt_tokens, tts_symbols, 0],
+            full_message=[answer_gpt, "assistant", total_gpt_tokens, tts_symbols or 0, 0],
+            gpt_tokens=tokens_in_answer,
+            count_limits=False,
         )
 
         if error_message:
@@ -278,10 +450,12 @@ def handle_voice(message: telebot.types.Message):
             return
 
         # Преобразование ответа в аудио и отправка
-        status_tts, voice_response = text_to_speech(answer_gpt)
+        status_tts, voice_response = synthesize(answer_gpt)
+        if not status_tts:
+            sessions.release_limit(user_id, "tts_symbols", tts_symbols)
 
         if status_tts:
-            bot.send_voice(user_id, voice_response, reply_to_message_id=message.id)
+            send_voice_cached(user_id, answer_gpt, voice_response, message.id)
         else:
             bot.send_message(
                 chat_id=user_id, text=answer_gpt, reply_to_message_id=message.id
@@ -296,7 +470,67 @@ def handle_voice(message: telebot.types.Message):
         )
 
 
+@metrics.timed()
+def ask_gpt(user_id: int, priority: int, last_messages: list, on_chunk=None):
+    """
+    Функция для запроса к GPT через общую очередь с приоритетами.
+    Место в очереди занимает только запрос, который уходит в GPT: ответы из кэша
+    и ожидание такого же выполняющегося запроса идут без очереди.
+    Если задан on_chunk и включён GPT_STREAM, ответ передаётся в него по мере генерации.
+    Если очередь переполнена, возвращает ошибку с текстом BUSY_MESSAGE
+    """
+    if user_id in ADMINS:
+        priority = PRIORITY_ADMIN
+    slot = functools.partial(gpt_scheduler.slot, user_id, priority)
+    if on_chunk is not None and GPT_STREAM:
+        return ask_gpt_helper_stream(last_messages, on_chunk, slot)
+    return ask_gpt_helper(last_messages, slot)
+
+
+@metrics.timed()
+def send_answer_voice_pipelined(message: Message, last_messages: list, prompt_tokens: int):
+    """
+    Функция для ответа голосом по предложениям: каждое готовое предложение ответа GPT
+    сразу озвучивается и отправляется отдельным ГС, не дожидаясь конца генерации
+    """
+    user_id = message.from_user.id
+    tokens_in_answer = None
+    try:
+        pipeline = TtsPipeline(
+            user_id,
+            lambda voice: bot.send_voice(user_id, voice, reply_to_message_id=message.id),
+        )
+        status_gpt, answer_gpt, tokens_in_answer = ask_gpt(
+            user_id, PRIORITY_VOICE, last_messages, pipeline.feed
+        )
+    finally:
+        # при исключении ответа нет, и резерв возвращается целиком
+        total_gpt_tokens = settle_gpt_tokens(user_id, prompt_tokens, tokens_in_answer)
+    if not status_gpt:
+        pipeline.finish("")  # дожидаемся уже начатого озвучивания
+        bot.send_message(user_id, answer_gpt)
+        return
+
+    tts_symbols, error_message = pipeline.finish(answer_gpt)
+
+    # Запись ответа GPT в БД (символы уже учтены при резервировании по предложениям)
+    tokens.remember({"role": "assistant", "text": answer_gpt}, tokens_in_answer)
+    sessions.add_message(
+        user_id=user_id,
+        full_message=[answer_gpt, "assistant", total_gpt_tokens, tts_symbols, 0],
+        gpt_tokens=tokens_in_answer,
+        count_limits=False,
+    )
+
+    if error_message:
+        bot.send_message(chat_id=user_id, text=error_message)
+    if not pipeline.sent:
+        # Ни одно предложение не удалось озвучить - отвечаем текстом
+        bot.send_message(chat_id=user_id, text=answer_gpt, reply_to_message_id=message.id)
+
+
 @bot.message_handler(content_types=["text"])
+@metrics.timed()
 def handle_text(message):
     try:
         user_id = message.from_user.id
@@ -310,42 +544,50 @@ def handle_text(message):
         # БД: добавляем сообщение пользователя и его роль в базу данных
         full_user_message = [message.text, "user", 0, 0, 0]
 
-        db.add_message(user_id=user_id, full_message=full_user_message)
+        sessions.add_message(user_id=user_id, full_message=full_user_message)
 
         # ВАЛИДАЦИЯ: считаем количество доступных пользователю GPT-токенов
-        # получаем последние 4 (COUNT_LAST_MSG) сообщения и количество уже потраченных токенов
-        last_messages, total_spent_tokens = db.select_n_last_messages(
-            user_id, COUNT_LAST_MSG
-        )
+        # получаем последние 4 (COUNT_LAST_MSG) сообщения
+        last_messages, _ = sessions.select_n_last_messages(user_id, COUNT_LAST_MSG)
 
-        # получаем сумму уже потраченных токенов + токенов в новом сообщении и оставшиеся лимиты пользователя
-        total_gpt_tokens, error_message = is_gpt_token_limit(
-            last_messages, total_spent_tokens
-        )
+        # резервируем токены запроса и ответа в счётчике пользователя
+        prompt_tokens, error_message = is_gpt_token_limit(user_id, last_messages)
 
         if error_message:
             # если что-то пошло не так — уведомляем пользователя и прекращаем выполнение функции
             bot.send_message(chat_id=user_id, text=error_message)
             return
 
-        # GPT: отправляем запрос к GPT
-        status_gpt, answer_gpt, tokens_in_answer = ask_gpt_helper(last_messages)
+        # GPT: отправляем запрос к GPT, в режиме GPT_STREAM показываем ответ по мере генерации
+        tokens_in_answer = None
+        try:
+            reply = StreamingReply(bot, user_id, reply_to_message_id=message.id)
+            status_gpt, answer_gpt, tokens_in_answer = ask_gpt(
+                user_id, PRIORITY_TEXT, last_messages, reply.update
+            )
+        finally:
+            # возвращаем неиспользованную часть резерва: токены запроса + токены в ответе GPT
+            # (при исключении ответа нет, и резерв возвращается целиком)
+            total_gpt_tokens = settle_gpt_tokens(user_id, prompt_tokens, tokens_in_answer)
 
         # GPT: обрабатываем ответ от GPT
         if not status_gpt:
             # если что-то пошло не так — уведомляем пользователя и прекращаем выполнение функции
+            reply.abort()  # часть ответа могла быть уже показана - помечаем её оборванной
             bot.send_message(chat_id=user_id, text=answer_gpt)
             return
-        # сумма всех потраченных токенов + токены в ответе GPT
-        total_gpt_tokens += tokens_in_answer
 
         # БД: добавляем ответ GPT и потраченные токены в базу данных
         full_gpt_message = [answer_gpt, "assistant", total_gpt_tokens, 0, 0]
-        db.add_message(user_id=user_id, full_message=full_gpt_message)
+        tokens.remember({"role": "assistant", "text": answer_gpt}, tokens_in_answer)
+        sessions.add_message(
+            user_id=user_id,
+            full_message=full_gpt_message,
+            gpt_tokens=tokens_in_answer,
+            count_limits=False,
+        )
 
-        bot.send_message(
-            chat_id=user_id, text=answer_gpt, reply_to_message_id=message.id
-        )  # отвечаем пользователю текстом
+        reply.finish(answer_gpt)  # отвечаем пользователю текстом
     except Exception as e:
         logging.error(e)  # если ошибка — записываем её в логи
         bot.send_message(
@@ -370,12 +612,31 @@ def handle_text(message):
     ],
 )
 def send_echo(message: Message):
-    text = (
-        f"Вы отправили ({message.text}).\n"
-        f"Но к сожалению я вас не понял😔, Отправь мне голосовое или текстовое сообщение, и я тебе отвечу🤗"
-    )
+    text = ECHO_TEXT.format(text=message.text)
     bot.send_message(chat_id=message.chat.id, text=text)
 
 
-logging.info("Бот запущен")
-bot.infinity_polling(timeout=60, long_polling_timeout=5)
+logs.bind_handlers(bot)  # записи лога из обработчиков помечены user_id и id сообщения
+
+app = webhook.create_app(bot)  # WSGI-приложение для режима webhook
+
+if __name__ == "__main__":
+    webhook.handle_sigterm()  # роутер и главный процесс webhook останавливают дочерние процессы через SIGTERM
+    shard = shards.get_shard_index()
+    if METRICS_ENABLED:
+        # у каждого процесса свой порт: общий порт отдавал бы метрики случайного процесса
+        process = shard if shard is not None else webhook.get_worker_index()
+        metrics.start_server(METRICS_HOST, METRICS_PORT if process is None else METRICS_PORT + 1 + process)
+    if shard is not None:
+        # процесс-обработчик: получает обновления своих пользователей от роутера
+        logging.info(f"Обработчик {shard} запущен")
+        webhook.serve(app, WEBHOOK_HOST, SHARD_BASE_PORT + shard)
+    elif SHARD_URLS:
+        shards.run(bot)
+    elif RUN_MODE == "webhook":
+        logging.info("Бот запущен в режиме webhook")
+        webhook.run(bot, app)
+    else:
+        logging.info("Бот запущен")
+        bot.remove_webhook()  # пока webhook установлен, getUpdates не работает
+        bot.infinity_polling(timeout=60, long_polling_timeout=5)
@@ -0,0 +1,118 @@
+import asyncio
+import threading
+
+from config import COALESCE_TIMEOUT
+
+
+class _Call:
+    """Выполняющийся запрос, результат которого ждут все одинаковые запросы"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Объединение одинаковых запросов: пока запрос с ключом key выполняется,
+    остальные такие же запросы не идут в API, а ждут его результата (или ошибки)
+    """
+
+    def __init__(self, name: str, is_failure=None):
+        """
+        is_failure(result) - для функций, которые не выбрасывают ошибку, а возвращают её
+        (например, (False, текст ошибки)): такие результаты тоже считаются ошибками
+        """
+        self.name = name
+        self._is_failure = is_failure
+        self._calls = {}  # ключ -> _Call
+        self._async_calls = {}  # ключ -> asyncio.Future (только из event loop)
+        self._lock = threading.Lock()
+        self._stats = {"calls": 0, "coalesced": 0, "timeouts": 0, "errors": 0}
+
+    def do(self, key: str, func, *args, timeout: float = COALESCE_TIMEOUT):
+        """
+        Выполняет func(*args) или ждёт результата такого же уже выполняющегося запроса.
+        Если ждать пришлось дольше timeout секунд, выбрасывает TimeoutError
+        """
+        with self._lock:
+            self._stats["calls"] += 1
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = _Call()
+            else:
+                self._stats["coalesced"] += 1
+
+        if is_leader:
+            try:
+                call.result = func(*args)
+                self._count_result(call.result)
+                return call.result
+            except BaseException as e:
+                call.error = e
+                with self._lock:
+                    self._stats["errors"] += 1
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+
+        if not call.done.wait(timeout):
+            with self._lock:
+                self._stats["timeouts"] += 1
+            raise TimeoutError(f"{self.name}: запрос {key} выполняется дольше {timeout} с")
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    async def do_async(self, key: str, func, *args, timeout: float = COALESCE_TIMEOUT):
+        """Асинхронная версия do: func - корутинная функция"""
+        with self._lock:
+            self._stats["calls"] += 1
+        future = self._async_calls.get(key)
+        if future is not None:
+            with self._lock:
+                self._stats["coalesced"] += 1
+            # asyncio.wait, в отличие от wait_for, не отменяет сам запрос по таймауту ожидающего
+            done, _ = await asyncio.wait({future}, timeout=timeout)
+            if not done:
+                with self._lock:
+                    self._stats["timeouts"] += 1
+                raise TimeoutError(f"{self.name}: запрос {key} выполняется дольше {timeout} с")
+            return future.result()
+
+        future = self._async_calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await func(*args)
+            self._count_result(result)
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            # отменили того, кто выполнял запрос, а не ожидающих: они получают ошибку
+            # запроса, как при таймауте, а не CancelledError, которая отменила бы их самих
+            with self._lock:
+                self._stats["errors"] += 1
+            future.set_exception(TimeoutError(f"{self.name}: запрос {key} отменён"))
+            future.exception()
+            raise
+        except BaseException as e:
+            with self._lock:
+                self._stats["errors"] += 1
+            future.set_exception(e)
+            future.exception()  # ошибку получит вызывающий, ожидающих может и не быть
+            raise
+        finally:
+            del self._async_calls[key]
+
+    def _count_result(self, result):
+        if self._is_failure is not None and self._is_failure(result):
+            with self._lock:
+                self._stats["errors"] += 1
+
+    def get_stats(self) -> dict:
+        """Возвращает счётчики: всего вызовов, сэкономлено запросов, таймаутов и ошибок"""
+        with self._lock:
+            return dict(self._stats)
@@ -1,64 +1,48 @@
+import hashlib
 import logging
-import sqlite3
+import time
 
-from config import DB_NAME, DB_TABLE_USERS_NAME, LOGS_PATH
+import metrics
+from config import METRICS_ENABLED, STORAGE_BACKEND, WEBHOOK_DEDUP_TTL
+from storage import create_storage
 
-logging.basicConfig(
-    filename=LOGS_PATH,
-    level=logging.ERROR,
-    format="%(asctime)s FILE: %(filename)s IN: %(funcName)s MESSAGE: %(message)s",
-    filemode="w",
-)
 
-
-def create_db():
-    connection = sqlite3.connect(DB_NAME)
-    connection.close()
+# Хранилище выбирается в config.py (STORAGE_BACKEND): SQLite, память или PostgreSQL.
+# Остальные модули работают с БД только через функции этого модуля
+storage = create_storage(STORAGE_BACKEND)
+if METRICS_ENABLED:
+    # каждое обращение к хранилищу замеряется как этап "db.<метод>"
+    storage = metrics.TimedProxy(storage, "db", exclude=("transaction", "close"))
 
 
-def execute_query(query: str, data: tuple | None = None, db_name: str = DB_NAME):
+def transaction():
     """
-    Функция для выполнения запроса к базе данных.
-    Принимает имя файла базы данных, SQL-запрос и опциональные данные для вставки.
+    Контекстный менеджер для явной транзакции.
+    Все запросы внутри блока (в том числе во вложенных transaction)
+    фиксируются одним коммитом, при ошибке - откатываются
     """
-    try:
-        connection = sqlite3.connect(db_name)
-        cursor = connection.cursor()
+    return storage.transaction()
 
-        if data:
-            cursor.execute(query, data)
-            connection.commit()
 
-        else:
-            cursor.execute(query)
+def close_connection():
+    """Функция для закрытия соединения текущего потока"""
+    storage.close()
 
-    except sqlite3.Error as e:
-        print("Ошибка при выполнении запроса: ", e)
-        logging.error("Ошибка при выполнении запроса: ", e)
 
-    else:
-        result = cursor.fetchall()
-        connection.close()
-        return result
+def create_db():
+    pass  # база создаётся при первом обращении, таблицы - в create_table
 
 
 def create_table():
     """
-    Функция для создания таблицы.
+    Функция для создания таблиц пользователей и сообщений.
+    Таблица users хранит счётчики лимитов пользователя,
+    таблица messages - историю диалога с индексом по (user_id, id),
+    таблица updates - id обновлений, уже полученных через webhook,
+    таблица states - состояния пользователей (DbStateStorage)
     """
     try:
-        sql_query = (
-            f"CREATE TABLE IF NOT EXISTS {DB_TABLE_USERS_NAME} "
-            f"(id INTEGER PRIMARY KEY, "
-            f"user_id INTEGER, "
-            f"message TEXT, "
-            f"role TEXT, "
-            f"total_gpt_tokens INTEGER, "
-            f"tts_symbols INTEGER, "
-            f"stt_blocks INTEGER);"
-        )
-        execute_query(sql_query)
-        print("Таблица успешно создана")
+        storage.create_schema()
         logging.info("Таблица успешно создана")
 
     except Exception as e:
@@ -67,83 +51,124 @@ def create_table():
         )
 
 
-def add_new_user(user_id: int):
-    """Функция добавления нового пользователя в базу"""
-    if not is_user_in_db(user_id):
-        sql_query = (
-            f"INSERT INTO {DB_TABLE_USERS_NAME} " 
-            f"(user_id, message, role, total_gpt_tokens, tts_symbols, stt_blocks) "
-            f"VALUES (?, 'Привет', 'user', {0}, {0}, {0});"
-        )
-        execute_query(sql_query, (user_id,))
-        print("Пользователь успешно добавлен")
-        logging.info("Пользователь успешно добавлен")
-    else:
-        print("Пользователь уже существует!")
-        logging.info("Пользователь уже существует!")
-
-
-def update_row(user_id: int, column_name: str, new_value: str | int | None):
-    """Функция для обновления значения таблицы"""
-    if is_user_in_db(user_id):
-        sql_query = (
-            f"UPDATE {DB_TABLE_USERS_NAME} "
-            f"SET {column_name} = ? "
-            f"WHERE user_id = ?;"
-        )
+def get_message_hash(role: str, text: str) -> str:
+    """Функция для получения хэша содержимого сообщения"""
+    return hashlib.sha1(f"{role}\n{text}".encode("utf-8")).hexdigest()
 
-        execute_query(sql_query, (new_value, user_id))
 
-    else:
-        print("Пользователь не найден в базе")
-        logging.info("Пользователь не найден в базе")
+def add_new_user(user_id: int, max_users: int | None = None) -> bool:
+    """
+    Функция добавления нового пользователя в базу.
+    Если задан max_users, пользователь добавляется, только пока пользователей меньше max_users:
+    проверка и добавление атомарны, поэтому лимит соблюдается,
+    даже если пользователей регистрируют несколько процессов сразу.
+    Возвращает True, если пользователь есть в базе
+    """
+    return storage.add_new_user(user_id, max_users)
 
 
-def get_all_users_data():
-    """Функция для предоставления информации о пользователе"""
-    sql_query = f"SELECT * " f"FROM {DB_TABLE_USERS_NAME};"
+def update_row(user_id: int, column_name: str, new_value: int):
+    """Функция для обновления счётчика лимитов пользователя"""
+    try:
+        if is_user_in_db(user_id):
+            storage.set_limit(user_id, column_name, new_value)
+        else:
+            logging.info("Пользователь не найден в базе")
+    except Exception as e:
+        logging.error(f"Ошибка при обновлении {column_name}: {e}")
+
 
-    result = execute_query(sql_query)
-    return result
+def get_all_users_data():
+    """Функция для предоставления информации о пользователях"""
+    try:
+        return storage.get_all_users_data()
+    except Exception as e:
+        logging.error(f"Ошибка при выполнении запроса: {e}")
 
 
 def is_user_in_db(user_id: int) -> bool:
-    sql_query = f"SELECT user_id " f"FROM {DB_TABLE_USERS_NAME} " f"WHERE user_id = ?;"
-    return bool(execute_query(sql_query, (user_id,)))
-
-
-def add_message(user_id, full_message):
-    """Функция, которая добавляет новое сообщение в таблицу"""
-    if is_user_in_db(user_id):
-        message, role, total_gpt_tokens, tts_symbols, stt_blocks = full_message
-        # записываем в таблицу новое сообщение
-        sql_query = (
-            f"INSERT INTO {DB_TABLE_USERS_NAME} (user_id, message, role, total_gpt_tokens, tts_symbols, stt_blocks)"
-            f"VALUES (?, ?, ?, ?, ?, ?)"
-        )
-        execute_query(
-            sql_query,
-            (user_id, message, role, total_gpt_tokens, tts_symbols, stt_blocks),
-        )
+    try:
+        return storage.is_user_in_db(user_id)
+    except Exception as e:
+        logging.error(f"Ошибка при выполнении запроса: {e}")
+        return False
 
 
-def count_users(user_id):
-    """Функция для подсчёта пользователей"""
-    try:
-        with sqlite3.connect(DB_NAME) as conn:
-            cursor = conn.cursor()
-            sql_query = (
-                f"SELECT COUNT(DISTINCT user_id) "
-                f"FROM {DB_TABLE_USERS_NAME} "
-                f"WHERE user_id <> ?"
+def add_message(
+    user_id, full_message, gpt_tokens: int | None = None, count_limits: bool = True
+):
+    """
+    Функция, которая добавляет новое сообщение в таблицу
+    и в той же транзакции прибавляет потраченные на него ресурсы к счётчикам пользователя.
+    gpt_tokens - количество токенов в самом сообщении, если оно уже известно.
+    count_limits=False - ресурсы уже зарезервированы через reserve_limit
+    """
+    message, role, total_gpt_tokens, tts_symbols, stt_blocks = full_message
+    with transaction():
+        if is_user_in_db(user_id):
+            add_messages_batch(
+                [(user_id, message, role, total_gpt_tokens, tts_symbols, stt_blocks, gpt_tokens)]
             )
-            cursor.execute(sql_query, (user_id,))
-            count = cursor.fetchone()[0]
-            return count
+            if count_limits:
+                add_limits_batch(
+                    {
+                        user_id: {
+                            "total_gpt_tokens": total_gpt_tokens,
+                            "tts_symbols": tts_symbols,
+                            "stt_blocks": stt_blocks,
+                        }
+                    }
+                )
+
+
+def get_message_tokens(text_hash: str) -> int | None:
+    """Функция для получения сохранённого количества токенов в сообщении по его хэшу"""
+    try:
+        return storage.get_message_tokens(text_hash)
     except Exception as e:
-        logging.error(
-            f"Ошибка при подсчёте пользователей в бд: {e}"
-        )
+        logging.error(f"Ошибка при выполнении запроса: {e}")
+        return None
+
+
+def save_message_tokens(text_hash: str, gpt_tokens: int):
+    """Функция для сохранения количества токенов у всех сообщений с таким хэшем"""
+    try:
+        storage.save_message_tokens(text_hash, gpt_tokens)
+    except Exception as e:
+        logging.error(f"Ошибка при выполнении запроса: {e}")
+
+
+def mark_update(update_id: int) -> bool:
+    """
+    Функция для отметки обновления Telegram как полученного.
+    Возвращает False, если обновление с таким id уже получали (Telegram прислал его повторно).
+    Работает и из нескольких процессов, потому что отметка - одна вставка в общую БД
+    """
+    now = time.time()
+    try:
+        marked = storage.mark_update(update_id, now)
+        if update_id % 1000 == 0:
+            # время от времени забываем старые id, чтобы таблица не росла
+            storage.forget_updates(now - WEBHOOK_DEDUP_TTL)
+        return marked
+    except Exception as e:
+        logging.error(f"Ошибка при отметке обновления {update_id}: {e}")
+        return True  # лучше обработать обновление дважды, чем потерять
+
+
+def count_all_users() -> int:
+    """Функция для подсчёта всех зарегистрированных пользователей"""
+    try:
+        return storage.count_all_users()
+    except Exception as e:
+        logging.error(f"Ошибка при подсчёте пользователей в бд: {e}")
+        return 0
+
+
+def count_users(user_id):
+    """Функция для подсчёта пользователей"""
+    count = count_all_users()
+    return count - 1 if is_user_in_db(user_id) else count
 
 
 def select_n_last_messages(user_id, n_last_messages=4):
@@ -151,26 +176,10 @@ def select_n_last_messages(user_id, n_last_messages=4):
     messages = []  # список с сообщениями
     total_spent_tokens = 0  # количество потраченных токенов за всё время общения
     try:
-        with sqlite3.connect(DB_NAME) as conn:
-            cursor = conn.cursor()
-            sql_query = (
-                f"SELECT message, role, total_gpt_tokens "
-                f"FROM {DB_TABLE_USERS_NAME} "
-                f"WHERE user_id=? "
-                f"ORDER BY id DESC LIMIT ?"
-            )
-            cursor.execute(sql_query, (user_id, n_last_messages))
-            data = cursor.fetchall()
-            # проверяем data на наличие хоть какого-то полученного результата запроса
-            # и на то, что в результате запроса есть хотя бы одно сообщение - data[0]
-            if data and data[0]:
-                # формируем список сообщений
-                for message in reversed(data):
-                    messages.append({"text": message[0], "role": message[1]})
-                    total_spent_tokens = max(total_spent_tokens, message[2])
-                    # находим максимальное количество потраченных токенов
-            # если результата нет, так как у нас ещё нет сообщений - возвращаем значения по умолчанию
-            return messages, total_spent_tokens
+        messages = storage.select_last_messages(user_id, n_last_messages)
+        # потраченные токены берём из счётчика пользователя, а не из последних сообщений
+        total_spent_tokens = count_all_limits(user_id, "total_gpt_tokens")
+        return messages, total_spent_tokens
     except Exception as e:
         logging.error(
             f"Ошибка при получении последних n сообщений: {e}"
@@ -178,36 +187,91 @@ def select_n_last_messages(user_id, n_last_messages=4):
         return messages, total_spent_tokens
 
 
-# подсчитываем количество потраченных пользователем ресурсов (<limit_type> - символы или аудиоблоки)
 def count_all_limits(user_id, limit_type):
     """Функция для подсчёта потраченных ресурсов (<limit_type> - символы или аудиоблоки)"""
+    limits = get_user_limits(user_id)
+    if limits and limits[limit_type]:
+        logging.info(
+            f"DATABASE: У user_id={user_id} использовано {limits[limit_type]} {limit_type}"
+        )
+        return limits[limit_type]
+    return 0
+
+
+def get_user_limits(user_id: int) -> dict | None:
+    """Функция для получения всех счётчиков лимитов пользователя одним запросом"""
     try:
-        with sqlite3.connect(DB_NAME) as conn:
-            cursor = conn.cursor()
-            # считаем лимиты по <limit_type>, которые использовал пользователь
-            sql_query = (
-                f"SELECT SUM({limit_type}) "
-                f"FROM {DB_TABLE_USERS_NAME} "
-                f"WHERE user_id=?"
-            )
-            cursor.execute(sql_query, (user_id,))
-            data = cursor.fetchone()
-            # проверяем data на наличие хоть какого-то полученного результата запроса
-            # и на то, что в результате запроса мы получили какое-то число в data[0]
-            if data and data[0]:
-                # если результат есть и data[0] == какому-то числу, то:
-                logging.info(
-                    f"DATABASE: У user_id={user_id} использовано {data[0]} {limit_type}"
-                )
-                return data[
-                    0
-                ]  # возвращаем это число - сумму всех потраченных <limit_type>
-            else:
-                # результата нет, так как у нас ещё нет записей о потраченных <limit_type>
-                return 0  # возвращаем 0
+        return storage.get_user_limits(user_id)
+    except Exception as e:
+        logging.error(f"Ошибка при получении счётчиков пользователя: {e}")
+        return None
+
 
+def reserve_limit(user_id: int, limit_type: str, amount: int, max_value: int) -> bool:
+    """
+    Функция для атомарной проверки и резервирования ресурсов (<limit_type>).
+    Счётчик увеличивается только если после этого он не превысит max_value,
+    поэтому параллельные сообщения не могут вместе выйти за лимит
+    """
+    try:
+        return storage.reserve_limit(user_id, limit_type, amount, max_value)
     except Exception as e:
-        logging.error(
-            f"Ошибка при подсчёте потраченных ресурсов: {e}"
-        )  # если ошибка - записываем её в логи
-        return 0
+        logging.error(f"Ошибка при резервировании {limit_type}: {e}")
+        return False
+
+
+def release_limit(user_id: int, limit_type: str, amount: int):
+    """Функция для возврата неиспользованных зарезервированных ресурсов"""
+    if amount <= 0:
+        return
+    try:
+        storage.release_limit(user_id, limit_type, amount)
+    except Exception as e:
+        logging.error(f"Ошибка при возврате {limit_type}: {e}")
+
+
+def add_messages_batch(messages: list[tuple]):
+    """
+    Функция для записи пачки сообщений одним коммитом.
+    messages - кортежи (user_id, message, role, total_gpt_tokens, tts_symbols, stt_blocks, gpt_tokens).
+    Счётчики пользователей не меняются - для них есть add_limits_batch.
+    При ошибке выбрасывает исключение, чтобы пачку можно было повторить
+    """
+    rows = [
+        (user_id, message, role, total_gpt_tokens, tts_symbols, stt_blocks,
+         get_message_hash(role, message), gpt_tokens)
+        for user_id, message, role, total_gpt_tokens, tts_symbols, stt_blocks, gpt_tokens in messages
+    ]
+    storage.add_messages(rows)
+
+
+def add_limits_batch(limits: dict[int, dict]):
+    """
+    Функция для прибавления пачки изменений к счётчикам пользователей одним коммитом.
+    limits - {user_id: {limit_type: изменение}}
+    """
+    storage.add_limits(limits)
+
+
+def get_state(chat_id: int, user_id: int) -> tuple[str | None, str] | None:
+    """Функция для получения состояния пользователя и его данных (JSON)"""
+    try:
+        return storage.get_state(chat_id, user_id)
+    except Exception as e:
+        logging.error(f"Ошибка при чтении состояния пользователя {user_id}: {e}")
+        return None
+
+
+def set_state(chat_id: int, user_id: int, state: str):
+    """Функция для записи состояния пользователя"""
+    storage.set_state(chat_id, user_id, state)
+
+
+def delete_state(chat_id: int, user_id: int) -> bool:
+    """Функция для удаления состояния пользователя"""
+    return storage.delete_state(chat_id, user_id)
+
+
+def save_state_data(chat_id: int, user_id: int, data: str):
+    """Функция для записи данных состояния пользователя (JSON)"""
+    storage.save_state_data(chat_id, user_id, data)
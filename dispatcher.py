@@ -0,0 +1,149 @@
+import logging
+import queue
+import threading
+import time
+
+import telebot
+
+BUSY_MESSAGE = "Сейчас я отвечаю слишком многим, попробуй написать чуть позже🙏"
+
+
+class OrderedWorkerPool:
+    """
+    Пул потоков, в котором задачи с одним ключом выполняются строго по очереди,
+    а задачи с разными ключами - параллельно.
+    У каждого потока своя ограниченная очередь, ключ всегда попадает в одну и ту же
+    """
+
+    def __init__(self, handler, workers: int, queue_size: int, name: str = "worker"):
+        self._handler = handler
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "submitted": 0,
+            "processed": 0,
+            "rejected": 0,
+            "failed": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+            "handle_seconds_total": 0.0,
+            "handle_seconds_max": 0.0,
+        }
+        for number, tasks in enumerate(self._queues):
+            threading.Thread(
+                target=self._work, args=(tasks,), name=f"{name}-{number}", daemon=True
+            ).start()
+
+    def submit(self, key, item, timeout: float | None = None) -> bool:
+        """
+        Ставит задачу в очередь потока, отвечающего за ключ.
+        Если очередь заполнена, ждёт до timeout секунд и возвращает False
+        """
+        tasks = self._queues[hash(key) % len(self._queues)]
+        try:
+            tasks.put((time.monotonic(), item), timeout=timeout)
+        except queue.Full:
+            with self._stats_lock:
+                self._stats["rejected"] += 1
+            return False
+        with self._stats_lock:
+            self._stats["submitted"] += 1
+        return True
+
+    def _work(self, tasks: queue.Queue):
+        while True:
+            queued_at, item = tasks.get()
+            started_at = time.monotonic()
+            failed = False
+            try:
+                self._handler(item)
+            except Exception as e:
+                failed = True
+                logging.error(f"Ошибка при обработке задачи в пуле: {e}")
+            finished_at = time.monotonic()
+            self._record(started_at - queued_at, finished_at - started_at, failed)
+            tasks.task_done()
+
+    def _record(self, wait_seconds: float, handle_seconds: float, failed: bool):
+        with self._stats_lock:
+            stats = self._stats
+            stats["processed"] += 1
+            stats["failed"] += failed
+            stats["wait_seconds_total"] += wait_seconds
+            stats["wait_seconds_max"] = max(stats["wait_seconds_max"], wait_seconds)
+            stats["handle_seconds_total"] += handle_seconds
+            stats["handle_seconds_max"] = max(stats["handle_seconds_max"], handle_seconds)
+
+    def get_stats(self) -> dict:
+        """Возвращает счётчики пула, текущую глубину очередей и средние задержки"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        depths = [tasks.qsize() for tasks in self._queues]
+        processed = stats["processed"] or 1
+        stats["queue_depth"] = sum(depths)
+        stats["queue_depth_max"] = max(depths)
+        stats["workers"] = len(self._queues)
+        stats["wait_seconds_avg"] = stats["wait_seconds_total"] / processed
+        stats["handle_seconds_avg"] = stats["handle_seconds_total"] / processed
+        return stats
+
+
+def get_update_key(update: telebot.types.Update):
+    """Функция для получения ключа очереди: id чата, из которого пришло обновление"""
+    for message in (
+        update.message,
+        update.edited_message,
+        update.callback_query.message if update.callback_query else None,
+    ):
+        if message is not None:
+            return message.chat.id
+    return update.update_id
+
+
+class PooledTeleBot(telebot.TeleBot):
+    """
+    TeleBot, который обрабатывает обновления на ограниченном пуле потоков:
+    сообщения одного чата - по очереди, разных чатов - параллельно.
+    Если очередь заполнена, поток получения обновлений ждёт (backpressure),
+    а после queue_timeout секунд отвечает пользователю, что бот занят
+    """
+
+    def __init__(self, token: str, workers: int, queue_size: int, queue_timeout: float, **kwargs):
+        self._last_update_id = 0
+        self._update_id_lock = threading.Lock()
+        super().__init__(token, threaded=False, **kwargs)
+        self.queue_timeout = queue_timeout
+        self.pool = OrderedWorkerPool(
+            self._process_update, workers, queue_size, name="bot-worker"
+        )
+
+    @property
+    def last_update_id(self) -> int:
+        return self._last_update_id
+
+    @last_update_id.setter
+    def last_update_id(self, value: int):
+        # Потоки пула обрабатывают обновления не по порядку, id может только расти
+        with self._update_id_lock:
+            if value > self._last_update_id:
+                self._last_update_id = value
+
+    def _process_update(self, update: telebot.types.Update):
+        super().process_new_updates([update])
+
+    def process_new_updates(self, updates: list):
+        for update in updates:
+            # Сдвигаем offset сразу, иначе при следующем запросе обновление придёт ещё раз
+            self.last_update_id = update.update_id
+            key = get_update_key(update)
+            if self.pool.submit(key, update, timeout=self.queue_timeout):
+                continue
+            logging.error(f"Очередь обработки переполнена, обновление {update.update_id} отброшено")
+            if update.message is not None:
+                try:
+                    self.send_message(chat_id=update.message.chat.id, text=BUSY_MESSAGE)
+                except Exception as e:
+                    logging.error(f"Не удалось отправить сообщение о занятости: {e}")
+
+    def get_stats(self) -> dict:
+        return self.pool.get_stats()
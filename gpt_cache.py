@@ -0,0 +1,137 @@
+import hashlib
+import json
+import math
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+
+import metrics
+from config import (
+    GPT_CACHE_MODE,
+    GPT_CACHE_NGRAM,
+    GPT_CACHE_SIMILARITY,
+    GPT_CACHE_SIZE,
+    GPT_CACHE_TTL,
+    SYSTEM_PROMPT,
+)
+
+_cache = OrderedDict()  # отпечаток диалога -> (время сохранения, ответ, токены в ответе)
+_similar = {}  # отпечаток однократного диалога -> (n-граммы вопроса, их норма)
+_lock = threading.Lock()
+_stats = {"hits": 0, "similar_hits": 0, "misses": 0}
+
+
+def normalize_text(text: str) -> str:
+    """Приводит текст к нижнему регистру, убирает знаки препинания и лишние пробелы"""
+    text = re.sub(r"[^\w\s]", " ", text.lower().replace("ё", "е"))
+    return " ".join(text.split())
+
+
+def get_fingerprint(messages: list) -> str:
+    """Функция для получения отпечатка диалога: системный промт и последние сообщения"""
+    normalized = [
+        (message["role"], normalize_text(message["text"]))
+        for message in SYSTEM_PROMPT + messages
+    ]
+    return hashlib.sha1(
+        json.dumps(normalized, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+
+
+def get_ngrams(text: str) -> Counter:
+    """Функция для получения вектора символьных n-грамм текста"""
+    text = f" {normalize_text(text)} "
+    return Counter(text[i:i + GPT_CACHE_NGRAM] for i in range(len(text) - GPT_CACHE_NGRAM + 1))
+
+
+def _get_question(messages: list) -> str | None:
+    """
+    Возвращает вопрос однократного диалога (в нём ещё нет ответов GPT),
+    только для таких диалогов ищем похожие вопросы
+    """
+    if not messages or any(message["role"] != "user" for message in messages):
+        return None
+    return messages[-1]["text"]
+
+
+def _is_fresh(item: tuple) -> bool:
+    return time.monotonic() - item[0] < GPT_CACHE_TTL
+
+
+def _forget(fingerprint: str):
+    _cache.pop(fingerprint, None)
+    _similar.pop(fingerprint, None)
+
+
+def _find_similar(question: str) -> str | None:
+    """Ищет сохранённый вопрос с косинусной близостью n-грамм не меньше GPT_CACHE_SIMILARITY"""
+    ngrams = get_ngrams(question)
+    norm = math.sqrt(sum(count * count for count in ngrams.values()))
+    if not norm:
+        return None
+    best, best_similarity = None, GPT_CACHE_SIMILARITY
+    for fingerprint, (other, other_norm) in _similar.items():
+        dot = sum(count * other.get(ngram, 0) for ngram, count in ngrams.items())
+        similarity = dot / (norm * other_norm)
+        if similarity >= best_similarity:
+            best, best_similarity = fingerprint, similarity
+    return best
+
+
+def get(messages: list) -> tuple[str, int | None] | None:
+    """
+    Функция для получения сохранённого ответа GPT на такой же диалог.
+    Возвращает ответ и токены в нём или None, если ответа в кэше нет
+    """
+    if GPT_CACHE_MODE == "off":
+        return None
+    fingerprint = get_fingerprint(messages)
+    with _lock:
+        item = _cache.get(fingerprint)
+        if item is not None and not _is_fresh(item):
+            _forget(fingerprint)
+            item = None
+        if item is None and GPT_CACHE_MODE == "similar":
+            question = _get_question(messages)
+            if question is not None:
+                similar = _find_similar(question)
+                if similar is not None and _is_fresh(_cache[similar]):
+                    _stats["similar_hits"] += 1
+                    metrics.count_cache("gpt", "similar_hit")
+                    fingerprint, item = similar, _cache[similar]
+        if item is None:
+            _stats["misses"] += 1
+            metrics.count_cache("gpt", "miss")
+            return None
+        _stats["hits"] += 1
+        metrics.count_cache("gpt", "hit")
+        _cache.move_to_end(fingerprint)
+        return item[1], item[2]
+
+
+def put(messages: list, answer: str, tokens_in_answer: int | None):
+    """Функция для сохранения ответа GPT на диалог"""
+    if GPT_CACHE_MODE == "off":
+        return
+    fingerprint = get_fingerprint(messages)
+    question = _get_question(messages) if GPT_CACHE_MODE == "similar" else None
+    with _lock:
+        _cache[fingerprint] = (time.monotonic(), answer, tokens_in_answer)
+        _cache.move_to_end(fingerprint)
+        if question is not None:
+            ngrams = get_ngrams(question)
+            norm = math.sqrt(sum(count * count for count in ngrams.values()))
+            if norm:
+                _similar[fingerprint] = (ngrams, norm)
+        while len(_cache) > GPT_CACHE_SIZE:
+            oldest, _ = _cache.popitem(last=False)
+            _similar.pop(oldest, None)
+
+
+def get_stats() -> dict:
+    """Возвращает счётчики попаданий и промахов кэша"""
+    with _lock:
+        stats = dict(_stats)
+        stats["size"] = len(_cache)
+    return stats
@@ -0,0 +1,245 @@
+import asyncio
+import json
+import time
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+import ratelimit
+
+from config import (
+    HTTP_BACKOFF_FACTOR,
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_POOL_CONNECTIONS,
+    HTTP_POOL_MAXSIZE,
+    HTTP_READ_TIMEOUT,
+    HTTP_RETRIES,
+)
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)  # Статусы, при которых повторяем запрос
+
+
+def create_session(retries: int = HTTP_RETRIES) -> requests.Session:
+    """
+    Создаёт сессию с пулом keep-alive соединений для каждого хоста
+    и повтором запросов с экспоненциальной задержкой при 429/5xx
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=HTTP_BACKOFF_FACTOR,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=None,  # повторяем и POST-запросы
+        respect_retry_after_header=True,
+        raise_on_status=False,  # после последней попытки отдаём ответ как есть
+    )
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_POOL_CONNECTIONS,
+        pool_maxsize=HTTP_POOL_MAXSIZE,
+        max_retries=retry,
+        pool_block=False,
+    )
+
+    new_session = requests.Session()
+    new_session.mount("https://", adapter)
+    new_session.mount("http://", adapter)
+    return new_session
+
+
+session = create_session()  # Общая сессия для yandex_gpt, speechkit и iam_token
+# Сессия без повторов urllib3: для запросов, тело которых читается из генератора и не может быть
+# отправлено ещё раз, и для API с ограничителем, где повторы делает request() через ограничитель
+single_session = create_session(retries=0)
+
+
+def _send(http_session: requests.Session, method: str, url: str, **kwargs) -> requests.Response:
+    """
+    Отправляет запрос и учитывает его время и код ответа в метриках.
+    При stream=True время учитывается при закрытии ответа, когда тело уже прочитано
+    """
+    started, status_code, streamed = time.perf_counter(), None, False
+    try:
+        response = http_session.request(method, url, **kwargs)
+        status_code = response.status_code
+        if kwargs.get("stream"):
+            response = StreamedResponse(response)
+            response.call_on_close(
+                lambda: metrics.observe_upstream(url, status_code, time.perf_counter() - started)
+            )
+            streamed = True
+        return response
+    finally:
+        if not streamed:
+            metrics.observe_upstream(url, status_code, time.perf_counter() - started)
+
+
+def request(method: str, url: str, retry: bool = True, **kwargs) -> requests.Response:
+    """
+    Функция для запроса через общую сессию. Запросы к API с квотами ждут
+    своей очереди в ограничителе (или выбрасывают RateLimitTimeout).
+    retry=False - не повторять запрос (тело читается из генератора).
+    При stream=True место в ограничителе занято, пока ответ не закрыт (см. StreamedResponse)
+    """
+    kwargs.setdefault("timeout", (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    limiter = ratelimit.get_limiter(url)
+    if limiter is None:
+        return _send(session if retry else single_session, method, url, **kwargs)
+
+    # повторы при 429/5xx - здесь, а не в urllib3: каждая попытка ждёт своей очереди
+    # в ограничителе, и 429 сразу снижает лимит одновременных запросов (как в async_request)
+    retries = HTTP_RETRIES if retry else 0
+    for attempt in range(retries + 1):
+        try:
+            response = _send_limited(limiter, method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == retries:
+                raise
+            retry_after = None
+        else:
+            if response.status_code not in RETRY_STATUSES or attempt == retries:
+                return response
+            retry_after = response.headers.get("Retry-After")
+            response.close()  # тело ответа с ошибкой не нужно, освобождаем соединение
+        delay = HTTP_BACKOFF_FACTOR * 2**attempt
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, int(retry_after))
+        time.sleep(delay)
+
+
+def _send_limited(limiter: ratelimit.EndpointLimiter, method: str, url: str, **kwargs) -> requests.Response:
+    """Одна попытка запроса: ждёт место в ограничителе и освобождает его по ответу"""
+    limiter.acquire()
+    status_code, streamed = None, False
+    try:
+        response = _send(single_session, method, url, **kwargs)
+        status_code = response.status_code
+        if isinstance(response, StreamedResponse) and status_code not in RETRY_STATUSES:
+            # тело ещё не прочитано, и соединение с API занято до закрытия ответа
+            response.call_on_close(lambda: limiter.release(status_code))
+            streamed = True
+        return response
+    finally:
+        if not streamed:
+            limiter.release(status_code)
+
+
+class StreamedResponse:
+    """
+    Ответ на запрос с stream=True с тем же интерфейсом, что у requests.Response.
+    Функции из call_on_close вызываются один раз при закрытии ответа (close или выход из with),
+    поэтому вызывающий код должен закрыть ответ, даже если не читал тело
+    """
+
+    def __init__(self, response: requests.Response):
+        self._response = response
+        self._on_close = []
+
+    def __getattr__(self, name: str):
+        return getattr(self._response, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def call_on_close(self, callback):
+        """Добавляет функцию, которая будет вызвана при закрытии ответа"""
+        self._on_close.append(callback)
+
+    def close(self):
+        callbacks, self._on_close = self._on_close, []
+        try:
+            self._response.close()
+        finally:
+            for callback in callbacks:
+                callback()
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    """Функция для POST-запроса через общую сессию"""
+    return request("POST", url, **kwargs)
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    """Функция для GET-запроса через общую сессию"""
+    return request("GET", url, **kwargs)
+
+
+class AsyncResponse:
+    """Прочитанный ответ асинхронного запроса с тем же интерфейсом, что у requests"""
+
+    def __init__(self, status_code: int, content: bytes):
+        self.status_code = status_code
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+
+_async_session = None
+
+
+def get_async_session() -> aiohttp.ClientSession:
+    """
+    Возвращает общую асинхронную сессию с пулом keep-alive соединений.
+    Сессия создаётся при первом вызове внутри работающего event loop
+    """
+    global _async_session
+    if _async_session is None or _async_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_CONNECTIONS * HTTP_POOL_MAXSIZE,
+            limit_per_host=HTTP_POOL_MAXSIZE,
+        )
+        timeout = aiohttp.ClientTimeout(
+            sock_connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT
+        )
+        _async_session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return _async_session
+
+
+async def async_request(
+    method: str, url: str, retries: int = HTTP_RETRIES, **kwargs
+) -> AsyncResponse:
+    """
+    Функция для асинхронного запроса через общую сессию
+    с повтором и экспоненциальной задержкой при 429/5xx.
+    Каждая попытка ждёт своей очереди в ограничителе API
+    """
+    limiter = ratelimit.get_limiter(url)
+    for attempt in range(retries + 1):
+        if limiter is not None:
+            await limiter.acquire_async()
+        status_code, started = None, time.perf_counter()
+        try:
+            async with get_async_session().request(method, url, **kwargs) as response:
+                content = await response.read()
+                status_code = response.status
+                if response.status not in RETRY_STATUSES or attempt == retries:
+                    return AsyncResponse(response.status, content)
+                retry_after = response.headers.get("Retry-After")
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if attempt == retries:
+                raise
+            retry_after = None
+        finally:
+            metrics.observe_upstream(url, status_code, time.perf_counter() - started)
+            if limiter is not None:
+                limiter.release(status_code)
+        delay = HTTP_BACKOFF_FACTOR * 2**attempt
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, int(retry_after))
+        await asyncio.sleep(delay)
+
+
+async def async_post(url: str, **kwargs) -> AsyncResponse:
+    """Функция для асинхронного POST-запроса через общую сессию"""
+    return await async_request("POST", url, **kwargs)
+
+
+async def close_async_session():
+    """Функция для закрытия асинхронной сессии при остановке бота"""
+    if _async_session is not None and not _async_session.closed:
+        await _async_session.close()
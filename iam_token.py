@@ -1,26 +1,34 @@
-from config import IAM_TOKEN_ENDPOINT, IAM_TOKEN_PATH
+from config import IAM_TOKEN_ENDPOINT, IAM_TOKEN_PATH, IAM_TOKEN_REFRESH_MARGIN
+
+import asyncio
+
+import os
+
+import tempfile
+
+import threading
 
 import time
 
-import requests
+import http_client
 
 import logging
 
 import json
 
 
-def create_new_iam_token():
+def create_new_iam_token() -> dict | None:
     """
     Получает новый IAM-TOKEN и дату истечения его срока годности и
-    записывает полученные данные в json
+    записывает полученные данные в json.
+    Возвращает данные токена или None, если получить его не удалось
     """
     headers = {"Metadata-Flavor": "Google"}
 
     try:
-        response = requests.get(IAM_TOKEN_ENDPOINT, headers=headers)
+        response = http_client.get(IAM_TOKEN_ENDPOINT, headers=headers)
 
     except Exception as e:
-        print(f"Не удалось выполнить запрос: {e}, токен не получен")
         logging.error(f"Не удалось выполнить запрос: {e}, токен не получен")
     else:
         if response.status_code == 200:
@@ -29,36 +37,129 @@ def create_new_iam_token():
                 "expires_at": response.json().get("expires_in") + time.time(),
             }
 
-            with open(IAM_TOKEN_PATH, "w") as token_file:
-                json.dump(token_data, token_file)
-                logging.info("Iam токен создан")
+            save_token_data(token_data)
+            logging.info("Iam токен создан")
+            return token_data
         else:
-            print(
-                f"Ошибка при получении ответа: {response.status_code}, токен не получен"
-            )
             logging.error(
                 f"Ошибка при получении ответа: {response.status_code}, токен не получен"
             )
+    return None
 
 
-def get_iam_token() -> str:
+def save_token_data(token_data: dict):
     """
-    Получает действующий IAM-TOKEN и возвращает его
+    Атомарно записывает данные токена в json: сначала во временный файл,
+    затем заменяет им старый
     """
+    directory = os.path.dirname(IAM_TOKEN_PATH) or "."
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as token_file:
+            json.dump(token_data, token_file)
+        os.replace(tmp_path, IAM_TOKEN_PATH)
+    except OSError as e:
+        logging.error(f"Не удалось сохранить Iam токен в файл: {e}")
+
+
+def load_token_data() -> dict | None:
+    """Читает данные токена из json, сохранённого до перезапуска"""
     try:
         with open(IAM_TOKEN_PATH, "r") as token_file:
-            token_data = json.load(token_file)
+            return json.load(token_file)
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        return None
+
+
+class IamTokenHolder:
+    """
+    Хранит IAM-TOKEN в памяти процесса и обновляет его в фоне
+    за IAM_TOKEN_REFRESH_MARGIN секунд до истечения срока годности
+    """
+
+    def __init__(self):
+        self._token_data = None
+        self._lock = threading.Lock()  # не даёт нескольким потокам обновлять токен одновременно
+        self._refresher = None
+
+    def _is_valid(self, token_data: dict | None, margin: float = 0) -> bool:
+        return bool(
+            token_data
+            and token_data.get("access_token")
+            and token_data.get("expires_at", 0) - margin > time.time()
+        )
+
+    def _refresh(self) -> dict | None:
+        """
+        Обновляет токен. Пока один поток обновляет токен, остальные ждут
+        и получают его результат вместо повторного запроса
+        """
+        with self._lock:
+            self._start_refresher()
+            if self._is_valid(self._token_data, IAM_TOKEN_REFRESH_MARGIN):
+                return self._token_data  # токен уже обновил другой поток
+
+            if self._token_data is None:
+                # После перезапуска пробуем взять токен из файла
+                token_data = load_token_data()
+                if self._is_valid(token_data, IAM_TOKEN_REFRESH_MARGIN):
+                    self._token_data = token_data
+                    return token_data
+
+            token_data = create_new_iam_token()
+            if token_data is not None:
+                self._token_data = token_data
+            elif self._is_valid(self._token_data):
+                logging.error("Не удалось обновить Iam токен, используем предыдущий")
+            return self._token_data
+
+    def _refresh_loop(self):
+        """Фоновое обновление токена до истечения его срока годности"""
+        while True:
+            token_data = self._token_data
+            if self._is_valid(token_data):
+                delay = token_data["expires_at"] - IAM_TOKEN_REFRESH_MARGIN - time.time()
+            else:
+                delay = 0
+            # После неудачной попытки повторяем не чаще раза в 10 секунд
+            time.sleep(max(delay, 10))
+            try:
+                self._refresh()
+            except Exception as e:
+                logging.error(f"Ошибка при фоновом обновлении Iam токена: {e}")
+
+    def _start_refresher(self):
+        if self._refresher is None:
+            self._refresher = threading.Thread(
+                target=self._refresh_loop, name="iam-token-refresher", daemon=True
+            )
+            self._refresher.start()
+
+    def get_token(self) -> str | None:
+        token_data = self._token_data
+        if not self._is_valid(token_data):
+            token_data = self._refresh()
+        if token_data is None:
+            return None
+        return token_data.get("access_token")
 
-        expires_at = token_data.get("expires_at")
 
-        if expires_at <= time.time():
-            create_new_iam_token()
+_holder = IamTokenHolder()
 
-    except FileNotFoundError:
-        create_new_iam_token()
 
-    with open(IAM_TOKEN_PATH, "r") as token_file:
-        token_data = json.load(token_file)
+def get_iam_token() -> str:
+    """
+    Получает действующий IAM-TOKEN и возвращает его
+    """
+    return _holder.get_token()
 
-    return token_data.get("access_token")
 
+async def get_iam_token_async() -> str:
+    """
+    Асинхронная версия get_iam_token: действующий токен отдаётся из памяти,
+    а если его нужно получить, запрос выполняется в отдельном потоке
+    """
+    token_data = _holder._token_data
+    if _holder._is_valid(token_data):
+        return token_data.get("access_token")
+    return await asyncio.to_thread(_holder.get_token)
@@ -0,0 +1,437 @@
+import json
+import random
+import re
+import struct
+import threading
+import time
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
+from wsgiref.simple_server import ServerHandler, WSGIRequestHandler, WSGIServer, make_server
+
+import ogg
+
+# Фейковые серверы для нагрузочного теста: Yandex Cloud (IAM, GPT, токенизатор, SpeechKit)
+# и Telegram Bot API (методы и скачивание файлов). Модуль не импортирует config,
+# потому что адреса серверов нужно передать в переменные окружения до его импорта
+
+FAKE_IAM_TOKEN = "loadtest-iam-token"
+PRE_SKIP = 312  # сколько отсчётов декодер пропускает в начале (как у libopus)
+PACKET_SAMPLES = 960  # 20 мс при 48 кГц
+PACKETS_PER_PAGE = 50  # одна страница OGG - одна секунда звука
+CHARS_PER_TOKEN = 4  # для ответа токенизатора
+BREAK_STREAM = "[обрыв]"  # потоковый ответ на вопрос с такой меткой обрывается после двух частей
+
+_STATUS_TEXTS = {
+    200: "200 OK",
+    206: "206 Partial Content",
+    404: "404 Not Found",
+    429: "429 Too Many Requests",
+    500: "500 Internal Server Error",
+}
+
+
+class Upstream:
+    """Поведение одного фейкового API: задержка ответа, её разброс и доля ошибок 5xx и 429"""
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        throttle_rate: float = 0.0,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+
+    def get_delay(self) -> float:
+        return max(random.gauss(self.latency, self.jitter), 0.0) if self.jitter else self.latency
+
+    def wait(self):
+        delay = self.get_delay()
+        if delay:
+            time.sleep(delay)
+
+    def get_failure(self) -> int | None:
+        """Статус ошибки, которую нужно вернуть на этот запрос, или None"""
+        chance = random.random()
+        if chance < self.error_rate:
+            return 500
+        if chance < self.error_rate + self.throttle_rate:
+            return 429
+        return None
+
+
+DEFAULT_UPSTREAMS = {
+    "iam": Upstream(0.01),
+    "tokens": Upstream(0.03, 0.01),
+    "gpt": Upstream(0.5, 0.15),
+    "tts": Upstream(0.2, 0.05),
+    "stt": Upstream(0.3, 0.1),
+    "telegram": Upstream(0.03, 0.01),
+    "telegram_file": Upstream(0.02),
+}
+
+
+class _ThreadingServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class _ChunkedHandler(ServerHandler):
+    """
+    Ответ по HTTP/1.1: ответ без Content-Length (потоковый ответ GPT) уходит частями
+    (Transfer-Encoding: chunked), как у настоящего API. По HTTP/1.0 клиент
+    с iter_lines(chunk_size=None) ждёт конца ответа и получает все части разом
+    """
+
+    http_version = "1.1"
+    chunked = False
+
+    def cleanup_headers(self):
+        super().cleanup_headers()
+        self.headers["Connection"] = "close"  # сервер обрабатывает один запрос на соединение
+        if "Content-Length" not in self.headers:
+            self.headers["Transfer-Encoding"] = "chunked"
+            self.chunked = True
+
+    def write(self, data: bytes):
+        if not self.headers_sent:
+            self.send_headers()  # заголовки решают, нужно ли делить ответ на части
+        if self.chunked:
+            if not data:
+                return  # пустая часть означала бы конец ответа
+            data = b"%x\r\n%s\r\n" % (len(data), data)
+        super().write(data)
+
+    def log_exception(self, exc_info):
+        if not isinstance(exc_info[1], ConnectionError):  # обрыв потока по BREAK_STREAM - не ошибка
+            super().log_exception(exc_info)
+
+    def finish_content(self):
+        if self.chunked:
+            self._write(b"0\r\n\r\n")
+            self._flush()
+        else:
+            super().finish_content()
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def handle(self):
+        # как WSGIRequestHandler.handle, но с _ChunkedHandler
+        self.raw_requestline = self.rfile.readline(65537)
+        if len(self.raw_requestline) > 65536 or not self.parse_request():
+            return
+        handler = _ChunkedHandler(
+            self.rfile, self.wfile, self.get_stderr(), self.get_environ(), multithread=False
+        )
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+    def log_message(self, format, *args):
+        pass
+
+
+def read_body(environ) -> bytes:
+    """Тело запроса, в том числе переданное частями (Transfer-Encoding: chunked)"""
+    stream = environ["wsgi.input"]
+    if environ.get("HTTP_TRANSFER_ENCODING", "").lower() == "chunked":
+        parts = []
+        while True:
+            size = int(stream.readline().split(b";")[0].strip(), 16)
+            if size == 0:
+                stream.readline()
+                return b"".join(parts)
+            parts.append(stream.read(size))
+            stream.readline()
+    length = int(environ.get("CONTENT_LENGTH") or 0)
+    return stream.read(length) if length else b""
+
+
+def _respond(start_response, status: int, body: bytes, content_type: str, headers=()):
+    start_response(
+        _STATUS_TEXTS.get(status, f"{status} Unknown"),
+        [("Content-Type", content_type), ("Content-Length", str(len(body))), *headers],
+    )
+    return [body]
+
+
+def _respond_json(start_response, data, status: int = 200):
+    body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+    return _respond(start_response, status, body, "application/json")
+
+
+def make_voice(seconds: int, seed: int = 0) -> bytes:
+    """
+    Функция для создания OGG/Opus заданной длительности: заголовки и страницы по секунде
+    с пакетами случайного размера. Декодировать такой звук нельзя, но разбор страниц,
+    проверка длительности и разрезание длинных ГС работают как с настоящим
+    """
+    rng = random.Random(seed)
+    serial = 0x10ADBEEF
+    head = struct.pack("<8sBBHIhB", b"OpusHead", 1, 1, PRE_SKIP, 48000, 0, 0)
+    vendor = b"loadtest"
+    tags = b"OpusTags" + struct.pack("<I", len(vendor)) + vendor + struct.pack("<I", 0)
+    pages = [
+        ogg.Page(0x02, 0, serial, 0, bytes([len(head)]), head),
+        ogg.Page(0, 0, serial, 1, bytes([len(tags)]), tags),
+    ]
+    granule = PRE_SKIP
+    for second in range(max(seconds, 1)):
+        packets = [bytes(rng.randint(10, 120)) for _ in range(PACKETS_PER_PAGE)]
+        granule += PACKET_SAMPLES * len(packets)
+        flags = ogg.LAST_PAGE if second == max(seconds, 1) - 1 else 0
+        table = bytes(len(packet) for packet in packets)
+        pages.append(ogg.Page(flags, granule, serial, second + 2, table, b"".join(packets)))
+    return b"".join(page.to_bytes() for page in pages)
+
+
+class FakeYandex:
+    """WSGI-приложение с API Yandex Cloud: IAM, completion, tokenizeCompletion, tts и stt"""
+
+    def __init__(self, upstreams: dict):
+        self.upstreams = upstreams
+        self._voices = {}
+        self._voices_lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        path = environ.get("PATH_INFO", "")
+        for suffix, name, handler in (
+            ("/token", "iam", self._iam),
+            ("/tokenizeCompletion", "tokens", self._tokens),
+            ("/completion", "gpt", self._completion),
+            ("/tts:synthesize", "tts", self._tts),
+            ("/stt:recognize", "stt", self._stt),
+        ):
+            if path.endswith(suffix):
+                upstream = self.upstreams[name]
+                body = read_body(environ)
+                failure = upstream.get_failure()
+                if failure:
+                    upstream.wait()
+                    return _respond_json(start_response, {"error": "fake failure"}, failure)
+                return handler(upstream, body, start_response)
+        return _respond_json(start_response, {"error": "not found"}, 404)
+
+    def _iam(self, upstream, body, start_response):
+        upstream.wait()
+        return _respond_json(start_response, {"access_token": FAKE_IAM_TOKEN, "expires_in": 3600})
+
+    def _tokens(self, upstream, body, start_response):
+        upstream.wait()
+        messages = json.loads(body).get("messages", [])
+        count = max(sum(len(message.get("text", "")) for message in messages) // CHARS_PER_TOKEN, 1)
+        return _respond_json(start_response, {"tokens": [{"id": "0", "text": ""}] * count})
+
+    def _completion(self, upstream, body, start_response):
+        request = json.loads(body)
+        messages = request.get("messages", [])
+        question = messages[-1].get("text", "") if messages else ""
+        answer = f"Ответ на «{question[:80]}». Это тестовый ответ фейкового сервера GPT."
+        tokens = max(len(answer) // CHARS_PER_TOKEN, 1)
+
+        def result(text: str, final: bool) -> dict:
+            return {
+                "result": {
+                    "alternatives": [{
+                        "message": {"role": "assistant", "text": text},
+                        "status": "ALTERNATIVE_STATUS_FINAL" if final else "ALTERNATIVE_STATUS_PARTIAL",
+                    }],
+                    "usage": {
+                        "inputTextTokens": str(len(question) // CHARS_PER_TOKEN),
+                        "completionTokens": str(tokens),
+                        "totalTokens": str(tokens + len(question) // CHARS_PER_TOKEN),
+                    },
+                    "modelVersion": "loadtest",
+                }
+            }
+
+        if not request.get("completionOptions", {}).get("stream"):
+            upstream.wait()
+            return _respond_json(start_response, result(answer, True))
+
+        # потоковый ответ: строки JSON с полным текстом на данный момент, задержка делится на части
+        words = answer.split(" ")
+        steps = [" ".join(words[:count]) for count in range(4, len(words), 4)] + [answer]
+        delay = upstream.get_delay()
+        start_response("200 OK", [("Content-Type", "application/json")])
+
+        def stream():
+            for number, text in enumerate(steps):
+                time.sleep(delay / len(steps))
+                if number == 2 and BREAK_STREAM in question:
+                    raise ConnectionError("фейковый GPT оборвал поток")
+                line = json.dumps(result(text, number == len(steps) - 1), ensure_ascii=False)
+                yield line.encode("utf-8") + b"\n"
+
+        return stream()
+
+    def _tts(self, upstream, body, start_response):
+        upstream.wait()
+        text = parse_qs(body.decode("utf-8")).get("text", [""])[0]
+        seconds = max(len(text) // 15, 1)  # примерно 15 символов речи в секунду
+        with self._voices_lock:
+            voice = self._voices.get(seconds)
+            if voice is None:
+                voice = self._voices[seconds] = make_voice(seconds, seconds)
+        return _respond(start_response, 200, voice, "audio/ogg")
+
+    def _stt(self, upstream, body, start_response):
+        upstream.wait()
+        granule = ogg.find_last_granule(body)
+        seconds = ogg.get_duration(granule, ogg.find_pre_skip(body) or 0) if granule else 0
+        return _respond_json(start_response, {"result": f"распознанный текст ({seconds:.0f} с, {len(body)} байт)"})
+
+
+class FakeTelegram:
+    """
+    WSGI-приложение с Telegram Bot API: отвечает на методы бота правдоподобными объектами
+    и отдаёт файлы ГС (с поддержкой Range). file_id ГС имеет вид voice-<секунды>-<номер>
+    """
+
+    def __init__(self, upstreams: dict):
+        self.upstreams = upstreams
+        self._message_id = 0
+        self._lock = threading.Lock()
+        self._voices = {}
+        self.calls = {}  # метод -> кол-во вызовов
+
+    def __call__(self, environ, start_response):
+        path = environ.get("PATH_INFO", "")
+        body = read_body(environ)
+        if path.startswith("/file/"):
+            return self._file(environ, path, start_response)
+        match = re.match(r"^/bot[^/]+/(\w+)$", path)
+        if not match:
+            return _respond_json(start_response, {"ok": False, "description": "Not Found"}, 404)
+
+        method = match.group(1)
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        upstream = self.upstreams["telegram"]
+        failure = upstream.get_failure()
+        upstream.wait()
+        if failure:
+            return _respond_json(
+                start_response,
+                {"ok": False, "error_code": failure, "description": "fake failure"},
+                failure,
+            )
+        params = self._parse_params(environ, body)
+        return _respond_json(start_response, {"ok": True, "result": self._result(method, params)})
+
+    def _parse_params(self, environ, body: bytes) -> dict:
+        params = {key: values[0] for key, values in parse_qs(environ.get("QUERY_STRING", "")).items()}
+        content_type = environ.get("CONTENT_TYPE", "")
+        if content_type.startswith("multipart/form-data"):
+            for name, value in re.findall(rb'name="(\w+)"\r\n\r\n(.*?)\r\n--', body, re.S):
+                params[name.decode()] = value.decode("utf-8", "replace")
+        elif body:
+            try:
+                params.update(json.loads(body))
+            except ValueError:
+                params.update({key: values[0] for key, values in parse_qs(body.decode("utf-8")).items()})
+        return params
+
+    def _next_message_id(self) -> int:
+        with self._lock:
+            self._message_id += 1
+            return self._message_id
+
+    def _result(self, method: str, params: dict):
+        chat_id = int(params.get("chat_id") or 0)
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "loadtest", "username": "loadtest_bot"}
+        if method == "getFile":
+            file_id = params.get("file_id", "voice-1-0")
+            _, seconds, number = file_id.split("-", 2)
+            return {
+                "file_id": file_id,
+                "file_unique_id": file_id,
+                "file_size": 0,
+                "file_path": f"voice/{seconds}/{number}.oga",
+            }
+        if method in ("sendMessage", "editMessageText", "sendVoice", "sendDocument"):
+            message = {
+                "message_id": int(params.get("message_id") or self._next_message_id()),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": 1, "is_bot": True, "first_name": "loadtest"},
+            }
+            if method == "sendVoice":
+                voice_id = f"sent-{message['message_id']}"
+                message["voice"] = {"file_id": voice_id, "file_unique_id": voice_id, "duration": 1}
+            else:
+                message["text"] = params.get("text", "")
+            return message
+        return True  # sendChatAction, deleteWebhook, setWebhook и т.п.
+
+    def _file(self, environ, path: str, start_response):
+        upstream = self.upstreams["telegram_file"]
+        upstream.wait()
+        match = re.match(r"^/file/bot[^/]+/voice/(\d+)/(\d+)\.oga$", path)
+        if not match:
+            return _respond(start_response, 404, b"", "text/plain")
+        seconds, number = int(match.group(1)), int(match.group(2))
+        with self._lock:
+            voice = self._voices.get(seconds)
+            if voice is None:
+                voice = self._voices[seconds] = make_voice(seconds, number)
+
+        byte_range = re.match(r"bytes=(\d*)-(\d*)$", environ.get("HTTP_RANGE", ""))
+        if not byte_range:
+            return _respond(start_response, 200, voice, "audio/ogg")
+        first, last = byte_range.groups()
+        if first:
+            start, end = int(first), int(last) + 1 if last else len(voice)
+        else:
+            start, end = max(len(voice) - int(last), 0), len(voice)
+        return _respond(
+            start_response,
+            206,
+            voice[start:end],
+            "audio/ogg",
+            [("Content-Range", f"bytes {start}-{end - 1}/{len(voice)}")],
+        )
+
+
+class FakeServers:
+    """Запускает фейковые Yandex Cloud и Telegram на свободных портах в фоновых потоках"""
+
+    def __init__(self, upstreams: dict | None = None, host: str = "127.0.0.1"):
+        self.upstreams = dict(DEFAULT_UPSTREAMS, **(upstreams or {}))
+        self.yandex = FakeYandex(self.upstreams)
+        self.telegram = FakeTelegram(self.upstreams)
+        self._servers = [
+            make_server(host, 0, app, server_class=_ThreadingServer, handler_class=_QuietHandler)
+            for app in (self.yandex, self.telegram)
+        ]
+        for server in self._servers:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    @property
+    def yandex_url(self) -> str:
+        host, port = self._servers[0].server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def telegram_url(self) -> str:
+        host, port = self._servers[1].server_address[:2]
+        return f"http://{host}:{port}"
+
+    def get_env(self) -> dict:
+        """Переменные окружения, которые направляют бота на фейковые серверы"""
+        return {
+            "iam_token_endpoint": f"{self.yandex_url}/computeMetadata/v1/instance/service-accounts/default/token",
+            "url_tokens": f"{self.yandex_url}/foundationModels/v1/tokenizeCompletion",
+            "url_gpt": f"{self.yandex_url}/foundationModels/v1/completion",
+            "url_speechkit_voice": f"{self.yandex_url}/speech/v1/tts:synthesize",
+            "url_speechkit_text": f"{self.yandex_url}/speech/v1/stt:recognize?",
+            "telegram_api_url": self.telegram_url,
+        }
+
+    def close(self):
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
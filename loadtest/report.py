@@ -0,0 +1,119 @@
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Функция для вычисления перцентиля (метод ближайшего ранга) по отсортированному списку"""
+    if not values:
+        return 0.0
+    rank = max(math.ceil(q / 100 * len(values)), 1)
+    return values[rank - 1]
+
+
+class Recorder:
+    """Потокобезопасный сборщик длительностей по именам (обработчик, API, этап)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._durations = {}
+        self._errors = {}
+
+    def record(self, name: str, seconds: float, error: bool = False):
+        with self._lock:
+            self._durations.setdefault(name, []).append(seconds)
+            if error:
+                self._errors[name] = self._errors.get(name, 0) + 1
+
+    @contextmanager
+    def timer(self, name: str):
+        started = time.perf_counter()
+        error = False
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self.record(name, time.perf_counter() - started, error)
+
+    def summary(self) -> dict:
+        """Кол-во, ошибки, среднее, p50/p95/p99 и максимум в миллисекундах для каждого имени"""
+        with self._lock:
+            durations = {name: sorted(values) for name, values in self._durations.items()}
+            errors = dict(self._errors)
+        result = {}
+        for name, values in sorted(durations.items()):
+            stats = {
+                "count": len(values),
+                "errors": errors.get(name, 0),
+                "mean_ms": sum(values) / len(values) * 1000,
+                "max_ms": values[-1] * 1000,
+            }
+            for q in PERCENTILES:
+                stats[f"p{q}_ms"] = percentile(values, q) * 1000
+            result[name] = stats
+        return result
+
+
+def format_table(title: str, summary: dict) -> str:
+    """Функция для вывода сводки одной группы в виде таблицы"""
+    lines = [title, f"  {'имя':<36}{'кол-во':>8}{'ошибки':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'макс':>9}"]
+    for name, stats in summary.items():
+        lines.append(
+            f"  {name:<36}{stats['count']:>8}{stats['errors']:>8}"
+            f"{stats['p50_ms']:>9.1f}{stats['p95_ms']:>9.1f}{stats['p99_ms']:>9.1f}{stats['max_ms']:>9.1f}"
+        )
+    return "\n".join(lines)
+
+
+def format_report(results: dict) -> str:
+    """Функция для вывода результатов прогона: пропускная способность и задержки по группам (мс)"""
+    lines = [
+        f"Обновлений обработано: {results['completed']} из {results['sent']}"
+        f" за {results['elapsed']:.2f} с, {results['throughput']:.1f} в секунду",
+    ]
+    for group in results["groups"]:
+        if results[group]:
+            lines.append(format_table(group, results[group]))
+    return "\n".join(lines)
+
+
+def _change(old: float, new: float) -> str:
+    if not old:
+        return "-"
+    return f"{(new - old) / old * 100:+.0f}%"
+
+
+def format_comparison(baseline: dict, results: dict) -> str:
+    """Функция для сравнения прогона с базовым: пропускная способность и p50/p95/p99 по всем именам"""
+    lines = [
+        f"Пропускная способность: {baseline['throughput']:.1f} -> {results['throughput']:.1f} в секунду"
+        f" ({_change(baseline['throughput'], results['throughput'])})",
+        f"  {'имя':<36}{'p50':>20}{'p95':>20}{'p99':>20}",
+    ]
+    for group in results["groups"]:
+        for name, stats in results[group].items():
+            old = baseline.get(group, {}).get(name)
+            if old is None:
+                continue
+            cells = [
+                f"{old[key]:.0f}->{stats[key]:.0f} {_change(old[key], stats[key]):>5}"
+                for key in ("p50_ms", "p95_ms", "p99_ms")
+            ]
+            lines.append(f"  {group + ':' + name:<36}" + "".join(f"{cell:>20}" for cell in cells))
+    return "\n".join(lines)
+
+
+def save(results: dict, path: str):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+def load(path: str) -> dict:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
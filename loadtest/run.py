@@ -0,0 +1,400 @@
+import argparse
+import ast
+import asyncio
+import functools
+import importlib
+import inspect
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from loadtest import report
+from loadtest.fake_servers import DEFAULT_UPSTREAMS, FakeServers, Upstream
+
+# Нагрузочный тест бота целиком: обработчики bot.py (или async_bot.py) получают поток
+# обновлений, а Telegram и Yandex Cloud заменены фейковыми серверами с заданными
+# задержками и долей ошибок. Пример:
+#   python -m loadtest.run --users 50 --messages 10 --voice-ratio 0.2 --output new.json
+#   python -m loadtest.run --mode async --baseline new.json
+#   python -m loadtest.run --latency gpt=1500 --errors gpt=0.05 --set GPT_STREAM=False
+
+# Функции модуля бота, время которых замеряется отдельно (если они есть в модуле)
+STAGES = (
+    "check_number_of_users",
+    "is_gpt_token_limit",
+    "is_gpt_token_limit_async",
+    "is_tts_symbol_limit",
+    "is_stt_block_limit",
+    "ask_gpt",
+    "answer_with_gpt",
+    "recognize_voice",
+    "synthesize",
+)
+GROUPS = ("updates", "handlers", "stages", "upstream", "telegram")
+
+
+def parse_pairs(pairs: list[str], convert) -> dict:
+    """Функция для разбора аргументов вида имя=значение"""
+    result = {}
+    for pair in pairs:
+        name, _, value = pair.partition("=")
+        result[name] = convert(value)
+    return result
+
+
+def create_upstreams(args) -> dict:
+    """Функция для настройки фейковых API по аргументам --latency, --jitter, --errors, --throttle"""
+    latency = parse_pairs(args.latency, lambda value: float(value) / 1000)
+    jitter = parse_pairs(args.jitter, lambda value: float(value) / 1000)
+    errors = parse_pairs(args.errors, float)
+    throttle = parse_pairs(args.throttle, float)
+    upstreams = {}
+    for name, default in DEFAULT_UPSTREAMS.items():
+        upstreams[name] = Upstream(
+            latency.get(name, default.latency),
+            jitter.get(name, default.jitter),
+            errors.get(name, default.error_rate),
+            throttle.get(name, default.throttle_rate),
+        )
+    return upstreams
+
+
+def make_message(user_id: int, message_id: int, **content) -> dict:
+    user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+    return {
+        "message_id": message_id,
+        "from": user,
+        "chat": {"id": user_id, "type": "private", "first_name": user["first_name"]},
+        "date": int(time.time()),
+        **content,
+    }
+
+
+def make_start_updates(user_ids: list[int]) -> list[dict]:
+    """Функция для создания команд /start, которыми пользователи регистрируются перед прогоном"""
+    return [
+        {"update_id": number + 1, "message": make_message(user_id, 1, text="/start",
+                                                          entities=[{"type": "bot_command", "offset": 0, "length": 6}])}
+        for number, user_id in enumerate(user_ids)
+    ]
+
+
+def generate_updates(args, first_update_id: int) -> list[dict]:
+    """
+    Функция для создания потока сообщений: по args.messages от каждого из args.users пользователей,
+    доля args.voice_ratio - ГС длительностью от 1 до args.voice_seconds секунд.
+    Тексты не повторяются, чтобы не попадать в кэши GPT и SpeechKit
+    """
+    rng = random.Random(args.seed)
+    updates = []
+    for number in range(args.messages):
+        for user_id in range(1, args.users + 1):
+            message_id = number + 2  # 1 - это /start
+            if rng.random() < args.voice_ratio:
+                seconds = rng.randint(1, args.voice_seconds)
+                file_id = f"voice-{seconds}-{len(updates)}"
+                content = {"voice": {
+                    "file_id": file_id,
+                    "file_unique_id": file_id,
+                    "duration": seconds,
+                    "mime_type": "audio/ogg",
+                }}
+            else:
+                content = {"text": f"Вопрос {number} от пользователя {user_id}: {rng.random():.6f}"}
+            updates.append({
+                "update_id": first_update_id + len(updates),
+                "message": make_message(user_id, message_id, **content),
+            })
+    return updates
+
+
+def adapt_recorded(updates: list[dict]) -> list[dict]:
+    """
+    Функция для подготовки записанных обновлений (WEBHOOK_RECORD_PATH): file_id ГС
+    заменяются на такие, по которым фейковый Telegram отдаст файл той же длительности
+    """
+    for number, update in enumerate(updates):
+        voice = (update.get("message") or {}).get("voice")
+        if voice:
+            voice["file_id"] = f"voice-{max(voice.get('duration', 1), 1)}-{number}"
+    return updates
+
+
+def get_kind(message) -> str:
+    if message.content_type == "voice":
+        return "voice"
+    if message.content_type == "text" and message.text.startswith("/"):
+        return "command"
+    return message.content_type
+
+
+class LoadTest:
+    """Прогон: замеры обработчиков, этапов и внешних запросов, учёт завершённых обновлений"""
+
+    def __init__(self, bot_module, upstream_urls: dict):
+        self.bot_module = bot_module
+        self.bot = bot_module.bot
+        self.upstream_urls = upstream_urls
+        self.groups = {group: report.Recorder() for group in GROUPS}
+        self._submitted = {}  # (chat_id, message_id) -> (время отправки, вид)
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._expected = 0
+        self.completed = 0
+
+    def reset(self, expected: int):
+        """Начинает новый этап прогона: обнуляет замеры и ждёт expected обновлений"""
+        self.groups = {group: report.Recorder() for group in GROUPS}
+        with self._lock:
+            self._submitted.clear()
+            self._expected = expected
+            self.completed = 0
+            self._done.clear()
+
+    def submitted(self, message):
+        with self._lock:
+            self._submitted[(message.chat.id, message.message_id)] = (time.perf_counter(), get_kind(message))
+
+    def _finished(self, message):
+        with self._lock:
+            started = self._submitted.pop((message.chat.id, message.message_id), None)
+            if started is None:
+                return
+            self.completed += 1
+            if self.completed >= self._expected:
+                self._done.set()
+        started_at, kind = started
+        self.groups["updates"].record(kind, time.perf_counter() - started_at)
+
+    def wait(self, timeout: float) -> bool:
+        return self._done.wait(timeout)
+
+    def _wrap(self, function, group: str, name: str, on_finish=None):
+        """Обёртка с замером времени для обычной и для асинхронной функции"""
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                try:
+                    with self.groups[group].timer(name):
+                        return await function(*args, **kwargs)
+                finally:
+                    if on_finish:
+                        on_finish(*args)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            try:
+                with self.groups[group].timer(name):
+                    return function(*args, **kwargs)
+            finally:
+                if on_finish:
+                    on_finish(*args)
+        return wrapper
+
+    def _get_upstream_name(self, url: str) -> str:
+        for prefix, name in self.upstream_urls.items():
+            if url.startswith(prefix):
+                return name
+        return "other"
+
+    def instrument(self):
+        """Встраивает замеры в обработчики, этапы, запросы к Yandex Cloud и к Telegram"""
+        for handler in self.bot.message_handlers:
+            function = handler["function"]
+            handler["function"] = self._wrap(
+                function, "handlers", function.__name__, on_finish=self._finished
+            )
+        for name in STAGES:
+            function = getattr(self.bot_module, name, None)
+            if function is not None:
+                setattr(self.bot_module, name, self._wrap(function, "stages", name))
+
+        import http_client
+        from telebot import apihelper, asyncio_helper
+
+        request, async_request = http_client.request, http_client.async_request
+
+        def timed_request(method, url, *args, **kwargs):
+            name, started = self._get_upstream_name(url), time.perf_counter()
+            try:
+                response = request(method, url, *args, **kwargs)
+            except BaseException:
+                self.groups["upstream"].record(name, time.perf_counter() - started, True)
+                raise
+            if isinstance(response, http_client.StreamedResponse):
+                # тело потокового ответа читается после возврата, время считаем до его закрытия
+                response.call_on_close(
+                    lambda: self.groups["upstream"].record(name, time.perf_counter() - started, False)
+                )
+            else:
+                self.groups["upstream"].record(name, time.perf_counter() - started, False)
+            return response
+
+        async def timed_async_request(method, url, *args, **kwargs):
+            with self.groups["upstream"].timer(self._get_upstream_name(url)):
+                return await async_request(method, url, *args, **kwargs)
+
+        http_client.request, http_client.async_request = timed_request, timed_async_request
+
+        make_request, process_request = apihelper._make_request, asyncio_helper._process_request
+
+        def timed_make_request(token, method_name, *args, **kwargs):
+            with self.groups["telegram"].timer(method_name):
+                return make_request(token, method_name, *args, **kwargs)
+
+        async def timed_process_request(token, url, *args, **kwargs):
+            with self.groups["telegram"].timer(url):
+                return await process_request(token, url, *args, **kwargs)
+
+        apihelper._make_request, asyncio_helper._process_request = timed_make_request, timed_process_request
+
+    def results(self, sent: int, elapsed: float) -> dict:
+        results = {
+            "sent": sent,
+            "completed": self.completed,
+            "elapsed": elapsed,
+            "throughput": self.completed / elapsed if elapsed else 0.0,
+            "groups": list(GROUPS),
+        }
+        for group, recorder in self.groups.items():
+            results[group] = recorder.summary()
+        return results
+
+
+def feed_sync(test: LoadTest, updates: list, rate: float):
+    """Отправляет обновления синхронному боту с заданной частотой (0 - как можно быстрее)"""
+    started = time.perf_counter()
+    for number, update in enumerate(updates):
+        if rate:
+            delay = started + number / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        test.submitted(update.message)
+        test.bot.process_new_updates([update])
+
+
+async def feed_async(test: LoadTest, updates: list, rate: float):
+    """Отправляет обновления асинхронному боту с заданной частотой (0 - как можно быстрее)"""
+    started = time.perf_counter()
+    tasks = []
+    for number, update in enumerate(updates):
+        if rate:
+            delay = started + number / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        test.submitted(update.message)
+        tasks.append(asyncio.create_task(test.bot.process_new_updates([update])))
+    await asyncio.gather(*tasks)
+
+
+def run_phase(test: LoadTest, updates: list, args) -> dict:
+    """Прогоняет обновления и возвращает результаты этапа"""
+    test.reset(len(updates))
+    started = time.perf_counter()
+    if args.mode == "async":
+        test.loop.run_until_complete(feed_async(test, updates, args.rate))
+    else:
+        feed_sync(test, updates, args.rate)
+    if not test.wait(args.timeout):
+        print(f"Не дождались {len(updates) - test.completed} обновлений за {args.timeout} с", file=sys.stderr)
+    return test.results(len(updates), time.perf_counter() - started)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота с фейковыми Telegram и Yandex Cloud")
+    parser.add_argument("--mode", choices=("sync", "async"), default="sync", help="bot.py или async_bot.py")
+    parser.add_argument("--users", type=int, default=20, help="кол-во пользователей")
+    parser.add_argument("--messages", type=int, default=5, help="сообщений от каждого пользователя")
+    parser.add_argument("--voice-ratio", type=float, default=0.2, help="доля ГС среди сообщений")
+    parser.add_argument("--voice-seconds", type=int, default=20, help="максимальная длительность ГС")
+    parser.add_argument("--updates", help="записанные обновления (JSONL) вместо созданных")
+    parser.add_argument("--rate", type=float, default=0.0, help="обновлений в секунду, 0 - как можно быстрее")
+    parser.add_argument("--timeout", type=float, default=300.0, help="сколько ждать обработки, секунды")
+    parser.add_argument("--storage", default="memory", help="хранилище: memory, sqlite или postgres")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--latency", action="append", default=[], metavar="API=МС",
+                        help="задержка фейкового API: iam, tokens, gpt, tts, stt, telegram, telegram_file")
+    parser.add_argument("--jitter", action="append", default=[], metavar="API=МС", help="разброс задержки")
+    parser.add_argument("--errors", action="append", default=[], metavar="API=ДОЛЯ", help="доля ответов 500")
+    parser.add_argument("--throttle", action="append", default=[], metavar="API=ДОЛЯ", help="доля ответов 429")
+    parser.add_argument("--set", action="append", default=[], metavar="ИМЯ=ЗНАЧЕНИЕ",
+                        help="переопределить настройку config.py (значение - литерал Python)")
+    parser.add_argument("--output", help="сохранить результаты в JSON")
+    parser.add_argument("--baseline", help="сравнить с результатами прошлого прогона (JSON)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    servers = FakeServers(create_upstreams(args))
+    home_dir = tempfile.TemporaryDirectory(prefix="loadtest-")
+
+    # окружение задаётся до импорта config: бот ходит только на фейковые серверы
+    os.environ.update(servers.get_env())
+    os.environ.update({
+        "token": "123456:LOADTEST",
+        "folder_id": "loadtest",
+        "home_dir": home_dir.name,
+        "storage_backend": args.storage,
+    })
+    import config
+
+    config.MAX_USERS = args.users + 1
+    for name, value in parse_pairs(args.set, ast.literal_eval).items():
+        setattr(config, name, value)
+
+    bot_module = importlib.import_module("async_bot" if args.mode == "async" else "bot")
+    import db
+
+    db.create_table()
+    test = LoadTest(bot_module, {
+        config.URL_GPT: "gpt",
+        config.URL_TOKENS: "tokens",
+        config.URL_SPEECHKIT_VOICE: "tts",
+        config.URL_SPEECHKIT_TEXT: "stt",
+        config.IAM_TOKEN_ENDPOINT: "iam",
+        servers.telegram_url: "telegram_file",
+    })
+    test.instrument()
+    if args.mode == "async":
+        test.loop = asyncio.new_event_loop()
+
+    from telebot.types import Update
+
+    if args.updates:
+        from replay_updates import load_updates
+
+        raw_updates = adapt_recorded(load_updates(args.updates))
+    else:
+        raw_updates = generate_updates(args, first_update_id=1000)
+    user_ids = sorted({update["message"]["from"]["id"] for update in raw_updates if "message" in update})
+
+    # регистрация пользователей (/start) - отдельный этап, в результаты не входит
+    run_phase(test, [Update.de_json(update) for update in make_start_updates(user_ids)], args)
+
+    updates = [Update.de_json(update) for update in raw_updates if "message" in update]
+    results = run_phase(test, updates, args)
+    results["args"] = vars(args)
+    results["fake_telegram_calls"] = dict(servers.telegram.calls)
+
+    print(report.format_report(results))
+    if args.baseline:
+        print()
+        print(report.format_comparison(report.load(args.baseline), results))
+    if args.output:
+        report.save(results, args.output)
+
+    if args.mode == "async":
+        import http_client
+
+        test.loop.run_until_complete(http_client.close_async_session())
+    servers.close()
+    return results
+
+
+if __name__ == "__main__":
+    main()
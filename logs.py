@@ -0,0 +1,249 @@
+import atexit
+import contextvars
+import copy
+import functools
+import glob
+import inspect
+import io
+import json
+import logging
+import os
+import queue
+import random
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+
+import telebot
+
+from config import (
+    LOG_BACKUP_COUNT,
+    LOG_DEBUG_SAMPLE_RATE,
+    LOG_LEVEL,
+    LOG_MAX_BYTES,
+    LOG_ROTATION,
+    LOG_ROTATION_WHEN,
+    LOG_TAIL_BYTES,
+    LOGS_PATH,
+)
+
+# Логирование всего бота. Обработчики только кладут запись в очередь (QueueHandler),
+# а в файл её пишет отдельный поток (QueueListener), поэтому запись на диск их не задерживает.
+# Файл - JSON по строке на запись, с ротацией по размеру или по времени.
+# В каждую запись добавляются user_id и request_id сообщения, которое сейчас обрабатывается
+
+user_id_var = contextvars.ContextVar("user_id", default=None)
+request_id_var = contextvars.ContextVar("request_id", default=None)
+
+_listener = None
+log_path = LOGS_PATH  # файл логов этого процесса (см. setup)
+
+
+class ContextFilter(logging.Filter):
+    """
+    Добавляет в запись user_id и request_id текущего сообщения и прореживает DEBUG:
+    проходит только доля LOG_DEBUG_SAMPLE_RATE таких записей.
+    Стоит на QueueHandler и вызывается в потоке обработчика, поэтому видит его контекст
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno <= logging.DEBUG and random.random() >= LOG_DEBUG_SAMPLE_RATE:
+            return False
+        record.user_id = user_id_var.get()
+        record.request_id = request_id_var.get()
+        return True
+
+
+class StructuredQueueHandler(QueueHandler):
+    """
+    QueueHandler, который оставляет трассировку исключения отдельным полем,
+    а не дописывает её к тексту сообщения
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """Форматирует запись как одну строку JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created))
+            + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "file": record.filename,
+            "func": record.funcName,
+            "message": record.getMessage(),
+        }
+        for key in ("user_id", "request_id"):
+            value = getattr(record, key, None)
+            if value is not None:
+                data[key] = value
+        if record.exc_text:
+            data["exc"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False)
+
+
+def get_path(process_name: str | None = None) -> str:
+    """Функция для получения пути к файлу логов процесса: log_file.txt -> log_file.<process_name>.txt"""
+    if not process_name:
+        return LOGS_PATH
+    root, ext = os.path.splitext(LOGS_PATH)
+    return f"{root}.{process_name}{ext}"
+
+
+def create_file_handler(path: str) -> logging.Handler:
+    """Функция для создания обработчика, который пишет в файл с ротацией (LOG_ROTATION)"""
+    if LOG_ROTATION == "time":
+        handler = TimedRotatingFileHandler(
+            path, when=LOG_ROTATION_WHEN, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
+        )
+    else:
+        handler = RotatingFileHandler(
+            path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
+        )
+    handler.setFormatter(JsonFormatter())
+    return handler
+
+
+def setup(process_name: str | None = None):
+    """
+    Функция для настройки логирования процесса. Повторный вызов ничего не делает.
+    process_name - для процессов-обработчиков: у каждого свой файл, потому что
+    ротировать один файл из нескольких процессов нельзя
+    """
+    global _listener, log_path
+    if _listener is not None:
+        return
+    log_path = get_path(process_name)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = StructuredQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+
+    # у telebot свой обработчик, который пишет в stderr прямо из потока бота - пусть пишет через очередь
+    telebot.logger.handlers.clear()
+    telebot.logger.setLevel(LOG_LEVEL)
+
+    _listener = QueueListener(log_queue, create_file_handler(log_path))
+    _listener.start()
+    atexit.register(stop)
+
+
+def stop():
+    """Функция для записи оставшихся в очереди записей и остановки потока логирования"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def _bind(message):
+    return (
+        user_id_var.set(message.from_user.id if message.from_user else None),
+        request_id_var.set(f"{message.chat.id}:{message.message_id}"),
+    )
+
+
+def _unbind(tokens: tuple):
+    user_id_var.reset(tokens[0])
+    request_id_var.reset(tokens[1])
+
+
+def with_message_context(function):
+    """Декоратор для обработчика: пока он работает, записи лога помечены user_id и id сообщения"""
+    if inspect.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def async_wrapper(message, *args, **kwargs):
+            tokens = _bind(message)
+            try:
+                return await function(message, *args, **kwargs)
+            finally:
+                _unbind(tokens)
+        return async_wrapper
+
+    @functools.wraps(function)
+    def wrapper(message, *args, **kwargs):
+        tokens = _bind(message)
+        try:
+            return function(message, *args, **kwargs)
+        finally:
+            _unbind(tokens)
+    return wrapper
+
+
+def bind_handlers(bot):
+    """Функция для добавления контекста сообщения во все уже зарегистрированные обработчики бота"""
+    for handler in bot.message_handlers:
+        handler["function"] = with_message_context(handler["function"])
+
+
+def get_process_paths() -> dict[str, str]:
+    """
+    Функция для получения файлов логов всех процессов на этой машине (см. setup):
+    имя процесса ("main", "shard0", "worker1", ...) -> путь
+    """
+    root, ext = os.path.splitext(LOGS_PATH)
+    paths = {"main": LOGS_PATH} if os.path.exists(LOGS_PATH) else {}
+    for path in sorted(glob.glob(f"{glob.escape(root)}.*{glob.escape(ext)}")):
+        paths[path[len(root) + 1:len(path) - len(ext)]] = path
+    return paths
+
+
+def read_tail(max_bytes: int = LOG_TAIL_BYTES, path: str | None = None) -> bytes:
+    """Функция для чтения последних max_bytes байт лога path (по умолчанию - этого процесса) целыми строками"""
+    with open(path or log_path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(size - max_bytes, 0))
+        data = f.read()
+    if size > max_bytes:
+        data = data.partition(b"\n")[2]  # первая строка обрезана
+    return data
+
+
+def read_all_tails(max_bytes: int = LOG_TAIL_BYTES) -> bytes:
+    """
+    Функция для чтения последних записей логов всех процессов (SHARDS, WEBHOOK_PROCESSES):
+    записи идут по времени, в поле process - имя процесса, всего не больше max_bytes
+    """
+    records = []
+    for process, path in get_process_paths().items():
+        for line in read_tail(max_bytes, path).splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            record["process"] = process
+            records.append((record.get("time", ""), json.dumps(record, ensure_ascii=False).encode("utf-8")))
+    if not records:
+        raise FileNotFoundError(f"Нет логов {LOGS_PATH}")
+    records.sort(key=lambda item: item[0])
+
+    lines, size = [], 0
+    for _, line in reversed(records):
+        size += len(line) + 1
+        if size > max_bytes:
+            break
+        lines.append(line)
+    return b"".join(line + b"\n" for line in reversed(lines))
+
+
+def get_tail_file() -> io.BytesIO:
+    """Функция для получения хвоста логов всех процессов в виде файла для отправки в Telegram"""
+    tail = io.BytesIO(read_all_tails())
+    tail.name = os.path.basename(LOGS_PATH)
+    return tail
@@ -0,0 +1,286 @@
+import functools
+import inspect
+import logging
+import threading
+import time
+from contextlib import nullcontext
+
+from config import (
+    IAM_TOKEN_ENDPOINT,
+    METRICS_BUCKETS,
+    METRICS_ENABLED,
+    METRICS_PATH,
+    OTEL_ENDPOINT,
+    URL_GPT,
+    URL_SPEECHKIT_TEXT,
+    URL_SPEECHKIT_VOICE,
+    URL_TOKENS,
+)
+
+# Метрики бота в формате Prometheus: длительность этапов обработки сообщений,
+# ответы внешних API по кодам, попадания в кэши и отказы по лимитам.
+# При METRICS_ENABLED = False замеры не делаются: timed возвращает функцию как есть,
+# stage - пустой контекстный менеджер, count_* сразу выходят
+
+UPSTREAMS = {
+    URL_GPT: "gpt",
+    URL_TOKENS: "tokens",
+    URL_SPEECHKIT_VOICE: "tts",
+    URL_SPEECHKIT_TEXT: "stt",
+    IAM_TOKEN_ENDPOINT: "iam",
+}
+
+_null_stage = nullcontext()
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    labels = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Counter:
+    """Счётчик с метками, например bot_cache_total{cache="gpt",result="hit"}"""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *labelvalues, amount: float = 1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def get_values(self) -> dict:
+        with self._lock:
+            return dict(self._values)
+
+    def collect(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labelvalues, value in sorted(self.get_values().items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labelvalues)} {value}")
+        return lines
+
+
+class Histogram:
+    """Гистограмма длительностей (секунды) с метками и границами METRICS_BUCKETS"""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple, buckets: tuple = METRICS_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._values = {}  # метки -> [счётчики по границам..., сумма, кол-во]
+
+    def observe(self, value: float, *labelvalues):
+        with self._lock:
+            series = self._values.get(labelvalues)
+            if series is None:
+                series = self._values[labelvalues] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def get_values(self) -> dict:
+        with self._lock:
+            return {labelvalues: list(series) for labelvalues, series in self._values.items()}
+
+    def collect(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labelvalues, series in sorted(self.get_values().items()):
+            for bound, count in zip(self.buckets, series):
+                labels = _format_labels(self.labelnames, labelvalues, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = _format_labels(self.labelnames, labelvalues, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {series[-1]}")
+            labels = _format_labels(self.labelnames, labelvalues)
+            lines.append(f"{self.name}_sum{labels} {series[-2]}")
+            lines.append(f"{self.name}_count{labels} {series[-1]}")
+        return lines
+
+
+stage_seconds = Histogram(
+    "bot_stage_seconds", "Длительность этапов обработки сообщений", ("stage",)
+)
+stage_errors = Counter(
+    "bot_stage_errors_total", "Этапы, завершившиеся исключением", ("stage",)
+)
+upstream_seconds = Histogram(
+    "bot_upstream_seconds", "Длительность запросов к внешним API", ("upstream",)
+)
+upstream_responses = Counter(
+    "bot_upstream_responses_total", "Ответы внешних API по кодам (error - нет ответа)", ("upstream", "status")
+)
+cache_requests = Counter(
+    "bot_cache_total", "Обращения к кэшам по результату", ("cache", "result")
+)
+rejections = Counter(
+    "bot_rejections_total", "Отказы по лимитам пользователей, квотам API и очереди к GPT", ("reason",)
+)
+registry = [stage_seconds, stage_errors, upstream_seconds, upstream_responses, cache_requests, rejections]
+
+_tracer = None
+if METRICS_ENABLED and OTEL_ENDPOINT:
+    # экспорт в OpenTelemetry нужен не всем, поэтому его пакеты импортируются, только если он включён
+    import otel
+
+    _tracer = otel.setup(registry)
+
+
+class _Stage:
+    """Замер одного этапа: гистограмма, счётчик ошибок и span OpenTelemetry (если включён)"""
+
+    __slots__ = ("name", "started", "span")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.span = None
+
+    def __enter__(self):
+        if _tracer is not None:
+            self.span = _tracer.start_as_current_span(self.name)
+            self.span.__enter__()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        stage_seconds.observe(time.perf_counter() - self.started, self.name)
+        if exc_type is not None:
+            stage_errors.inc(self.name)
+        if self.span is not None:
+            self.span.__exit__(exc_type, exc, tb)
+        return False
+
+
+def stage(name: str):
+    """
+    Контекстный менеджер для замера этапа обработки:
+        with metrics.stage("telegram.get_file"):
+            file_info = bot.get_file(file_id)
+    """
+    if not METRICS_ENABLED:
+        return _null_stage
+    return _Stage(name)
+
+
+def timed(name: str | None = None):
+    """
+    Декоратор для замера функции (обычной или асинхронной) как этапа name (по умолчанию - имя функции).
+    Если метрики выключены, функция возвращается без обёртки
+    """
+
+    def decorator(function):
+        if not METRICS_ENABLED:
+            return function
+        stage_name = name or function.__name__
+
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with _Stage(stage_name):
+                    return await function(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with _Stage(stage_name):
+                return function(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+def get_upstream(url: str) -> str:
+    """Функция для получения имени API по адресу запроса"""
+    for prefix, name in UPSTREAMS.items():
+        if url.startswith(prefix):
+            return name
+    if "/file/bot" in url:
+        return "telegram_file"
+    return "other"
+
+
+def observe_upstream(url: str, status_code: int | None, seconds: float):
+    """Функция для учёта запроса к внешнему API. status_code=None - ответа нет (ошибка сети)"""
+    if not METRICS_ENABLED:
+        return
+    upstream = get_upstream(url)
+    upstream_seconds.observe(seconds, upstream)
+    upstream_responses.inc(upstream, "error" if status_code is None else str(status_code))
+
+
+def count_cache(cache: str, result: str):
+    """Функция для учёта обращения к кэшу: result - "hit", "miss" и т.п."""
+    if METRICS_ENABLED:
+        cache_requests.inc(cache, result)
+
+
+def count_rejection(reason: str):
+    """Функция для учёта отказа: лимит пользователя, квота API или переполненная очередь"""
+    if METRICS_ENABLED:
+        rejections.inc(reason)
+
+
+class TimedProxy:
+    """Обёртка над объектом, которая замеряет каждый вызов его методов как этап "<prefix>.<метод>" """
+
+    def __init__(self, target, prefix: str, exclude: tuple = ()):
+        self._target = target
+        self._prefix = prefix
+        self._exclude = exclude
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self._target, name)
+        if not callable(attribute) or name in self._exclude:
+            return attribute
+        wrapper = timed(f"{self._prefix}.{name}")(attribute)
+        setattr(self, name, wrapper)  # следующий вызов не проходит через __getattr__
+        return wrapper
+
+
+def render() -> bytes:
+    """Функция для вывода всех метрик в текстовом формате Prometheus"""
+    lines = []
+    for metric in registry:
+        lines.extend(metric.collect())
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def create_app(app=None):
+    """
+    Функция для создания WSGI-приложения, которое отдаёт метрики по METRICS_PATH,
+    а остальные запросы передаёт в app (например, в приложение webhook)
+    """
+
+    def metrics_app(environ, start_response):
+        if environ.get("PATH_INFO") == METRICS_PATH and environ["REQUEST_METHOD"] == "GET":
+            body = render()
+            start_response("200 OK", [
+                ("Content-Type", "text/plain; version=0.0.4; charset=utf-8"),
+                ("Content-Length", str(len(body))),
+            ])
+            return [body]
+        if app is None:
+            start_response("404 Not Found", [("Content-Type", "text/plain"), ("Content-Length", "0")])
+            return [b""]
+        return app(environ, start_response)
+
+    return metrics_app
+
+
+def start_server(host: str, port: int):
+    """Функция для запуска сервера метрик в фоновом потоке (режим polling, async_bot.py)"""
+    import webhook
+
+    thread = threading.Thread(
+        target=webhook.serve, args=(create_app(), host, port), name="metrics", daemon=True
+    )
+    thread.start()
+    logging.info(f"Метрики доступны на {host}:{port}{METRICS_PATH}")
+    return thread
@@ -0,0 +1,201 @@
+import struct
+
+# Формат страницы OGG (RFC 3533): "OggS", версия, флаги, позиция (granule), номер потока,
+# номер страницы, контрольная сумма, кол-во сегментов и таблица их длин
+CAPTURE_PATTERN = b"OggS"
+PAGE_HEADER = struct.Struct("<4sBBqIIIB")
+
+CONTINUED_PACKET = 0x01  # страница начинается с продолжения пакета с прошлой страницы
+LAST_PAGE = 0x04  # последняя страница потока
+
+OPUS_SAMPLE_RATE = 48000  # позиция (granule) в Opus всегда считается в отсчётах 48 кГц
+OPUS_HEAD = b"OpusHead"  # начало первого пакета потока Opus (RFC 7845)
+DEFAULT_PRE_SKIP = 312  # pre-skip libopus, которым кодируют ГС клиенты Telegram, - если OpusHead не прочитан
+
+
+def find_last_granule(data: bytes) -> int | None:
+    """
+    Функция для поиска позиции последней целой страницы в куске OGG-файла
+    (например, в его конце). Возвращает None, если целых страниц с позицией нет
+    """
+    end = len(data)
+    start = data.rfind(CAPTURE_PATTERN, 0, end)
+    while start != -1:
+        if start + PAGE_HEADER.size <= len(data):
+            _, version, _, granule, _, _, _, segments = PAGE_HEADER.unpack_from(data, start)
+            table_end = start + PAGE_HEADER.size + segments
+            if (
+                version == 0
+                and granule != -1  # -1 - на странице не заканчивается ни один пакет
+                and table_end <= len(data)
+                and table_end + sum(data[start + PAGE_HEADER.size:table_end]) <= len(data)
+            ):
+                return granule
+        end = start
+        start = data.rfind(CAPTURE_PATTERN, 0, end)
+    return None
+
+
+def find_pre_skip(data: bytes) -> int | None:
+    """
+    Функция для чтения pre-skip из заголовка OpusHead: сколько отсчётов в начале
+    декодер пропускает. Возвращает None, если заголовка в куске нет
+    """
+    start = data.find(OPUS_HEAD)
+    if start == -1 or start + 12 > len(data):
+        return None
+    return struct.unpack_from("<H", data, start + 10)[0]
+
+
+def get_duration(granule: int, pre_skip: int) -> float:
+    """
+    Функция для перевода позиции Opus в секунды звука. Позиция считается вместе
+    с pre_skip отсчётами, которые декодер выбрасывает, поэтому их вычитаем
+    """
+    return max(granule - pre_skip, 0) / OPUS_SAMPLE_RATE
+
+
+def _make_crc_table() -> list[int]:
+    table = []
+    for byte in range(256):
+        crc = byte << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04C11DB7) if crc & 0x80000000 else crc << 1
+        table.append(crc & 0xFFFFFFFF)
+    return table
+
+
+_CRC_TABLE = _make_crc_table()
+
+
+def crc32(data: bytes) -> int:
+    """Контрольная сумма страницы OGG (CRC-32 без отражения битов, многочлен 0x04C11DB7)"""
+    crc = 0
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ _CRC_TABLE[(crc >> 24) ^ byte]
+    return crc
+
+
+class Page:
+    """Страница OGG: заголовок, таблица длин сегментов и данные"""
+
+    def __init__(
+        self, flags: int, granule: int, serial: int, sequence: int, table: bytes, body: bytes
+    ):
+        self.flags = flags
+        self.granule = granule
+        self.serial = serial
+        self.sequence = sequence
+        self.table = table
+        self.body = body
+
+    @property
+    def packets(self) -> int:
+        """Кол-во пакетов, которые заканчиваются на этой странице"""
+        return sum(1 for length in self.table if length < 255)
+
+    def to_bytes(self) -> bytes:
+        header = PAGE_HEADER.pack(
+            CAPTURE_PATTERN, 0, self.flags, self.granule,
+            self.serial, self.sequence, 0, len(self.table),
+        )
+        page = bytearray(header + self.table + self.body)
+        struct.pack_into("<I", page, 22, crc32(page))  # сумма считается с нулями на её месте
+        return bytes(page)
+
+
+def iter_pages(data: bytes):
+    """Генератор страниц OGG-файла. Выбрасывает ValueError, если файл повреждён"""
+    offset = 0
+    while offset < len(data):
+        if data[offset:offset + 4] != CAPTURE_PATTERN or offset + PAGE_HEADER.size > len(data):
+            raise ValueError(f"Нет страницы OGG по смещению {offset}")
+        _, version, flags, granule, serial, sequence, _, segments = PAGE_HEADER.unpack_from(
+            data, offset
+        )
+        table_start = offset + PAGE_HEADER.size
+        table = data[table_start:table_start + segments]
+        body_end = table_start + segments + sum(table)
+        if version != 0 or body_end > len(data):
+            raise ValueError(f"Повреждённая страница OGG по смещению {offset}")
+        yield Page(flags, granule, serial, sequence, table, data[table_start + segments:body_end])
+        offset = body_end
+
+
+def _choose_cut(
+    pages: list, start: int, start_granule: int, max_samples: int, window_samples: int
+) -> int:
+    """
+    Выбирает последнюю страницу куска, который начинается со страницы start.
+    Из подходящих по длине границ страниц в последние window_samples берётся самая тихая:
+    страница с наименьшим размером пакета (тишина в Opus кодируется короткими пакетами)
+    """
+    candidates = []
+    for index in range(start, len(pages)):
+        page = pages[index]
+        if page.granule - start_granule > max_samples:
+            break
+        next_page = pages[index + 1] if index + 1 < len(pages) else None
+        if page.granule != -1 and (next_page is None or not next_page.flags & CONTINUED_PACKET):
+            candidates.append(index)
+    if not candidates:
+        raise ValueError("Страница OGG длиннее допустимого куска")
+    if candidates[-1] == len(pages) - 1:
+        return candidates[-1]  # остаток файла помещается целиком
+
+    last_granule = pages[candidates[-1]].granule
+    quiet = [
+        index for index in candidates
+        if last_granule - pages[index].granule <= window_samples
+    ]
+    return min(
+        quiet,
+        key=lambda index: (len(pages[index].body) / max(pages[index].packets, 1), -index),
+    )
+
+
+def split_opus(
+    data: bytes, max_seconds: float, window_seconds: float
+) -> list[tuple[bytes, float]]:
+    """
+    Функция для разбиения OGG/Opus на самостоятельные файлы не длиннее max_seconds
+    по границам страниц, без перекодирования. У каждого куска свои заголовки,
+    позиции отсчитываются от его начала, а номера страниц и контрольные суммы пересчитаны.
+    Возвращает список кусков и их длительности в секундах
+    """
+    pages = list(iter_pages(data))
+    if not pages or not pages[0].body.startswith(OPUS_HEAD):
+        raise ValueError("Это не OGG/Opus")
+    if any(page.serial != pages[0].serial for page in pages):
+        raise ValueError("В файле несколько потоков")
+    pre_skip = find_pre_skip(pages[0].body)
+
+    # Заголовки (OpusHead и OpusTags) - страницы до первой страницы со звуком
+    header_count = 1
+    while header_count < len(pages) and pages[header_count].granule in (0, -1):
+        header_count += 1
+    headers = pages[:header_count]
+    audio = pages[header_count:]
+
+    segments = []
+    start, start_granule = 0, 0
+    max_samples = int(max_seconds * OPUS_SAMPLE_RATE)
+    window_samples = int(window_seconds * OPUS_SAMPLE_RATE)
+    while start < len(audio):
+        end = _choose_cut(audio, start, start_granule, max_samples, window_samples)
+        # у всех кусков, кроме первого, декодер снова пропустит pre_skip отсчётов
+        offset = start_granule - (pre_skip if segments else 0)
+        sequence = len(headers)
+        parts = [page.to_bytes() for page in headers]
+        for index in range(start, end + 1):
+            page = audio[index]
+            flags = page.flags & ~LAST_PAGE | (LAST_PAGE if index == end else 0)
+            granule = page.granule - offset if page.granule != -1 else -1
+            parts.append(
+                Page(flags, granule, page.serial, sequence, page.table, page.body).to_bytes()
+            )
+            sequence += 1
+        end_granule = audio[end].granule
+        segments.append((b"".join(parts), get_duration(end_granule - offset, pre_skip)))
+        start, start_granule = end + 1, end_granule
+    return segments
@@ -0,0 +1,57 @@
+from opentelemetry import metrics, trace
+from opentelemetry.exporter.otlp.proto.http.metric_exporter import OTLPMetricExporter
+from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+from opentelemetry.metrics import CallbackOptions, Observation
+from opentelemetry.sdk.metrics import MeterProvider
+from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor
+
+from config import OTEL_ENDPOINT
+
+# Экспорт в OpenTelemetry (OTLP/HTTP на OTEL_ENDPOINT). Импортируется из metrics.py,
+# только если задан OTEL_ENDPOINT: нужны пакеты opentelemetry-sdk и opentelemetry-exporter-otlp-proto-http
+
+SERVICE_NAME = "yandex-gpt-bot"
+EXPORT_INTERVAL_MS = 15000  # раз во сколько миллисекунд отправлять метрики коллектору
+
+
+def _observe(metric, index: int | None = None):
+    """Функция для чтения текущих значений метрики (для гистограммы - сумма или кол-во)"""
+
+    def callback(options: CallbackOptions):
+        for labelvalues, value in metric.get_values().items():
+            if index is not None:
+                value = value[index]
+            yield Observation(value, dict(zip(metric.labelnames, labelvalues)))
+
+    return callback
+
+
+def setup(registry: list):
+    """
+    Функция для настройки экспорта: этапы обработки уходят спанами (вложенные этапы -
+    дочерние спаны), метрики из registry - наблюдаемыми счётчиками.
+    Возвращает tracer для metrics.stage
+    """
+    resource = Resource.create({"service.name": SERVICE_NAME})
+
+    tracer_provider = TracerProvider(resource=resource)
+    tracer_provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter(f"{OTEL_ENDPOINT}/v1/traces")))
+    trace.set_tracer_provider(tracer_provider)
+
+    reader = PeriodicExportingMetricReader(
+        OTLPMetricExporter(f"{OTEL_ENDPOINT}/v1/metrics"), export_interval_millis=EXPORT_INTERVAL_MS
+    )
+    metrics.set_meter_provider(MeterProvider(resource=resource, metric_readers=[reader]))
+    meter = metrics.get_meter(SERVICE_NAME)
+    for metric in registry:
+        if hasattr(metric, "buckets"):
+            # гистограмму без своих границ передаём суммой и кол-вом, как *_sum и *_count в Prometheus
+            meter.create_observable_counter(f"{metric.name}_sum", [_observe(metric, -2)], unit="s")
+            meter.create_observable_counter(f"{metric.name}_count", [_observe(metric, -1)])
+        else:
+            meter.create_observable_counter(metric.name, [_observe(metric)], description=metric.documentation)
+
+    return trace.get_tracer(SERVICE_NAME)
@@ -0,0 +1,162 @@
+import asyncio
+import threading
+import time
+
+import metrics
+from config import (
+    CONCURRENCY_DECREASE,
+    CONCURRENCY_INCREASE,
+    CONCURRENCY_INITIAL,
+    CONCURRENCY_MAX,
+    CONCURRENCY_MIN,
+    RATE_LIMIT_QUEUE_TIMEOUT,
+    RATE_LIMITS,
+)
+
+THROTTLED_STATUS = 429  # API просит снизить частоту запросов
+ASYNC_POLL_INTERVAL = 0.05  # как часто асинхронный запрос проверяет, не освободилось ли место
+
+
+class RateLimitTimeout(Exception):
+    """Запрос не дождался своей очереди к API за RATE_LIMIT_QUEUE_TIMEOUT секунд"""
+
+
+class TokenBucket:
+    """Ограничение частоты: rate запросов в секунду со всплесками до burst запросов"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self) -> float:
+        """Забирает разрешение на запрос. Возвращает 0 или сколько секунд подождать до следующей попытки"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+
+class AimdLimiter:
+    """
+    Ограничение кол-ва одновременных запросов: при 429 лимит уменьшается
+    в CONCURRENCY_DECREASE раз, после успешных запросов плавно растёт
+    """
+
+    def __init__(self):
+        self.limit = float(CONCURRENCY_INITIAL)
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    def try_acquire(self) -> bool:
+        with self._condition:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self, deadline: float) -> bool:
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            self.in_flight += 1
+            return True
+
+    def release(self, throttled: bool | None):
+        """Освобождает место. throttled=None - исход неизвестен (ошибка сети), лимит не меняем"""
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(CONCURRENCY_MIN, self.limit * CONCURRENCY_DECREASE)
+            elif throttled is not None:
+                self.limit = min(CONCURRENCY_MAX, self.limit + CONCURRENCY_INCREASE / self.limit)
+            self._condition.notify_all()
+
+
+class EndpointLimiter:
+    """Ограничения частоты и одновременности запросов к одному API"""
+
+    def __init__(self, name: str, rate: float, burst: int):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.concurrency = AimdLimiter()
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "throttled": 0, "timeouts": 0, "wait_seconds_total": 0.0}
+
+    def acquire(self, timeout: float = RATE_LIMIT_QUEUE_TIMEOUT):
+        """Ждёт места для запроса не дольше timeout секунд, иначе выбрасывает RateLimitTimeout"""
+        started = time.monotonic()
+        deadline = started + timeout
+        while True:
+            wait = self.bucket.take()
+            if not wait:
+                break
+            if time.monotonic() + wait > deadline:
+                self._timeout()
+            time.sleep(wait)
+        if not self.concurrency.acquire(deadline):
+            self._timeout()
+        self._count_wait(started)
+
+    async def acquire_async(self, timeout: float = RATE_LIMIT_QUEUE_TIMEOUT):
+        """Асинхронная версия acquire"""
+        started = time.monotonic()
+        deadline = started + timeout
+        while True:
+            wait = self.bucket.take()
+            if not wait:
+                break
+            if time.monotonic() + wait > deadline:
+                self._timeout()
+            await asyncio.sleep(wait)
+        while not self.concurrency.try_acquire():
+            if time.monotonic() + ASYNC_POLL_INTERVAL > deadline:
+                self._timeout()
+            await asyncio.sleep(ASYNC_POLL_INTERVAL)
+        self._count_wait(started)
+
+    def release(self, status_code: int | None):
+        """Освобождает место после ответа. status_code=None - ответа нет (ошибка сети)"""
+        throttled = status_code == THROTTLED_STATUS
+        with self._lock:
+            self._stats["throttled"] += throttled
+        self.concurrency.release(None if status_code is None else throttled)
+
+    def _timeout(self):
+        with self._lock:
+            self._stats["timeouts"] += 1
+        metrics.count_rejection(f"rate_limit_{metrics.get_upstream(self.name)}")
+        raise RateLimitTimeout(f"Слишком много запросов к {self.name}, очередь не подошла")
+
+    def _count_wait(self, started: float):
+        with self._lock:
+            self._stats["requests"] += 1
+            self._stats["wait_seconds_total"] += time.monotonic() - started
+
+    def get_stats(self) -> dict:
+        """Возвращает счётчики и текущий лимит одновременных запросов"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats["concurrency_limit"] = int(self.concurrency.limit)
+        stats["in_flight"] = self.concurrency.in_flight
+        return stats
+
+
+limiters = [EndpointLimiter(url, rate, burst) for url, (rate, burst) in RATE_LIMITS.items()]
+
+
+def get_limiter(url: str) -> EndpointLimiter | None:
+    """Функция для получения ограничителя по адресу запроса (адрес STT содержит ещё и параметры)"""
+    for limiter in limiters:
+        if url.startswith(limiter.name):
+            return limiter
+    return None
@@ -0,0 +1,129 @@
+import argparse
+import json
+import sys
+import time
+
+import requests
+
+from config import WEBHOOK_PATH, WEBHOOK_PORT, WEBHOOK_SECRET
+
+UPDATE_STATUS_HEADER = "X-Update-Status"  # webhook.UPDATE_STATUS_HEADER: processed или duplicate
+
+# Проигрывание записанных обновлений (WEBHOOK_RECORD_PATH) на локальный webhook:
+#   python replay_updates.py updates.jsonl --repeat 2
+# С --repeat каждое обновление отправляется несколько раз, как при повторной доставке Telegram,
+# и обработано должно быть только первое: это проверяется по заголовку X-Update-Status в ответах
+# (код выхода 1, если нет). Роутер при SHARDS > 0 только ставит обновление в очередь и заголовок
+# не присылает - тогда проверки нет.
+# С --generate вместо файла отправляются сообщения от множества пользователей
+# (например, чтобы проверить распределение по обработчикам при SHARDS > 0):
+#   python replay_updates.py --generate 100 --messages 5
+
+
+def load_updates(path: str) -> list[dict]:
+    """Функция для чтения обновлений из файла: по одному JSON на строку"""
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def generate_updates(users: int, messages: int, text: str, first_update_id: int = 1) -> list[dict]:
+    """Функция для создания текстовых сообщений от users пользователей, по messages от каждого"""
+    updates = []
+    for number in range(messages):
+        for user_id in range(1, users + 1):
+            update_id = first_update_id + len(updates)
+            user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+            updates.append({
+                "update_id": update_id,
+                "message": {
+                    "message_id": number + 1,
+                    "from": user,
+                    "chat": {"id": user_id, "type": "private", "first_name": user["first_name"]},
+                    "date": int(time.time()),
+                    "text": text,
+                },
+            })
+    return updates
+
+
+def replay(updates: list[dict], url: str, repeat: int = 1, delay: float = 0.0) -> tuple[dict, dict]:
+    """
+    Отправляет обновления на webhook. Возвращает количество ответов по статус-кодам
+    и исход каждого update_id: сколько раз он обработан (processed) и пропущен как повтор (duplicate)
+    """
+    headers = {"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET} if WEBHOOK_SECRET else {}
+    statuses = {}
+    outcomes = {}  # update_id -> {"processed": n, "duplicate": n}
+    with requests.Session() as session:
+        for update in updates:
+            for _ in range(repeat):
+                response = session.post(url, json=update, headers=headers, timeout=30)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+                outcome = response.headers.get(UPDATE_STATUS_HEADER)
+                if outcome:
+                    counts = outcomes.setdefault(update["update_id"], {"processed": 0, "duplicate": 0})
+                    counts[outcome] = counts.get(outcome, 0) + 1
+            if delay:
+                time.sleep(delay)
+    return statuses, outcomes
+
+
+def check_outcomes(updates: list[dict], outcomes: dict) -> list[str]:
+    """
+    Функция для проверки, что каждое обновление обработано ровно один раз,
+    а все повторные доставки пропущены. Возвращает описания нарушений
+    """
+    problems = []
+    for update_id in dict.fromkeys(update["update_id"] for update in updates):
+        counts = outcomes.get(update_id)
+        if counts is None:
+            problems.append(f"{update_id}: нет ответа с {UPDATE_STATUS_HEADER}")
+        elif counts["processed"] != 1:
+            problems.append(
+                f"{update_id}: обработано {counts['processed']} раз, пропущено {counts['duplicate']}"
+            )
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Проигрывание записанных обновлений Telegram на webhook")
+    parser.add_argument("path", nargs="?", help="файл с обновлениями, по одному JSON на строку")
+    parser.add_argument("--generate", type=int, metavar="USERS", help="создать сообщения от USERS пользователей")
+    parser.add_argument("--messages", type=int, default=1, help="сколько сообщений от каждого пользователя")
+    parser.add_argument("--text", default="/help", help="текст создаваемых сообщений")
+    parser.add_argument("--url", default=f"http://127.0.0.1:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    parser.add_argument("--repeat", type=int, default=1, help="сколько раз отправлять каждое обновление")
+    parser.add_argument("--delay", type=float, default=0.0, help="пауза между обновлениями, секунды")
+    args = parser.parse_args()
+    if not args.path and not args.generate:
+        parser.error("нужен файл с обновлениями или --generate")
+
+    if args.generate:
+        # update_id от текущего времени, чтобы повторный запуск не отсекался как повтор
+        first_update_id = int(time.time() * 1000)
+        updates = generate_updates(args.generate, args.messages, args.text, first_update_id)
+    else:
+        updates = load_updates(args.path)
+    started = time.monotonic()
+    statuses, outcomes = replay(updates, args.url, args.repeat, args.delay)
+    print(f"Отправлено {len(updates)} обновлений x{args.repeat} за {time.monotonic() - started:.2f} с")
+    print(f"Ответы: {statuses}")
+    if not outcomes:
+        print(f"В ответах нет {UPDATE_STATUS_HEADER} (роутер SHARDS?), повторы не проверены")
+        return 0
+
+    processed = sum(counts["processed"] for counts in outcomes.values())
+    duplicates = sum(counts["duplicate"] for counts in outcomes.values())
+    print(f"Обработано: {processed}, пропущено повторов: {duplicates}")
+    problems = check_outcomes(updates, outcomes)
+    for problem in problems[:20]:
+        print(problem)
+    if problems:
+        print(f"Повторы отсекаются неверно: {len(problems)} обновлений")
+        return 1
+    print("Каждое обновление обработано один раз")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
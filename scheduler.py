@@ -0,0 +1,172 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+import metrics
+from config import GPT_CONCURRENCY, GPT_QUEUE_SIZE, GPT_QUEUE_TIMEOUT
+
+# Классы приоритета: чем меньше число, тем раньше запрос получит доступ к GPT
+PRIORITY_ADMIN = 0  # администраторы
+PRIORITY_TEXT = 1  # ответ на текстовое сообщение, пользователь ждёт его в чате
+PRIORITY_VOICE = 2  # ответ голосом, к нему всё равно добавится озвучивание
+PRIORITY_BACKGROUND = 3  # фоновая работа, которую никто не ждёт
+
+PRIORITY_NAMES = {
+    PRIORITY_ADMIN: "админы",
+    PRIORITY_TEXT: "текст",
+    PRIORITY_VOICE: "голос",
+    PRIORITY_BACKGROUND: "фон",
+}
+
+
+class _Waiter:
+    def __init__(self, user_id: int, priority: int):
+        self.user_id = user_id
+        self.priority = priority
+        self.queued_at = time.monotonic()
+        self.event = threading.Event()
+        self.granted = False
+
+
+class PriorityScheduler:
+    """
+    Очередь к GPT с классами приоритета: одновременно выполняется не больше slots запросов,
+    свободное место получает запрос из самого приоритетного класса, а внутри класса
+    пользователи обслуживаются по кругу, чтобы один активный пользователь не занял всю очередь.
+    Когда очередь заполнена, новый запрос вытесняет запрос из менее приоритетного класса
+    или получает отказ
+    """
+
+    def __init__(
+        self,
+        slots: int = GPT_CONCURRENCY,
+        queue_size: int = GPT_QUEUE_SIZE,
+        timeout: float = GPT_QUEUE_TIMEOUT,
+    ):
+        self.slots = slots
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.in_flight = 0
+        # класс приоритета -> пользователь -> его ожидающие запросы по порядку
+        self._queues = {priority: OrderedDict() for priority in PRIORITY_NAMES}
+        self._waiting = 0
+        self._lock = threading.Lock()
+        self._stats = {
+            "served": 0,
+            "shed": 0,
+            "timeouts": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+        }
+
+    def acquire(self, user_id: int, priority: int) -> bool:
+        """Ждёт своей очереди к GPT. Возвращает False, если запрос вытеснен или не дождался"""
+        with self._lock:
+            if self.in_flight < self.slots and not self._waiting:
+                self.in_flight += 1
+                self._record_wait(0.0)
+                return True
+            if self._waiting >= self.queue_size and not self._shed_below(priority):
+                self._stats["shed"] += 1
+                metrics.count_rejection("gpt_queue_full")
+                return False
+            waiter = _Waiter(user_id, priority)
+            self._queues[priority].setdefault(user_id, deque()).append(waiter)
+            self._waiting += 1
+
+        waiter.event.wait(self.timeout)
+        with self._lock:
+            if waiter.granted:
+                return True
+            if not waiter.event.is_set():
+                # не дождались - убираем запрос из очереди сами
+                self._remove(waiter)
+                self._stats["timeouts"] += 1
+                metrics.count_rejection("gpt_queue_timeout")
+            return False
+
+    def release(self):
+        """Освобождает место после ответа GPT и отдаёт его следующему запросу"""
+        with self._lock:
+            self.in_flight -= 1
+            self._grant_next()
+
+    @contextmanager
+    def slot(self, user_id: int, priority: int):
+        """Контекстный менеджер для acquire/release: внутри блока доступно значение acquire"""
+        granted = self.acquire(user_id, priority)
+        try:
+            yield granted
+        finally:
+            if granted:
+                self.release()
+
+    def _grant_next(self):
+        for users in self._queues.values():
+            while users and self.in_flight < self.slots:
+                user_id, waiters = next(iter(users.items()))
+                waiter = waiters.popleft()
+                if waiters:
+                    users.move_to_end(user_id)  # следующий запрос этого пользователя - после остальных
+                else:
+                    del users[user_id]
+                self._waiting -= 1
+                self.in_flight += 1
+                waiter.granted = True
+                self._record_wait(time.monotonic() - waiter.queued_at)
+                waiter.event.set()
+
+    def _shed_below(self, priority: int) -> bool:
+        """
+        Вытесняет из очереди последний запрос самого активного пользователя
+        в наименее приоритетном классе ниже priority. Возвращает True, если место освободилось
+        """
+        for worse in sorted(self._queues, reverse=True):
+            if worse <= priority:
+                return False
+            users = self._queues[worse]
+            if not users:
+                continue
+            waiters = max(users.values(), key=len)
+            waiter = waiters[-1]
+            self._remove(waiter)
+            self._stats["shed"] += 1
+            metrics.count_rejection("gpt_queue_full")
+            waiter.event.set()  # granted=False: ожидающий получит отказ
+            return True
+        return False
+
+    def _remove(self, waiter: _Waiter):
+        users = self._queues[waiter.priority]
+        waiters = users[waiter.user_id]
+        waiters.remove(waiter)
+        if not waiters:
+            del users[waiter.user_id]
+        self._waiting -= 1
+
+    def _record_wait(self, wait_seconds: float):
+        stats = self._stats
+        stats["served"] += 1
+        stats["wait_seconds_total"] += wait_seconds
+        stats["wait_seconds_max"] = max(stats["wait_seconds_max"], wait_seconds)
+
+    def get_stats(self) -> dict:
+        """Возвращает состояние очереди: занятые места, ожидающих по классам и счётчики"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["in_flight"] = self.in_flight
+            stats["slots"] = self.slots
+            stats["waiting"] = self._waiting
+            stats["waiting_by_priority"] = {
+                PRIORITY_NAMES[priority]: sum(len(waiters) for waiters in users.values())
+                for priority, users in self._queues.items()
+            }
+            stats["waiting_users"] = len(
+                {user_id for users in self._queues.values() for user_id in users}
+            )
+        stats["wait_seconds_avg"] = stats["wait_seconds_total"] / (stats["served"] or 1)
+        return stats
+
+
+gpt_scheduler = PriorityScheduler()  # общая очередь запросов к GPT
@@ -0,0 +1,343 @@
+import atexit
+import logging
+import sys
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+import db
+from config import (
+    COUNT_LAST_MSG,
+    SESSION_CACHE_MAX_BYTES,
+    SESSION_FLUSH_BATCH,
+    SESSION_FLUSH_INTERVAL,
+    SHARD_URLS,
+    WEBHOOK_PROCESSES,
+)
+from storage import LIMIT_TYPES
+
+SESSION_OVERHEAD_BYTES = 1024  # примерный размер пустой сессии в памяти
+
+
+class UserSession:
+    """
+    Сессия пользователя в памяти: признак регистрации,
+    последние COUNT_LAST_MSG сообщений и счётчики лимитов
+    """
+
+    def __init__(self, registered: bool, messages: list, limits: dict | None):
+        self.registered = registered
+        self.messages = deque(messages, maxlen=COUNT_LAST_MSG)
+        self.limits = limits or dict.fromkeys(LIMIT_TYPES, 0)
+        self.lock = threading.Lock()
+        self.users = 0  # сколько потоков сейчас изменяют сессию - такую не вытесняем
+
+    def size(self) -> int:
+        """Примерный размер сессии в байтах"""
+        return SESSION_OVERHEAD_BYTES + sum(
+            sys.getsizeof(message["text"]) for message in self.messages
+        )
+
+
+_sessions = OrderedDict()  # user_id -> UserSession, в порядке последнего обращения
+_sessions_bytes = 0
+_users_count = None  # количество зарегистрированных пользователей
+_lock = threading.RLock()
+
+_pending_messages = []  # сообщения, ещё не записанные в БД
+_pending_limits = {}  # user_id -> {limit_type: изменение}, ещё не записанные в БД
+_pending_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_flush_event = threading.Event()
+_flusher = None
+
+
+def _load_session(user_id: int) -> UserSession:
+    """Функция для загрузки сессии из БД"""
+    flush()  # иначе из БД могут прочитаться устаревшие данные
+
+    if not db.is_user_in_db(user_id):
+        return UserSession(False, [], None)
+    messages, _ = db.select_n_last_messages(user_id, COUNT_LAST_MSG)
+    return UserSession(True, messages, db.get_user_limits(user_id))
+
+
+def _evict():
+    """
+    Функция для вытеснения давно не использованных сессий при превышении памяти.
+    Сессии, которые сейчас изменяет другой поток, не вытесняются: его изменения
+    попали бы в сессию вне кэша, а следующая загрузка из БД их бы не увидела
+    """
+    global _sessions_bytes
+    excess = _sessions_bytes - SESSION_CACHE_MAX_BYTES
+    victims = []
+    for user_id, session in _sessions.items():
+        if excess <= 0 or len(_sessions) - len(victims) <= 1:
+            break
+        if session.users:
+            continue
+        victims.append(user_id)
+        excess -= session.size()
+    for user_id in victims:
+        _sessions_bytes -= _sessions.pop(user_id).size()
+
+
+def _get_session(user_id: int, use: bool) -> UserSession:
+    global _sessions_bytes
+    with _lock:
+        session = _sessions.get(user_id)
+        if session is not None:
+            _sessions.move_to_end(user_id)
+            session.users += use
+            return session
+
+    session = _load_session(user_id)
+    with _lock:
+        if user_id in _sessions:  # пока загружали, сессию уже добавил другой поток
+            session = _sessions[user_id]
+        else:
+            _sessions[user_id] = session
+            _sessions_bytes += session.size()
+        session.users += use
+        _evict()
+    return session
+
+
+def get_session(user_id: int) -> UserSession:
+    """Функция для получения сессии пользователя: из памяти или из БД"""
+    return _get_session(user_id, use=False)
+
+
+@contextmanager
+def use_session(user_id: int):
+    """Функция для получения сессии, которая не вытесняется, пока её изменяют"""
+    session = _get_session(user_id, use=True)
+    try:
+        yield session
+    finally:
+        with _lock:
+            session.users -= 1
+
+
+def _add_pending_limits(user_id: int, deltas: dict):
+    with _pending_lock:
+        user_limits = _pending_limits.setdefault(user_id, dict.fromkeys(LIMIT_TYPES, 0))
+        for limit_type, delta in deltas.items():
+            user_limits[limit_type] += delta
+    _start_flusher()
+
+
+def is_user_in_db(user_id: int) -> bool:
+    return get_session(user_id).registered
+
+
+def count_users(user_id: int) -> int:
+    """Функция для подсчёта пользователей, кроме самого пользователя"""
+    global _users_count
+    with _lock:
+        if _users_count is None or SHARD_URLS:
+            # при нескольких процессах пользователей регистрируют и другие - считаем по БД
+            _users_count = db.count_all_users()
+        count = _users_count
+    return count - 1 if is_user_in_db(user_id) else count
+
+
+def add_new_user(user_id: int, max_users: int | None = None) -> bool:
+    """
+    Функция добавления нового пользователя: сразу пишет в БД, минуя очередь.
+    Лимит max_users проверяется в БД, общей для всех процессов.
+    Возвращает True, если пользователь зарегистрирован
+    """
+    global _users_count, _sessions_bytes
+    if is_user_in_db(user_id):
+        logging.info("Пользователь уже существует!")
+        return True
+    if not db.add_new_user(user_id, max_users):
+        with _lock:
+            _users_count = None  # пользователей добавили другие процессы, пересчитаем
+        return False
+    session = _load_session(user_id)
+    with _lock:
+        old_session = _sessions.pop(user_id, None)
+        if old_session is not None:
+            _sessions_bytes -= old_session.size()
+        _sessions[user_id] = session
+        _sessions_bytes += session.size()
+        if _users_count is not None:
+            _users_count += 1
+        _evict()
+    return True
+
+
+def add_message(
+    user_id, full_message, gpt_tokens: int | None = None, count_limits: bool = True
+):
+    """
+    Функция, которая добавляет новое сообщение в сессию сразу,
+    а в БД - при следующей записи пачки в фоне
+    """
+    global _sessions_bytes
+    message, role, total_gpt_tokens, tts_symbols, stt_blocks = full_message
+    with use_session(user_id) as session:
+        if not session.registered:
+            return
+        with session.lock:
+            old_size = session.size()
+            session.messages.append({"text": message, "role": role})
+            if count_limits:
+                session.limits["total_gpt_tokens"] += total_gpt_tokens
+                session.limits["tts_symbols"] += tts_symbols
+                session.limits["stt_blocks"] += stt_blocks
+            new_size = session.size()
+        with _lock:
+            _sessions_bytes += new_size - old_size
+
+    with _pending_lock:
+        _pending_messages.append(
+            (user_id, message, role, total_gpt_tokens, tts_symbols, stt_blocks, gpt_tokens)
+        )
+        pending = len(_pending_messages)
+    if count_limits:
+        _add_pending_limits(
+            user_id,
+            {
+                "total_gpt_tokens": total_gpt_tokens,
+                "tts_symbols": tts_symbols,
+                "stt_blocks": stt_blocks,
+            },
+        )
+    _start_flusher()
+    if pending >= SESSION_FLUSH_BATCH:
+        _flush_event.set()
+
+
+def select_n_last_messages(user_id, n_last_messages=4):
+    """Функция для получения последних n сообщений пользователя и потраченных токенов"""
+    if n_last_messages > COUNT_LAST_MSG:
+        flush()
+        return db.select_n_last_messages(user_id, n_last_messages)
+    session = get_session(user_id)
+    with session.lock:
+        messages = list(session.messages)[-n_last_messages:]
+        return messages, session.limits["total_gpt_tokens"]
+
+
+def get_user_limits(user_id: int) -> dict | None:
+    """Функция для получения всех счётчиков лимитов пользователя"""
+    session = get_session(user_id)
+    if not session.registered:
+        return None
+    with session.lock:
+        return dict(session.limits)
+
+
+def count_all_limits(user_id, limit_type):
+    """Функция для получения потраченных ресурсов (<limit_type>)"""
+    limits = get_user_limits(user_id)
+    return limits[limit_type] if limits else 0
+
+
+def reserve_limit(user_id: int, limit_type: str, amount: int, max_value: int) -> bool:
+    """
+    Функция для атомарной проверки и резервирования ресурсов (<limit_type>).
+    Проверка и увеличение счётчика идут под блокировкой сессии
+    """
+    with use_session(user_id) as session:
+        if not session.registered:
+            return False
+        with session.lock:
+            if session.limits[limit_type] + amount > max_value:
+                return False
+            session.limits[limit_type] += amount
+            _add_pending_limits(user_id, {limit_type: amount})
+    return True
+
+
+def release_limit(user_id: int, limit_type: str, amount: int):
+    """Функция для возврата неиспользованных зарезервированных ресурсов"""
+    if amount <= 0:
+        return
+    with use_session(user_id) as session:
+        if not session.registered:
+            return
+        with session.lock:
+            released = min(amount, session.limits[limit_type])
+            session.limits[limit_type] -= released
+            _add_pending_limits(user_id, {limit_type: -released})
+
+
+def update_row(user_id: int, column_name: str, new_value: int):
+    """Функция для записи нового значения счётчика: сразу в БД и в сессию"""
+    with use_session(user_id) as session:
+        if not session.registered:
+            logging.info("Пользователь не найден в базе")
+            return
+        with session.lock:
+            flush()  # накопленные изменения не должны лечь поверх нового значения
+            db.update_row(user_id, column_name, new_value)
+            session.limits[column_name] = new_value
+
+
+def flush():
+    """Функция для записи всех накопленных сообщений и счётчиков в БД одним коммитом"""
+    with _flush_lock:
+        with _pending_lock:
+            messages = _pending_messages[:]
+            limits = dict(_pending_limits)
+            _pending_messages.clear()
+            _pending_limits.clear()
+        if not messages and not limits:
+            return
+        try:
+            with db.transaction():
+                db.add_messages_batch(messages)
+                db.add_limits_batch(limits)
+        except Exception as e:
+            logging.error(f"Ошибка при записи сессий в БД, повторим позже: {e}")
+            with _pending_lock:
+                _pending_messages[:0] = messages
+                for user_id, deltas in limits.items():
+                    user_limits = _pending_limits.setdefault(
+                        user_id, dict.fromkeys(LIMIT_TYPES, 0)
+                    )
+                    for limit_type, delta in deltas.items():
+                        user_limits[limit_type] += delta
+
+
+def _flush_loop():
+    while True:
+        _flush_event.wait(SESSION_FLUSH_INTERVAL)
+        _flush_event.clear()
+        flush()
+
+
+def _start_flusher():
+    global _flusher
+    if _flusher is not None:
+        return
+    with _lock:
+        if _flusher is None:
+            _flusher = threading.Thread(
+                target=_flush_loop, name="sessions-flusher", daemon=True
+            )
+            _flusher.start()
+
+
+atexit.register(flush)  # при остановке бота дописываем всё, что осталось в очереди
+
+
+if WEBHOOK_PROCESSES > 1 and not SHARD_URLS:
+    # Несколько процессов на одном порту: ядро раздаёт соединения как придётся, и сообщения
+    # одного пользователя попадают в разные процессы. Сессия в памяти каждого из них устаревала бы,
+    # а отложенная запись накладывалась бы на чужую, поэтому кэша нет и все функции сразу идут в общую БД.
+    # Чтобы пользователь был закреплён за одним процессом и кэш работал, есть SHARDS
+    add_new_user = db.add_new_user
+    is_user_in_db = db.is_user_in_db
+    count_users = db.count_users
+    add_message = db.add_message
+    select_n_last_messages = db.select_n_last_messages
+    get_user_limits = db.get_user_limits
+    count_all_limits = db.count_all_limits
+    reserve_limit = db.reserve_limit
+    release_limit = db.release_limit
+    update_row = db.update_row
@@ -0,0 +1,167 @@
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import telebot
+from telebot import apihelper
+
+import http_client
+import webhook
+from config import (
+    RUN_MODE,
+    SHARD_URLS,
+    WEBHOOK_HOST,
+    WEBHOOK_PORT,
+    WEBHOOK_SECRET,
+    WORKER_QUEUE_SIZE,
+    WORKER_QUEUE_TIMEOUT,
+)
+from dispatcher import OrderedWorkerPool
+
+# Шардирование: главный процесс (роутер) получает обновления от Telegram и пересылает
+# каждое процессу-обработчику с номером user_id % len(SHARD_URLS).
+# Пользователь всегда попадает в один и тот же процесс, поэтому только этот процесс
+# меняет его строки в общей БД и держит его сессию в кэше sessions.
+# Номер обработчика передаётся через переменную окружения SHARD_ENV
+
+SHARD_ENV = "BOT_SHARD"
+FORWARD_ATTEMPTS = 5  # сколько раз пытаться переслать обновление (обработчик может ещё запускаться)
+
+
+def get_shard_index() -> int | None:
+    """Функция для получения номера обработчика текущего процесса (None - это не обработчик)"""
+    shard = os.environ.get(SHARD_ENV)
+    return int(shard) if shard is not None else None
+
+
+def get_user_id(update: dict) -> int:
+    """
+    Функция для получения id пользователя из обновления Telegram в виде словаря:
+    поле from у сообщения, callback_query и т.д. Если пользователя нет - update_id
+    """
+    for value in update.values():
+        if isinstance(value, dict) and isinstance(value.get("from"), dict):
+            return value["from"]["id"]
+    return update["update_id"]
+
+
+def get_shard(update: dict) -> int:
+    """Функция для получения номера обработчика, который отвечает за пользователя"""
+    return get_user_id(update) % len(SHARD_URLS)
+
+
+class ShardRouter:
+    """
+    Пересылает обновления обработчикам. Для каждого обработчика свой поток,
+    поэтому обновления одного пользователя приходят к нему в том же порядке
+    """
+
+    def __init__(self):
+        self.pool = OrderedWorkerPool(
+            self._forward, len(SHARD_URLS), WORKER_QUEUE_SIZE, name="shard-router"
+        )
+        self._headers = {"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET} if WEBHOOK_SECRET else {}
+        self._stats_lock = threading.Lock()
+        self._forwarded = [0] * len(SHARD_URLS)
+        self._lost = 0
+
+    def submit(self, update: dict) -> bool:
+        """Ставит обновление в очередь его обработчика. False - очередь переполнена"""
+        shard = get_shard(update)
+        return self.pool.submit(shard, (shard, update), timeout=WORKER_QUEUE_TIMEOUT)
+
+    def _forward(self, item: tuple[int, dict]):
+        shard, update = item
+        for attempt in range(FORWARD_ATTEMPTS):
+            try:
+                response = http_client.post(SHARD_URLS[shard], json=update, headers=self._headers)
+                if response.status_code == 200:
+                    with self._stats_lock:
+                        self._forwarded[shard] += 1
+                    return
+                logging.error(f"Обработчик {shard} ответил {response.status_code}")
+            except Exception as e:
+                logging.error(f"Не удалось переслать обновление обработчику {shard}: {e}")
+            # повтор безопасен: обработчики отсекают повторы по update_id
+            time.sleep(attempt + 1)
+        with self._stats_lock:
+            self._lost += 1
+        logging.error(f"Обновление {update['update_id']} не доставлено обработчику {shard}")
+
+    def poll(self, bot: telebot.TeleBot, timeout: int = 60, long_polling_timeout: int = 5):
+        """Функция для получения обновлений через getUpdates и пересылки их обработчикам"""
+        offset = None
+        while True:
+            try:
+                updates = apihelper.get_updates(
+                    bot.token, offset, timeout=timeout, long_polling_timeout=long_polling_timeout
+                )
+            except Exception as e:
+                logging.error(f"Ошибка при получении обновлений: {e}")
+                time.sleep(1)
+                continue
+            for update in updates:
+                # offset сдвигаем только после того, как обновление принято: пока очередь обработчика
+                # заполнена, ждём, а Telegram хранит остальные обновления у себя
+                while not self.submit(update):
+                    logging.warning(f"Очередь роутера переполнена, ждём места для обновления {update['update_id']}")
+                offset = update["update_id"] + 1
+
+    def create_app(self):
+        """
+        Функция для создания WSGI-приложения роутера. Если очередь обработчика переполнена,
+        отвечает 503, и Telegram пришлёт обновление ещё раз
+        """
+
+        def app(environ, start_response):
+            status, body = webhook.read_update(environ)
+            if body is not None:
+                try:
+                    update = json.loads(body)
+                    status = "200 OK" if self.submit(update) else "503 Service Unavailable"
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                    logging.error(f"Некорректное обновление от Telegram: {e}")
+                    status = "400 Bad Request"
+            start_response(status, [("Content-Type", "text/plain"), ("Content-Length", "0")])
+            return [b""]
+
+        return app
+
+    def get_stats(self) -> dict:
+        """Возвращает статистику пула пересылки и кол-во обновлений по обработчикам"""
+        stats = self.pool.get_stats()
+        with self._stats_lock:
+            stats["forwarded"] = list(self._forwarded)
+            stats["lost"] = self._lost
+        return stats
+
+
+def start_local_workers() -> list[subprocess.Popen]:
+    """Запускает обработчики на этом сервере: тот же скрипт с номером обработчика в окружении"""
+    return [
+        subprocess.Popen([sys.executable, *sys.argv], env=dict(os.environ, **{SHARD_ENV: str(shard)}))
+        for shard in range(len(SHARD_URLS))
+    ]
+
+
+def run(bot: telebot.TeleBot):
+    """
+    Функция для запуска роутера. Если адреса обработчиков не заданы в окружении (shard_urls),
+    обработчики запускаются здесь же отдельными процессами
+    """
+    workers = [] if os.environ.get("shard_urls") else start_local_workers()
+    router = ShardRouter()
+    logging.info(f"Роутер запущен, обработчиков: {len(SHARD_URLS)}")
+    try:
+        if RUN_MODE == "webhook":
+            webhook.set_webhook(bot)
+            webhook.serve(router.create_app(), WEBHOOK_HOST, WEBHOOK_PORT)
+        else:
+            bot.remove_webhook()  # пока webhook установлен, getUpdates не работает
+            router.poll(bot)
+    finally:
+        webhook.stop_workers(workers)
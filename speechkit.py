@@ -1,13 +1,36 @@
-import requests
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
 
-from config import FOLDER_ID, RUS, URL_SPEECHKIT_TEXT, URL_SPEECHKIT_VOICE
-from utils import logging
-from iam_token import get_iam_token
+import http_client
+import metrics
+import ogg
+from coalesce import SingleFlight
+import tts_cache
+from config import (
+    FOLDER_ID,
+    HTTP_RETRIES,
+    RUS,
+    STT_PARALLEL_REQUESTS,
+    STT_SEGMENT_SECONDS,
+    STT_SILENCE_WINDOW,
+    TTS_VOICE,
+    URL_SPEECHKIT_TEXT,
+    URL_SPEECHKIT_VOICE,
+)
+from iam_token import get_iam_token, get_iam_token_async
 
+SPEECHKIT_ERROR = "При запросе в SpeechKit возникла ошибка"
 
-def text_to_speech(text: str):
-    """Функция для преобразования текста в ГС"""
-    iam_token = get_iam_token()
+tts_flight = SingleFlight("tts", is_failure=lambda result: not result[0])  # одинаковые тексты озвучиваем одним запросом
+
+_stt_executor = ThreadPoolExecutor(
+    max_workers=STT_PARALLEL_REQUESTS, thread_name_prefix="stt"
+)
+
+
+def get_tts_request(text: str, iam_token: str) -> tuple[dict, dict]:
+    """Функция для получения заголовков и тела запроса на синтез речи"""
     # Аутентификация через IAM-токен
     headers = {
         "Authorization": f"Bearer {iam_token}",
@@ -15,23 +38,82 @@ def text_to_speech(text: str):
     data = {
         "text": text,  # текст, который нужно преобразовать в голосовое сообщение
         "lang": RUS,
-        "voice": "filipp",  # голос Филлипа
+        "voice": TTS_VOICE,
         "folderId": FOLDER_ID,
     }
-    # Выполняем запрос
-    response = requests.post(url=URL_SPEECHKIT_VOICE, headers=headers, data=data)
+    return headers, data
 
+
+def parse_tts_response(response):
+    """Функция для разбора ответа на синтез речи"""
     if response.status_code == 200:
         return True, response.content  # Возвращаем голосовое сообщение
     else:
         logging.error("При запросе в SpeechKit возникла ошибка, функция text_to_speech")
-        return False, "При запросе в SpeechKit возникла ошибка"
+        return False, SPEECHKIT_ERROR
 
 
-def speech_to_text(data):
-    """Функция для преобразования ГС в текст"""
-    iam_token = get_iam_token()
+@metrics.timed()
+def text_to_speech(text: str):
+    """Функция для преобразования текста в ГС"""
+    voice = tts_cache.get(text)
+    if voice is not None:
+        return True, voice  # этот текст уже озвучивали
+
+    try:
+        return tts_flight.do(tts_cache.get_key(text), _synthesize, text)
+    except TimeoutError as e:
+        logging.error(f"Не дождались озвучивания: {e}, функция text_to_speech")
+        return False, SPEECHKIT_ERROR
+
+
+def _synthesize(text: str):
+    headers, data = get_tts_request(text, get_iam_token())
+    # Выполняем запрос
+    try:
+        response = http_client.post(url=URL_SPEECHKIT_VOICE, headers=headers, data=data)
+    except Exception as e:
+        logging.error(f"Не удалось выполнить запрос к SpeechKit: {e}, функция text_to_speech")
+        return False, SPEECHKIT_ERROR
+
+    status, voice = parse_tts_response(response)
+    if status:
+        tts_cache.put(text, voice)
+    return status, voice
+
+
+@metrics.timed()
+async def text_to_speech_async(text: str):
+    """Асинхронная версия text_to_speech"""
+    voice = await asyncio.to_thread(tts_cache.get, text)
+    if voice is not None:
+        return True, voice  # этот текст уже озвучивали
+
+    try:
+        return await tts_flight.do_async(tts_cache.get_key(text), _synthesize_async, text)
+    except TimeoutError as e:
+        logging.error(f"Не дождались озвучивания: {e}, функция text_to_speech_async")
+        return False, SPEECHKIT_ERROR
+
+
+async def _synthesize_async(text: str):
+    headers, data = get_tts_request(text, await get_iam_token_async())
+    try:
+        response = await http_client.async_post(
+            url=URL_SPEECHKIT_VOICE, headers=headers, data=data
+        )
+    except Exception as e:
+        logging.error(f"Не удалось выполнить запрос к SpeechKit: {e}, функция text_to_speech_async")
+        return False, SPEECHKIT_ERROR
+
+    status, voice = parse_tts_response(response)
+    if status:
+        await asyncio.to_thread(tts_cache.put, text, voice)
+    return status, voice
 
+
+def get_stt_request(iam_token: str) -> tuple[str, dict]:
+    """Функция для получения адреса с параметрами и заголовков запроса на распознавание"""
     # Указываем параметры запроса
     params = "&".join(
         [
@@ -45,17 +127,91 @@ def speech_to_text(data):
     headers = {
         "Authorization": f"Bearer {iam_token}",
     }
+    return URL_SPEECHKIT_TEXT + params, headers
 
-    # Выполняем запрос
-    response = requests.post(
-        url=URL_SPEECHKIT_TEXT + params, headers=headers, data=data
-    )
 
-    # Читаем json в словарь
-    decoded_data = response.json()
+def parse_stt_response(decoded_data: dict):
+    """Функция для разбора ответа на распознавание"""
     # Проверяем, не произошла ли ошибка при запросе
     if decoded_data.get("error_code") is None:
         return True, decoded_data.get("result")  # Возвращаем статус и текст из аудио
     else:
         logging.error("При запросе в SpeechKit возникла ошибка, функция speech_to_text")
-        return False, "При запросе в SpeechKit возникла ошибка"
+        return False, SPEECHKIT_ERROR
+
+
+@metrics.timed()
+def speech_to_text(data):
+    """
+    Функция для преобразования ГС в текст.
+    data - байты ГС или итератор по его частям (например, из voice_files.iter_file):
+    тогда части уходят в SpeechKit по мере скачивания, но запрос не повторяется
+    """
+    url, headers = get_stt_request(get_iam_token())
+
+    # Выполняем запрос и читаем json в словарь
+    try:
+        response = http_client.post(
+            url=url, headers=headers, data=data, retry=isinstance(data, bytes)
+        )
+        decoded_data = response.json()
+    except Exception as e:
+        logging.error(f"Не удалось выполнить запрос к SpeechKit: {e}, функция speech_to_text")
+        return False, SPEECHKIT_ERROR
+
+    return parse_stt_response(decoded_data)
+
+
+@metrics.timed()
+async def speech_to_text_async(data):
+    """Асинхронная версия speech_to_text"""
+    url, headers = get_stt_request(await get_iam_token_async())
+    try:
+        response = await http_client.async_post(
+            url=url,
+            headers=headers,
+            data=data,
+            retries=HTTP_RETRIES if isinstance(data, bytes) else 0,
+        )
+        decoded_data = response.json()
+    except Exception as e:
+        logging.error(f"Не удалось выполнить запрос к SpeechKit: {e}, функция speech_to_text_async")
+        return False, SPEECHKIT_ERROR
+
+    return parse_stt_response(decoded_data)
+
+
+def split_long_audio(data: bytes) -> list[tuple[bytes, float]] | None:
+    """Функция для разбиения длинного ГС на куски, которые SpeechKit распознает по одному"""
+    try:
+        return ogg.split_opus(data, STT_SEGMENT_SECONDS, STT_SILENCE_WINDOW)
+    except ValueError as e:
+        logging.error(f"Не удалось разрезать ГС на куски: {e}, функция split_long_audio")
+        return None
+
+
+def join_segments(results: list) -> tuple[bool, str]:
+    """Функция для склейки распознанных кусков в порядке их следования"""
+    for status, text in results:
+        if not status:
+            return False, text
+    return True, " ".join(text for _, text in results if text)
+
+
+@metrics.timed()
+def speech_to_text_long(segments: list[tuple[bytes, float]]) -> tuple[bool, str]:
+    """
+    Функция для распознавания длинного ГС, разрезанного split_long_audio на куски
+    короче 30 секунд: куски распознаются одновременно, текст склеивается по порядку
+    """
+    results = list(_stt_executor.map(speech_to_text, [segment for segment, _ in segments]))
+    return join_segments(results)
+
+
+@metrics.timed()
+async def speech_to_text_long_async(segments: list[tuple[bytes, float]]) -> tuple[bool, str]:
+    """Асинхронная версия speech_to_text_long"""
+    results = await asyncio.gather(
+        *(speech_to_text_async(segment) for segment, _ in segments)
+    )
+    return join_segments(results)
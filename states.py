@@ -0,0 +1,51 @@
+import json
+
+from telebot.storage import StateStorageBase
+from telebot.storage.base_storage import StateContext
+
+import db
+
+
+class DbStateStorage(StateStorageBase):
+    """
+    Хранилище состояний пользователей (например, "ждём текст для /tts") в общей БД.
+    В отличие от register_next_step_handler, состояние не теряется при перезапуске
+    и видно любому процессу-обработчику, к которому попадёт пользователь
+    """
+
+    def set_state(self, chat_id, user_id, state):
+        if hasattr(state, "name"):
+            state = state.name
+        db.set_state(chat_id, user_id, state)
+        return True
+
+    def delete_state(self, chat_id, user_id):
+        return db.delete_state(chat_id, user_id)
+
+    def get_state(self, chat_id, user_id):
+        row = db.get_state(chat_id, user_id)
+        return row[0] if row else None
+
+    def get_data(self, chat_id, user_id):
+        row = db.get_state(chat_id, user_id)
+        return json.loads(row[1]) if row else None
+
+    def save(self, chat_id, user_id, data):
+        db.save_state_data(chat_id, user_id, json.dumps(data, ensure_ascii=False))
+
+    def set_data(self, chat_id, user_id, key, value):
+        data = self.get_data(chat_id, user_id)
+        if data is None:
+            raise RuntimeError(f"chat_id {chat_id} and user_id {user_id} does not exist")
+        data[key] = value
+        self.save(chat_id, user_id, data)
+        return True
+
+    def reset_data(self, chat_id, user_id):
+        if self.get_data(chat_id, user_id) is None:
+            return False
+        self.save(chat_id, user_id, {})
+        return True
+
+    def get_interactive_data(self, chat_id, user_id):
+        return StateContext(self, chat_id, user_id)
@@ -0,0 +1,23 @@
+from storage.base import LIMIT_TYPES, Storage
+
+
+def create_storage(backend: str) -> Storage:
+    """
+    Функция для создания хранилища по имени: "sqlite", "memory" или "postgres".
+    Модуль PostgreSQL импортируется, только если он выбран (нужен пакет asyncpg)
+    """
+    if backend == "sqlite":
+        from config import DB_NAME
+        from storage.sqlite import SqliteStorage
+        return SqliteStorage(DB_NAME)
+    if backend == "memory":
+        from storage.memory import MemoryStorage
+        return MemoryStorage()
+    if backend == "postgres":
+        from config import POSTGRES_DSN
+        from storage.postgres import PostgresStorage
+        return PostgresStorage(POSTGRES_DSN)
+    raise ValueError(f"Неизвестное хранилище: {backend}")
+
+
+__all__ = ["LIMIT_TYPES", "Storage", "create_storage"]
@@ -0,0 +1,127 @@
+from abc import ABC, abstractmethod
+
+LIMIT_TYPES = ("total_gpt_tokens", "tts_symbols", "stt_blocks")
+
+
+def check_limit_type(limit_type: str):
+    """Имя счётчика подставляется в запрос как имя колонки, поэтому принимаем только известные"""
+    if limit_type not in LIMIT_TYPES:
+        raise ValueError(f"Неизвестный счётчик: {limit_type}")
+
+
+class Storage(ABC):
+    """
+    Интерфейс хранилища: пользователи и их счётчики лимитов, история сообщений,
+    кэш токенов, полученные обновления и состояния пользователей.
+    db.py выбирает реализацию по STORAGE_BACKEND и работает только через этот интерфейс.
+    Хранилище, в котором реализованы не все методы, не создаётся (TypeError).
+    Сообщения передаются кортежами
+    (user_id, message, role, total_gpt_tokens, tts_symbols, stt_blocks, text_hash, gpt_tokens)
+    """
+
+    @abstractmethod
+    def create_schema(self):
+        """Создаёт таблицы, если их ещё нет"""
+        ...
+
+    @abstractmethod
+    def transaction(self):
+        """
+        Контекстный менеджер: все операции внутри блока (в том числе во вложенных transaction)
+        выполняются атомарно - фиксируются вместе или откатываются при ошибке
+        """
+        ...
+
+    def close(self):
+        """Закрывает соединения текущего потока, следующий запрос откроет новое"""
+
+    @abstractmethod
+    def add_new_user(self, user_id: int, max_users: int | None = None) -> bool:
+        """
+        Регистрирует пользователя с первым сообщением "Привет". Проверка max_users
+        и добавление атомарны для всех процессов. Возвращает True, если пользователь есть в базе
+        """
+        ...
+
+    @abstractmethod
+    def is_user_in_db(self, user_id: int) -> bool:
+        ...
+
+    @abstractmethod
+    def count_all_users(self) -> int:
+        ...
+
+    @abstractmethod
+    def get_all_users_data(self) -> list[tuple]:
+        """Строки пользователей: (user_id, total_gpt_tokens, tts_symbols, stt_blocks)"""
+        ...
+
+    @abstractmethod
+    def add_messages(self, rows: list[tuple]):
+        """Добавляет сообщения, не меняя счётчики пользователей"""
+        ...
+
+    @abstractmethod
+    def select_last_messages(self, user_id: int, n_last_messages: int) -> list[dict]:
+        """Последние n сообщений пользователя от старых к новым: [{"text": ..., "role": ...}]"""
+        ...
+
+    @abstractmethod
+    def get_user_limits(self, user_id: int) -> dict | None:
+        ...
+
+    @abstractmethod
+    def set_limit(self, user_id: int, limit_type: str, value: int):
+        ...
+
+    @abstractmethod
+    def add_limits(self, limits: dict[int, dict]):
+        """Прибавляет изменения {user_id: {limit_type: изменение}}, счётчики не уходят ниже 0"""
+        ...
+
+    @abstractmethod
+    def reserve_limit(self, user_id: int, limit_type: str, amount: int, max_value: int) -> bool:
+        """Атомарно увеличивает счётчик, только если он не превысит max_value"""
+        ...
+
+    @abstractmethod
+    def release_limit(self, user_id: int, limit_type: str, amount: int):
+        """Уменьшает счётчик, не ниже 0"""
+        ...
+
+    @abstractmethod
+    def get_message_tokens(self, text_hash: str) -> int | None:
+        ...
+
+    @abstractmethod
+    def save_message_tokens(self, text_hash: str, gpt_tokens: int):
+        """Сохраняет кол-во токенов у всех сообщений с таким хэшем, где оно ещё не известно"""
+        ...
+
+    @abstractmethod
+    def mark_update(self, update_id: int, received_at: float) -> bool:
+        """Отмечает обновление как полученное. False - его уже получали"""
+        ...
+
+    @abstractmethod
+    def forget_updates(self, received_before: float):
+        """Удаляет отметки обновлений, полученных раньше received_before"""
+        ...
+
+    @abstractmethod
+    def get_state(self, chat_id: int, user_id: int) -> tuple[str | None, str] | None:
+        """Состояние пользователя и его данные (JSON) или None, если состояния нет"""
+        ...
+
+    @abstractmethod
+    def set_state(self, chat_id: int, user_id: int, state: str):
+        """Создаёт или меняет состояние пользователя, данные сохраняются"""
+        ...
+
+    @abstractmethod
+    def delete_state(self, chat_id: int, user_id: int) -> bool:
+        ...
+
+    @abstractmethod
+    def save_state_data(self, chat_id: int, user_id: int, data: str):
+        ...
@@ -0,0 +1,162 @@
+import threading
+from contextlib import contextmanager
+
+from config import DB_BUSY_TIMEOUT
+from storage.base import LIMIT_TYPES, Storage, check_limit_type
+
+
+class MemoryStorage(Storage):
+    """
+    Хранилище в памяти процесса - для тестов и замеров без диска.
+    Все операции выполняются под одной блокировкой, transaction держит её до конца блока.
+    При ошибке внутри transaction данные возвращаются к снимку, сделанному в её начале
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._users = {}  # user_id -> {limit_type: значение}
+        self._messages = {}  # user_id -> [(message, role, text_hash, gpt_tokens)]
+        self._tokens = {}  # text_hash -> gpt_tokens (None - для сообщений с таким хэшем ещё не известно)
+        self._updates = {}  # update_id -> received_at
+        self._states = {}  # (chat_id, user_id) -> [state, data]
+        self._depth = 0  # вложенность transaction, меняет только поток, который держит блокировку
+
+    @contextmanager
+    def transaction(self):
+        # как BEGIN IMMEDIATE с busy_timeout: не ждём блокировку бесконечно
+        if not self._lock.acquire(timeout=DB_BUSY_TIMEOUT):
+            raise TimeoutError("Хранилище занято другой транзакцией")
+        snapshot = self._snapshot() if self._depth == 0 else None  # вложенная транзакция - часть внешней
+        self._depth += 1
+        try:
+            yield self
+        except BaseException:
+            if snapshot is not None:
+                self._users, self._messages, self._tokens, self._updates, self._states = snapshot
+            raise
+        finally:
+            self._depth -= 1
+            self._lock.release()
+
+    def _snapshot(self) -> tuple:
+        # копируются только изменяемые контейнеры, строки сообщений и кортежи общие со снимком
+        return (
+            {user_id: dict(limits) for user_id, limits in self._users.items()},
+            {user_id: list(messages) for user_id, messages in self._messages.items()},
+            dict(self._tokens),
+            dict(self._updates),
+            {key: list(row) for key, row in self._states.items()},
+        )
+
+    def create_schema(self):
+        pass
+
+    def add_new_user(self, user_id: int, max_users: int | None = None) -> bool:
+        with self._lock:
+            if user_id in self._users:
+                return True
+            if max_users is not None and len(self._users) >= max_users:
+                return False
+            self._users[user_id] = dict.fromkeys(LIMIT_TYPES, 0)
+            self._messages[user_id] = [("Привет", "user", None, None)]
+            return True
+
+    def is_user_in_db(self, user_id: int) -> bool:
+        return user_id in self._users
+
+    def count_all_users(self) -> int:
+        return len(self._users)
+
+    def get_all_users_data(self) -> list[tuple]:
+        with self._lock:
+            return [
+                (user_id, *(limits[limit_type] for limit_type in LIMIT_TYPES))
+                for user_id, limits in self._users.items()
+            ]
+
+    def add_messages(self, rows: list[tuple]):
+        with self._lock:
+            for user_id, message, role, _, _, _, text_hash, gpt_tokens in rows:
+                self._messages.setdefault(user_id, []).append((message, role, text_hash, gpt_tokens))
+                if self._tokens.get(text_hash) is None:
+                    self._tokens[text_hash] = gpt_tokens
+
+    def select_last_messages(self, user_id: int, n_last_messages: int) -> list[dict]:
+        with self._lock:
+            messages = self._messages.get(user_id, [])[-n_last_messages:] if n_last_messages else []
+            return [{"text": message, "role": role} for message, role, _, _ in messages]
+
+    def get_user_limits(self, user_id: int) -> dict | None:
+        with self._lock:
+            limits = self._users.get(user_id)
+            return dict(limits) if limits is not None else None
+
+    def set_limit(self, user_id: int, limit_type: str, value: int):
+        check_limit_type(limit_type)
+        with self._lock:
+            if user_id in self._users:
+                self._users[user_id][limit_type] = value
+
+    def add_limits(self, limits: dict[int, dict]):
+        with self._lock:
+            for user_id, deltas in limits.items():
+                user_limits = self._users.get(user_id)
+                if user_limits is None:
+                    continue
+                for limit_type, delta in deltas.items():
+                    check_limit_type(limit_type)
+                    user_limits[limit_type] = max(user_limits[limit_type] + delta, 0)
+
+    def reserve_limit(self, user_id: int, limit_type: str, amount: int, max_value: int) -> bool:
+        check_limit_type(limit_type)
+        with self._lock:
+            user_limits = self._users.get(user_id)
+            if user_limits is None or user_limits[limit_type] + amount > max_value:
+                return False
+            user_limits[limit_type] += amount
+            return True
+
+    def release_limit(self, user_id: int, limit_type: str, amount: int):
+        self.add_limits({user_id: {limit_type: -amount}})
+
+    def get_message_tokens(self, text_hash: str) -> int | None:
+        return self._tokens.get(text_hash)
+
+    def save_message_tokens(self, text_hash: str, gpt_tokens: int):
+        with self._lock:
+            if text_hash in self._tokens and self._tokens[text_hash] is None:
+                self._tokens[text_hash] = gpt_tokens
+
+    def mark_update(self, update_id: int, received_at: float) -> bool:
+        with self._lock:
+            if update_id in self._updates:
+                return False
+            self._updates[update_id] = received_at
+            return True
+
+    def forget_updates(self, received_before: float):
+        with self._lock:
+            self._updates = {
+                update_id: received_at
+                for update_id, received_at in self._updates.items()
+                if received_at >= received_before
+            }
+
+    def get_state(self, chat_id: int, user_id: int) -> tuple[str | None, str] | None:
+        with self._lock:
+            row = self._states.get((chat_id, user_id))
+            return tuple(row) if row is not None else None
+
+    def set_state(self, chat_id: int, user_id: int, state: str):
+        with self._lock:
+            self._states.setdefault((chat_id, user_id), [None, "{}"])[0] = state
+
+    def delete_state(self, chat_id: int, user_id: int) -> bool:
+        with self._lock:
+            return self._states.pop((chat_id, user_id), None) is not None
+
+    def save_state_data(self, chat_id: int, user_id: int, data: str):
+        with self._lock:
+            row = self._states.get((chat_id, user_id))
+            if row is not None:
+                row[1] = data
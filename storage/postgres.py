@@ -0,0 +1,320 @@
+import asyncio
+import threading
+from contextlib import contextmanager
+
+import asyncpg
+
+from config import (
+    DB_BUSY_TIMEOUT,
+    DB_TABLE_MESSAGES_NAME,
+    DB_TABLE_STATES_NAME,
+    DB_TABLE_UPDATES_NAME,
+    DB_TABLE_USERS_NAME,
+    POSTGRES_POOL_MAX,
+    POSTGRES_POOL_MIN,
+)
+from storage.base import LIMIT_TYPES, Storage, check_limit_type
+
+REGISTRATION_LOCK_ID = 1  # номер advisory-блокировки для регистрации пользователей
+
+
+def _rowcount(status: str) -> int:
+    """Кол-во строк из статуса команды asyncpg: "UPDATE 1", "INSERT 0 1", "DELETE 3" """
+    return int(status.rsplit(" ", 1)[-1])
+
+
+class PostgresStorage(Storage):
+    """
+    Хранилище в PostgreSQL для нескольких серверов с ботом.
+    Запросы идут через пул соединений asyncpg в отдельном потоке с циклом событий,
+    синхронные методы ждут результат, поэтому интерфейс тот же, что у SQLite.
+    Внутри transaction запросы потока идут через одно соединение из пула
+    """
+
+    def __init__(self, dsn: str):
+        self._local = threading.local()
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, name="postgres-loop", daemon=True).start()
+
+        async def create_pool():
+            # create_pool и acquire возвращают не корутины, а awaitable-объекты,
+            # а run_coroutine_threadsafe принимает только корутины
+            return await asyncpg.create_pool(dsn, min_size=POSTGRES_POOL_MIN, max_size=POSTGRES_POOL_MAX)
+
+        self._pool = self._run(create_pool())
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def _call(self, method: str, query: str, *args):
+        """Выполняет запрос: в открытой транзакции потока или на свободном соединении пула"""
+        connection = getattr(self._local, "connection", None)
+
+        async def call():
+            if connection is not None:
+                return await getattr(connection, method)(query, *args)
+            async with self._pool.acquire(timeout=DB_BUSY_TIMEOUT) as pooled:
+                return await getattr(pooled, method)(query, *args)
+
+        return self._run(call())
+
+    def _execute(self, query: str, *args) -> str:
+        return self._call("execute", query, *args)
+
+    def _fetch(self, query: str, *args) -> list:
+        return self._call("fetch", query, *args)
+
+    @contextmanager
+    def transaction(self):
+        if getattr(self._local, "connection", None) is not None:
+            yield  # вложенная транзакция - часть внешней
+            return
+
+        async def acquire():
+            return await self._pool.acquire(timeout=DB_BUSY_TIMEOUT)
+
+        connection = self._run(acquire())
+        transaction = connection.transaction()
+        try:
+            self._run(transaction.start())
+            self._local.connection = connection
+            try:
+                yield
+            except Exception:
+                self._run(transaction.rollback())
+                raise
+            else:
+                self._run(transaction.commit())
+        finally:
+            self._local.connection = None
+            self._run(self._pool.release(connection))
+
+    def close(self):
+        # как у SQLite, закрывается только то, что принадлежит потоку, и хранилищем можно пользоваться дальше.
+        # Вне transaction соединение берётся из пула на время одного запроса, так что закрывать нечего,
+        # а сам пул живёт до конца процесса или до close_pool
+        pass
+
+    def close_pool(self):
+        """Закрывает все соединения пула, после этого хранилищем пользоваться нельзя"""
+        self._run(self._pool.close())
+
+    def create_schema(self):
+        with self.transaction():
+            self._execute(
+                f"CREATE TABLE IF NOT EXISTS {DB_TABLE_USERS_NAME} "
+                f"(user_id BIGINT PRIMARY KEY, "
+                f"total_gpt_tokens INTEGER NOT NULL DEFAULT 0, "
+                f"tts_symbols INTEGER NOT NULL DEFAULT 0, "
+                f"stt_blocks INTEGER NOT NULL DEFAULT 0);"
+            )
+            self._execute(
+                f"CREATE TABLE IF NOT EXISTS {DB_TABLE_MESSAGES_NAME} "
+                f"(id BIGSERIAL PRIMARY KEY, "
+                f"user_id BIGINT NOT NULL REFERENCES {DB_TABLE_USERS_NAME} (user_id), "
+                f"message TEXT, "
+                f"role TEXT, "
+                f"total_gpt_tokens INTEGER, "
+                f"tts_symbols INTEGER, "
+                f"stt_blocks INTEGER, "
+                f"text_hash TEXT, "
+                f"gpt_tokens INTEGER);"
+            )
+            self._execute(
+                f"CREATE INDEX IF NOT EXISTS idx_{DB_TABLE_MESSAGES_NAME}_user_id "
+                f"ON {DB_TABLE_MESSAGES_NAME} (user_id, id);"
+            )
+            self._execute(
+                f"CREATE INDEX IF NOT EXISTS idx_{DB_TABLE_MESSAGES_NAME}_text_hash "
+                f"ON {DB_TABLE_MESSAGES_NAME} (text_hash);"
+            )
+            self._execute(
+                f"CREATE TABLE IF NOT EXISTS {DB_TABLE_UPDATES_NAME} "
+                f"(update_id BIGINT PRIMARY KEY, "
+                f"received_at DOUBLE PRECISION NOT NULL);"
+            )
+            self._execute(
+                f"CREATE TABLE IF NOT EXISTS {DB_TABLE_STATES_NAME} "
+                f"(chat_id BIGINT NOT NULL, "
+                f"user_id BIGINT NOT NULL, "
+                f"state TEXT, "
+                f"data TEXT NOT NULL DEFAULT '{{}}', "
+                f"PRIMARY KEY (chat_id, user_id));"
+            )
+
+    def add_new_user(self, user_id: int, max_users: int | None = None) -> bool:
+        with self.transaction():
+            if self.is_user_in_db(user_id):
+                return True
+            if max_users is not None:
+                # регистрации по очереди до конца транзакции, остальные запросы не ждут
+                self._execute("SELECT pg_advisory_xact_lock($1);", REGISTRATION_LOCK_ID)
+                if self.count_all_users() >= max_users:
+                    return False
+            status = self._execute(
+                f"INSERT INTO {DB_TABLE_USERS_NAME} (user_id) VALUES ($1) ON CONFLICT DO NOTHING;",
+                user_id,
+            )
+            if _rowcount(status):
+                # Первое сообщение диалога, как и раньше, - приветствие пользователя
+                self._execute(
+                    f"INSERT INTO {DB_TABLE_MESSAGES_NAME} "
+                    f"(user_id, message, role, total_gpt_tokens, tts_symbols, stt_blocks) "
+                    f"VALUES ($1, 'Привет', 'user', 0, 0, 0);",
+                    user_id,
+                )
+            return True
+
+    def is_user_in_db(self, user_id: int) -> bool:
+        return bool(self._fetch(
+            f"SELECT user_id FROM {DB_TABLE_USERS_NAME} WHERE user_id = $1;", user_id
+        ))
+
+    def count_all_users(self) -> int:
+        return self._fetch(f"SELECT COUNT(*) FROM {DB_TABLE_USERS_NAME};")[0][0]
+
+    def get_all_users_data(self) -> list[tuple]:
+        rows = self._fetch(
+            f"SELECT user_id, total_gpt_tokens, tts_symbols, stt_blocks FROM {DB_TABLE_USERS_NAME};"
+        )
+        return [tuple(row) for row in rows]
+
+    def add_messages(self, rows: list[tuple]):
+        if rows:
+            self._call(
+                "executemany",
+                f"INSERT INTO {DB_TABLE_MESSAGES_NAME} "
+                f"(user_id, message, role, total_gpt_tokens, tts_symbols, stt_blocks, text_hash, gpt_tokens) "
+                f"VALUES ($1, $2, $3, $4, $5, $6, $7, $8);",
+                rows,
+            )
+
+    def select_last_messages(self, user_id: int, n_last_messages: int) -> list[dict]:
+        rows = self._fetch(
+            f"SELECT message, role FROM {DB_TABLE_MESSAGES_NAME} "
+            f"WHERE user_id = $1 ORDER BY id DESC LIMIT $2;",
+            user_id,
+            n_last_messages,
+        )
+        return [{"text": row["message"], "role": row["role"]} for row in reversed(rows)]
+
+    def get_user_limits(self, user_id: int) -> dict | None:
+        rows = self._fetch(
+            f"SELECT {', '.join(LIMIT_TYPES)} FROM {DB_TABLE_USERS_NAME} WHERE user_id = $1;",
+            user_id,
+        )
+        return dict(rows[0]) if rows else None
+
+    def set_limit(self, user_id: int, limit_type: str, value: int):
+        check_limit_type(limit_type)
+        self._execute(
+            f"UPDATE {DB_TABLE_USERS_NAME} SET {limit_type} = $1 WHERE user_id = $2;",
+            value,
+            user_id,
+        )
+
+    def add_limits(self, limits: dict[int, dict]):
+        for deltas in limits.values():
+            for limit_type in deltas:
+                check_limit_type(limit_type)
+        # одно обращение к БД на каждый счётчик, а не на каждую пару (пользователь, счётчик)
+        with self.transaction():
+            for limit_type in LIMIT_TYPES:
+                rows = [
+                    (user_id, deltas[limit_type])
+                    for user_id, deltas in limits.items()
+                    if deltas.get(limit_type)
+                ]
+                if rows:
+                    self._call(
+                        "executemany",
+                        f"UPDATE {DB_TABLE_USERS_NAME} "
+                        f"SET {limit_type} = GREATEST({limit_type} + $2, 0) "
+                        f"WHERE user_id = $1;",
+                        rows,
+                    )
+
+    def reserve_limit(self, user_id: int, limit_type: str, amount: int, max_value: int) -> bool:
+        check_limit_type(limit_type)
+        status = self._execute(
+            f"UPDATE {DB_TABLE_USERS_NAME} "
+            f"SET {limit_type} = {limit_type} + $1 "
+            f"WHERE user_id = $2 AND {limit_type} + $1 <= $3;",
+            amount,
+            user_id,
+            max_value,
+        )
+        return _rowcount(status) == 1
+
+    def release_limit(self, user_id: int, limit_type: str, amount: int):
+        check_limit_type(limit_type)
+        self._execute(
+            f"UPDATE {DB_TABLE_USERS_NAME} "
+            f"SET {limit_type} = GREATEST({limit_type} - $1, 0) "
+            f"WHERE user_id = $2;",
+            amount,
+            user_id,
+        )
+
+    def get_message_tokens(self, text_hash: str) -> int | None:
+        rows = self._fetch(
+            f"SELECT gpt_tokens FROM {DB_TABLE_MESSAGES_NAME} "
+            f"WHERE text_hash = $1 AND gpt_tokens IS NOT NULL LIMIT 1;",
+            text_hash,
+        )
+        return rows[0][0] if rows else None
+
+    def save_message_tokens(self, text_hash: str, gpt_tokens: int):
+        self._execute(
+            f"UPDATE {DB_TABLE_MESSAGES_NAME} SET gpt_tokens = $1 "
+            f"WHERE text_hash = $2 AND gpt_tokens IS NULL;",
+            gpt_tokens,
+            text_hash,
+        )
+
+    def mark_update(self, update_id: int, received_at: float) -> bool:
+        status = self._execute(
+            f"INSERT INTO {DB_TABLE_UPDATES_NAME} (update_id, received_at) "
+            f"VALUES ($1, $2) ON CONFLICT DO NOTHING;",
+            update_id,
+            received_at,
+        )
+        return _rowcount(status) == 1
+
+    def forget_updates(self, received_before: float):
+        self._execute(
+            f"DELETE FROM {DB_TABLE_UPDATES_NAME} WHERE received_at < $1;", received_before
+        )
+
+    def get_state(self, chat_id: int, user_id: int) -> tuple[str | None, str] | None:
+        rows = self._fetch(
+            f"SELECT state, data FROM {DB_TABLE_STATES_NAME} WHERE chat_id = $1 AND user_id = $2;",
+            chat_id,
+            user_id,
+        )
+        return tuple(rows[0]) if rows else None
+
+    def set_state(self, chat_id: int, user_id: int, state: str):
+        self._execute(
+            f"INSERT INTO {DB_TABLE_STATES_NAME} (chat_id, user_id, state) VALUES ($1, $2, $3) "
+            f"ON CONFLICT (chat_id, user_id) DO UPDATE SET state = excluded.state;",
+            chat_id,
+            user_id,
+            state,
+        )
+
+    def delete_state(self, chat_id: int, user_id: int) -> bool:
+        status = self._execute(
+            f"DELETE FROM {DB_TABLE_STATES_NAME} WHERE chat_id = $1 AND user_id = $2;",
+            chat_id,
+            user_id,
+        )
+        return _rowcount(status) == 1
+
+    def save_state_data(self, chat_id: int, user_id: int, data: str):
+        self._execute(
+            f"UPDATE {DB_TABLE_STATES_NAME} SET data = $1 WHERE chat_id = $2 AND user_id = $3;",
+            data,
+            chat_id,
+            user_id,
+        )
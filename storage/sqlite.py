@@ -0,0 +1,325 @@
+import logging
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from config import (
+    DB_BUSY_TIMEOUT,
+    DB_CACHED_STATEMENTS,
+    DB_MMAP_SIZE,
+    DB_TABLE_MESSAGES_NAME,
+    DB_TABLE_STATES_NAME,
+    DB_TABLE_UPDATES_NAME,
+    DB_TABLE_USERS_NAME,
+)
+from storage.base import LIMIT_TYPES, Storage, check_limit_type
+
+
+class SqliteStorage(Storage):
+    """
+    Хранилище в файле SQLite. У каждого потока своё постоянное соединение
+    в режиме WAL, транзакции - BEGIN IMMEDIATE, поэтому файл можно делить между процессами
+    """
+
+    def __init__(self, db_name: str):
+        self.db_name = db_name
+        self._local = threading.local()
+
+    def get_connection(self) -> sqlite3.Connection:
+        """
+        Функция для получения постоянного соединения текущего потока.
+        Соединение открывается один раз, в режиме WAL и с кэшем подготовленных запросов
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # isolation_level=None: без явной транзакции каждый запрос сразу фиксируется
+            connection = sqlite3.connect(
+                self.db_name,
+                isolation_level=None,
+                cached_statements=DB_CACHED_STATEMENTS,
+                timeout=DB_BUSY_TIMEOUT,
+            )
+            connection.execute("PRAGMA journal_mode=WAL;")
+            connection.execute("PRAGMA synchronous=NORMAL;")
+            connection.execute("PRAGMA temp_store=MEMORY;")
+            connection.execute(f"PRAGMA mmap_size={int(DB_MMAP_SIZE)};")
+            self._local.connection = connection
+        return connection
+
+    @contextmanager
+    def transaction(self):
+        connection = self.get_connection()
+        depth = getattr(self._local, "depth", 0)
+        if depth == 0:
+            connection.execute("BEGIN IMMEDIATE;")
+        self._local.depth = depth + 1
+        try:
+            yield connection
+        except Exception:
+            self._local.depth = depth
+            if depth == 0:
+                connection.rollback()
+            raise
+        else:
+            self._local.depth = depth
+            if depth == 0:
+                connection.commit()
+
+    def close(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            self._local.connection = None
+            connection.close()
+
+    def _execute(self, query: str, data: tuple = ()) -> list:
+        return self.get_connection().execute(query, data).fetchall()
+
+    def create_schema(self):
+        """
+        Таблица users хранит счётчики лимитов пользователя,
+        таблица messages - историю диалога с индексом по (user_id, id),
+        таблица updates - id обновлений, уже полученных через webhook,
+        таблица states - состояния пользователей.
+        Старая схема, где каждая строка users - это сообщение, переносится в новую
+        """
+        with self.transaction() as connection:
+            if self._is_legacy_schema():
+                self._migrate_legacy_schema(connection)
+            self._create_tables(connection)
+
+    def _create_tables(self, connection: sqlite3.Connection):
+        connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {DB_TABLE_USERS_NAME} "
+            f"(user_id INTEGER PRIMARY KEY, "
+            f"total_gpt_tokens INTEGER NOT NULL DEFAULT 0, "
+            f"tts_symbols INTEGER NOT NULL DEFAULT 0, "
+            f"stt_blocks INTEGER NOT NULL DEFAULT 0);"
+        )
+        connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {DB_TABLE_MESSAGES_NAME} "
+            f"(id INTEGER PRIMARY KEY, "
+            f"user_id INTEGER NOT NULL REFERENCES {DB_TABLE_USERS_NAME} (user_id), "
+            f"message TEXT, "
+            f"role TEXT, "
+            f"total_gpt_tokens INTEGER, "
+            f"tts_symbols INTEGER, "
+            f"stt_blocks INTEGER, "
+            f"text_hash TEXT, "
+            f"gpt_tokens INTEGER);"
+        )
+        connection.execute(
+            f"CREATE INDEX IF NOT EXISTS idx_{DB_TABLE_MESSAGES_NAME}_user_id "
+            f"ON {DB_TABLE_MESSAGES_NAME} (user_id, id);"
+        )
+        connection.execute(
+            f"CREATE INDEX IF NOT EXISTS idx_{DB_TABLE_MESSAGES_NAME}_text_hash "
+            f"ON {DB_TABLE_MESSAGES_NAME} (text_hash);"
+        )
+        connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {DB_TABLE_UPDATES_NAME} "
+            f"(update_id INTEGER PRIMARY KEY, "
+            f"received_at REAL NOT NULL);"
+        )
+        connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {DB_TABLE_STATES_NAME} "
+            f"(chat_id INTEGER NOT NULL, "
+            f"user_id INTEGER NOT NULL, "
+            f"state TEXT, "
+            f"data TEXT NOT NULL DEFAULT '{{}}', "
+            f"PRIMARY KEY (chat_id, user_id));"
+        )
+
+    def _is_legacy_schema(self) -> bool:
+        columns = [
+            row[1] for row in self._execute(f"PRAGMA table_info({DB_TABLE_USERS_NAME});")
+        ]
+        return "message" in columns
+
+    def _migrate_legacy_schema(self, connection: sqlite3.Connection):
+        """
+        Переносит данные из старой таблицы users в новые users и messages.
+        Счётчики пользователя считаются по всей его истории один раз при миграции
+        """
+        legacy_table = f"{DB_TABLE_USERS_NAME}_legacy"
+        connection.execute(f"ALTER TABLE {DB_TABLE_USERS_NAME} RENAME TO {legacy_table};")
+
+        # В базах, созданных до появления кэша токенов, этих колонок нет
+        columns = [
+            row[1] for row in connection.execute(f"PRAGMA table_info({legacy_table});")
+        ]
+        if "text_hash" not in columns:
+            connection.execute(f"ALTER TABLE {legacy_table} ADD COLUMN text_hash TEXT;")
+        if "gpt_tokens" not in columns:
+            connection.execute(f"ALTER TABLE {legacy_table} ADD COLUMN gpt_tokens INTEGER;")
+
+        self._create_tables(connection)
+        connection.execute(
+            f"INSERT INTO {DB_TABLE_USERS_NAME} (user_id, total_gpt_tokens, tts_symbols, stt_blocks) "
+            f"SELECT user_id, IFNULL(MAX(total_gpt_tokens), 0), "
+            f"IFNULL(SUM(tts_symbols), 0), IFNULL(SUM(stt_blocks), 0) "
+            f"FROM {legacy_table} GROUP BY user_id;"
+        )
+        connection.execute(
+            f"INSERT INTO {DB_TABLE_MESSAGES_NAME} "
+            f"(id, user_id, message, role, total_gpt_tokens, tts_symbols, stt_blocks, text_hash, gpt_tokens) "
+            f"SELECT id, user_id, message, role, total_gpt_tokens, tts_symbols, stt_blocks, text_hash, gpt_tokens "
+            f"FROM {legacy_table};"
+        )
+        connection.execute(f"DROP TABLE {legacy_table};")
+        logging.info("Данные перенесены в новую схему БД")
+
+    def add_new_user(self, user_id: int, max_users: int | None = None) -> bool:
+        # count и insert в одной транзакции BEGIN IMMEDIATE: другие процессы ждут её окончания
+        with self.transaction() as connection:
+            if self.is_user_in_db(user_id):
+                logging.info("Пользователь уже существует!")
+                return True
+            if max_users is not None and self.count_all_users() >= max_users:
+                logging.info(f"Пользователь {user_id} не добавлен: достигнут лимит {max_users}")
+                return False
+            connection.execute(
+                f"INSERT INTO {DB_TABLE_USERS_NAME} (user_id) VALUES (?);", (user_id,)
+            )
+            # Первое сообщение диалога, как и раньше, - приветствие пользователя
+            connection.execute(
+                f"INSERT INTO {DB_TABLE_MESSAGES_NAME} "
+                f"(user_id, message, role, total_gpt_tokens, tts_symbols, stt_blocks) "
+                f"VALUES (?, 'Привет', 'user', 0, 0, 0);",
+                (user_id,),
+            )
+            logging.info("Пользователь успешно добавлен")
+            return True
+
+    def is_user_in_db(self, user_id: int) -> bool:
+        return bool(self._execute(
+            f"SELECT user_id FROM {DB_TABLE_USERS_NAME} WHERE user_id = ?;", (user_id,)
+        ))
+
+    def count_all_users(self) -> int:
+        return self._execute(f"SELECT COUNT(*) FROM {DB_TABLE_USERS_NAME};")[0][0]
+
+    def get_all_users_data(self) -> list[tuple]:
+        return self._execute(
+            f"SELECT user_id, total_gpt_tokens, tts_symbols, stt_blocks FROM {DB_TABLE_USERS_NAME};"
+        )
+
+    def add_messages(self, rows: list[tuple]):
+        with self.transaction() as connection:
+            connection.executemany(
+                f"INSERT INTO {DB_TABLE_MESSAGES_NAME} "
+                f"(user_id, message, role, total_gpt_tokens, tts_symbols, stt_blocks, text_hash, gpt_tokens) "
+                f"VALUES (?, ?, ?, ?, ?, ?, ?, ?);",
+                rows,
+            )
+
+    def select_last_messages(self, user_id: int, n_last_messages: int) -> list[dict]:
+        # запрос идёт по индексу (user_id, id) и читает только n строк
+        rows = self._execute(
+            f"SELECT message, role FROM {DB_TABLE_MESSAGES_NAME} "
+            f"WHERE user_id = ? ORDER BY id DESC LIMIT ?;",
+            (user_id, n_last_messages),
+        )
+        return [{"text": message, "role": role} for message, role in reversed(rows)]
+
+    def get_user_limits(self, user_id: int) -> dict | None:
+        rows = self._execute(
+            f"SELECT {', '.join(LIMIT_TYPES)} FROM {DB_TABLE_USERS_NAME} WHERE user_id = ?;",
+            (user_id,),
+        )
+        return dict(zip(LIMIT_TYPES, rows[0])) if rows else None
+
+    def set_limit(self, user_id: int, limit_type: str, value: int):
+        check_limit_type(limit_type)
+        self._execute(
+            f"UPDATE {DB_TABLE_USERS_NAME} SET {limit_type} = ? WHERE user_id = ?;",
+            (value, user_id),
+        )
+
+    def add_limits(self, limits: dict[int, dict]):
+        with self.transaction() as connection:
+            for user_id, deltas in limits.items():
+                for limit_type, delta in deltas.items():
+                    check_limit_type(limit_type)
+                    if delta:
+                        connection.execute(
+                            f"UPDATE {DB_TABLE_USERS_NAME} "
+                            f"SET {limit_type} = MAX({limit_type} + ?, 0) "
+                            f"WHERE user_id = ?;",
+                            (delta, user_id),
+                        )
+
+    def reserve_limit(self, user_id: int, limit_type: str, amount: int, max_value: int) -> bool:
+        check_limit_type(limit_type)
+        # проверка и увеличение - один UPDATE, параллельные запросы не выйдут за лимит вместе
+        cursor = self.get_connection().execute(
+            f"UPDATE {DB_TABLE_USERS_NAME} "
+            f"SET {limit_type} = {limit_type} + ? "
+            f"WHERE user_id = ? AND {limit_type} + ? <= ?;",
+            (amount, user_id, amount, max_value),
+        )
+        return cursor.rowcount == 1
+
+    def release_limit(self, user_id: int, limit_type: str, amount: int):
+        check_limit_type(limit_type)
+        self._execute(
+            f"UPDATE {DB_TABLE_USERS_NAME} "
+            f"SET {limit_type} = MAX({limit_type} - ?, 0) "
+            f"WHERE user_id = ?;",
+            (amount, user_id),
+        )
+
+    def get_message_tokens(self, text_hash: str) -> int | None:
+        rows = self._execute(
+            f"SELECT gpt_tokens FROM {DB_TABLE_MESSAGES_NAME} "
+            f"WHERE text_hash = ? AND gpt_tokens IS NOT NULL LIMIT 1;",
+            (text_hash,),
+        )
+        return rows[0][0] if rows else None
+
+    def save_message_tokens(self, text_hash: str, gpt_tokens: int):
+        self._execute(
+            f"UPDATE {DB_TABLE_MESSAGES_NAME} SET gpt_tokens = ? "
+            f"WHERE text_hash = ? AND gpt_tokens IS NULL;",
+            (gpt_tokens, text_hash),
+        )
+
+    def mark_update(self, update_id: int, received_at: float) -> bool:
+        cursor = self.get_connection().execute(
+            f"INSERT OR IGNORE INTO {DB_TABLE_UPDATES_NAME} (update_id, received_at) "
+            f"VALUES (?, ?);",
+            (update_id, received_at),
+        )
+        return cursor.rowcount == 1
+
+    def forget_updates(self, received_before: float):
+        self._execute(
+            f"DELETE FROM {DB_TABLE_UPDATES_NAME} WHERE received_at < ?;", (received_before,)
+        )
+
+    def get_state(self, chat_id: int, user_id: int) -> tuple[str | None, str] | None:
+        rows = self._execute(
+            f"SELECT state, data FROM {DB_TABLE_STATES_NAME} WHERE chat_id = ? AND user_id = ?;",
+            (chat_id, user_id),
+        )
+        return rows[0] if rows else None
+
+    def set_state(self, chat_id: int, user_id: int, state: str):
+        self._execute(
+            f"INSERT INTO {DB_TABLE_STATES_NAME} (chat_id, user_id, state, data) "
+            f"VALUES (?, ?, ?, '{{}}') "
+            f"ON CONFLICT (chat_id, user_id) DO UPDATE SET state = excluded.state;",
+            (chat_id, user_id, state),
+        )
+
+    def delete_state(self, chat_id: int, user_id: int) -> bool:
+        cursor = self.get_connection().execute(
+            f"DELETE FROM {DB_TABLE_STATES_NAME} WHERE chat_id = ? AND user_id = ?;",
+            (chat_id, user_id),
+        )
+        return cursor.rowcount == 1
+
+    def save_state_data(self, chat_id: int, user_id: int, data: str):
+        self._execute(
+            f"UPDATE {DB_TABLE_STATES_NAME} SET data = ? WHERE chat_id = ? AND user_id = ?;",
+            (data, chat_id, user_id),
+        )
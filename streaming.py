@@ -0,0 +1,63 @@
+import logging
+import time
+
+from config import GPT_STREAM_EDIT_INTERVAL
+
+TRUNCATED_MARK = "…\n\n(ответ оборван)"  # дописывается к показанной части, если поток GPT прервался
+
+
+class StreamingReply:
+    """
+    Ответ, который показывается пользователю по мере генерации:
+    первая часть отправляется новым сообщением, следующие - редактированием
+    этого же сообщения не чаще раза в GPT_STREAM_EDIT_INTERVAL секунд
+    """
+
+    def __init__(self, bot, chat_id: int, reply_to_message_id: int | None = None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.reply_to_message_id = reply_to_message_id
+        self.message_id = None
+        self.sent_text = ""
+        self.last_edit = 0.0
+        self.first_chunk_at = None
+
+    def update(self, text: str):
+        """Показывает новый текст, если с прошлого редактирования прошло достаточно времени"""
+        if self.message_id is None:
+            self.first_chunk_at = time.monotonic()
+            self._send(text)
+        elif time.monotonic() - self.last_edit >= GPT_STREAM_EDIT_INTERVAL:
+            self._edit(text)
+
+    def finish(self, text: str):
+        """Показывает окончательный текст ответа"""
+        if self.message_id is None:
+            self._send(text)
+        else:
+            self._edit(text)
+
+    def abort(self):
+        """Помечает уже показанную часть ответа как оборванную"""
+        if self.message_id is not None:
+            self._edit(self.sent_text + TRUNCATED_MARK)
+
+    def _send(self, text: str):
+        message = self.bot.send_message(
+            chat_id=self.chat_id, text=text, reply_to_message_id=self.reply_to_message_id
+        )
+        self.message_id = message.message_id
+        self.sent_text = text
+        self.last_edit = time.monotonic()
+
+    def _edit(self, text: str):
+        if text == self.sent_text:
+            return  # Telegram не даёт отредактировать сообщение без изменений
+        try:
+            self.bot.edit_message_text(
+                text=text, chat_id=self.chat_id, message_id=self.message_id
+            )
+            self.sent_text = text
+        except Exception as e:
+            logging.error(f"Не удалось отредактировать сообщение с ответом: {e}")
+        self.last_edit = time.monotonic()
@@ -0,0 +1,58 @@
+import os
+import tempfile
+
+import pytest
+
+from loadtest.fake_servers import FakeServers, Upstream
+
+# Тесты работают с фейковыми Telegram и Yandex Cloud из пакета loadtest: окружение задаётся
+# до импорта config (в pytest_configure - раньше, чем импортируются модули тестов)
+
+_servers = None
+_home_dir = None
+
+
+def pytest_configure(config):
+    global _servers, _home_dir
+    _servers = FakeServers({
+        "iam": Upstream(),
+        "tokens": Upstream(),
+        "gpt": Upstream(0.6),  # потоковый ответ приходит частями в течение 0.6 с
+        "tts": Upstream(0.01),
+        "stt": Upstream(0.01),
+        "telegram": Upstream(),
+        "telegram_file": Upstream(),
+    })
+    _home_dir = tempfile.TemporaryDirectory(prefix="tests-")
+    os.environ.update(_servers.get_env())
+    os.environ.update({
+        "token": "123456:TEST",
+        "folder_id": "test",
+        "home_dir": _home_dir.name,
+        "storage_backend": "memory",
+    })
+    import config as bot_config
+
+    bot_config.MAX_USERS = 1000  # пользователей регистрируют разные тесты
+
+
+def pytest_unconfigure(config):
+    if _servers is not None:
+        _servers.close()
+    if _home_dir is not None:
+        _home_dir.cleanup()
+
+
+@pytest.fixture(scope="session")
+def fake_servers() -> FakeServers:
+    return _servers
+
+
+@pytest.fixture(scope="session")
+def bot_module():
+    """Модуль bot.py с созданными таблицами"""
+    import bot
+    import db
+
+    db.create_table()
+    return bot
@@ -0,0 +1,78 @@
+import threading
+from wsgiref.simple_server import make_server
+
+import pytest
+import requests
+from telebot.types import Update
+
+from loadtest import report
+from loadtest.fake_servers import FakeServers, Upstream
+from loadtest.run import LoadTest, generate_updates, make_start_updates, parse_args, run_phase
+
+# Нагрузочный стенд: обработчики бота на фейковых серверах, отсечение повторных
+# доставок webhook и поведение самих фейковых API
+
+
+@pytest.mark.parametrize("upstream, status", [
+    (Upstream(error_rate=1.0), 500),
+    (Upstream(throttle_rate=1.0), 429),
+    (Upstream(), 200),
+])
+def test_fake_api_failures(upstream, status):
+    servers = FakeServers({"iam": upstream})
+    try:
+        response = requests.get(servers.get_env()["iam_token_endpoint"], timeout=5)
+    finally:
+        servers.close()
+    assert response.status_code == status
+
+
+def test_report_percentiles():
+    recorder = report.Recorder()
+    for milliseconds in range(1, 101):
+        recorder.record("gpt", milliseconds / 1000, error=milliseconds > 98)
+    stats = recorder.summary()["gpt"]
+    assert stats["count"] == 100 and stats["errors"] == 2
+    assert stats["p50_ms"] == pytest.approx(50)
+    assert stats["p95_ms"] == pytest.approx(95)
+    assert stats["p99_ms"] == pytest.approx(99)
+
+
+def test_load_run_processes_all_updates(bot_module, fake_servers):
+    import config
+
+    args = parse_args(["--users", "3", "--messages", "2", "--voice-ratio", "0.5",
+                       "--voice-seconds", "3", "--timeout", "60"])
+    test = LoadTest(bot_module, {config.URL_GPT: "gpt", fake_servers.telegram_url: "telegram_file"})
+    test.instrument()
+
+    raw_updates = generate_updates(args, first_update_id=1000)
+    user_ids = sorted({update["message"]["from"]["id"] for update in raw_updates})
+    run_phase(test, [Update.de_json(update) for update in make_start_updates(user_ids)], args)
+    results = run_phase(test, [Update.de_json(update) for update in raw_updates], args)
+
+    assert results["completed"] == results["sent"] == 6
+    assert results["handlers"] and results["upstream"]["gpt"]["count"] > 0
+    assert not any(stats["errors"] for stats in results["handlers"].values())
+
+
+def test_webhook_drops_redelivered_updates(bot_module):
+    import webhook
+    from config import WEBHOOK_PATH
+    from replay_updates import check_outcomes, generate_updates as generate_text_updates, replay
+
+    server = make_server(
+        "127.0.0.1", 0, webhook.create_app(bot_module.bot),
+        server_class=webhook.ThreadingWSGIServer, handler_class=webhook.QuietRequestHandler,
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        updates = generate_text_updates(users=3, messages=2, text="/help", first_update_id=50000)
+        url = f"http://127.0.0.1:{server.server_address[1]}{WEBHOOK_PATH}"
+        statuses, outcomes = replay(updates, url, repeat=3)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert statuses == {200: len(updates) * 3}
+    assert check_outcomes(updates, outcomes) == []
@@ -0,0 +1,119 @@
+import time
+
+import pytest
+from telebot.types import Update
+
+from loadtest.fake_servers import BREAK_STREAM, CHARS_PER_TOKEN
+from loadtest.run import make_message
+
+# Потоковый ответ GPT (GPT_STREAM): фейковый GPT присылает ответ частями по 4 слова
+
+QUESTION = " ".join(["слово"] * 13)
+EDIT_INTERVAL = 0.2  # GPT_STREAM_EDIT_INTERVAL в тестах
+EDIT_TOLERANCE = 0.05  # секунд - погрешность замера времени между редактированиями
+
+
+@pytest.fixture
+def shown(bot_module, monkeypatch):
+    """Что увидел пользователь: (время, метод, текст) отправленных и отредактированных сообщений"""
+    import streaming
+
+    monkeypatch.setattr(streaming, "GPT_STREAM_EDIT_INTERVAL", EDIT_INTERVAL)
+    shown = []
+    bot = bot_module.bot
+    for method, name in (("sendMessage", "send_message"), ("editMessageText", "edit_message_text")):
+        function = getattr(bot, name)
+
+        def wrapper(*args, method=method, function=function, **kwargs):
+            shown.append((time.monotonic(), method, kwargs["text"]))
+            return function(*args, **kwargs)
+
+        monkeypatch.setattr(bot, name, wrapper)
+    return shown
+
+
+@pytest.fixture
+def chunks(bot_module, monkeypatch):
+    """Все части ответа, которые получил StreamingReply"""
+    chunks = []
+
+    class CountingReply(bot_module.StreamingReply):
+        def update(self, text: str):
+            chunks.append(text)
+            super().update(text)
+
+    monkeypatch.setattr(bot_module, "StreamingReply", CountingReply)
+    return chunks
+
+
+def ask(bot_module, user_id: int, text: str):
+    import sessions
+
+    assert sessions.add_new_user(user_id, bot_module.MAX_USERS)
+    message = Update.de_json({"update_id": user_id, "message": make_message(user_id, 2, text=text)}).message
+    bot_module.handle_text(message)
+
+
+def test_handle_text_streams_answer(bot_module, shown, chunks):
+    import sessions
+    import tokens
+    from config import COUNT_LAST_MSG
+
+    user_id = 101
+    ask(bot_module, user_id, QUESTION)
+
+    assert len(chunks) > 2, "ответ пришёл одной частью, проверять нечего"
+    assert shown[0][1] == "sendMessage"
+    assert len(shown) < len(chunks) + 1, "сообщение обновлялось на каждую часть"
+    streamed = [moment for moment, _, _ in shown[:-1]]  # последнее редактирование - окончательный текст
+    for previous, current in zip(streamed, streamed[1:]):
+        assert current - previous >= EDIT_INTERVAL - EDIT_TOLERANCE
+
+    answer = chunks[-1]
+    assert shown[-1][2] == answer
+
+    # списаны токены запроса (последние COUNT_LAST_MSG сообщений до ответа) и ответа
+    messages, _ = sessions.select_n_last_messages(user_id, COUNT_LAST_MSG + 1)
+    assert messages[-1] == {"text": answer, "role": "assistant"}
+    prompt_tokens = tokens.count_messages_tokens(messages[:-1][-COUNT_LAST_MSG:])
+    completion_tokens = max(len(answer) // CHARS_PER_TOKEN, 1)  # столько возвращает фейковый GPT
+    assert sessions.count_all_limits(user_id, "total_gpt_tokens") == prompt_tokens + completion_tokens
+
+
+def test_truncated_stream_is_not_saved(bot_module, shown):
+    import sessions
+    from streaming import TRUNCATED_MARK
+    from yandex_gpt import GPT_ERROR
+
+    user_id = 102
+    ask(bot_module, user_id, f"{QUESTION} {BREAK_STREAM}")
+
+    texts = [text for _, _, text in shown]
+    assert len(texts) >= 2 and texts[-2].endswith(TRUNCATED_MARK)
+    assert texts[-1] == GPT_ERROR
+    messages, _ = sessions.select_n_last_messages(user_id, 1)
+    assert messages[-1]["role"] == "user", "оборванный ответ сохранён в историю"
+    assert sessions.count_all_limits(user_id, "total_gpt_tokens") == 0, "резерв не возвращён"
+
+
+def test_chunk_error_is_raised(monkeypatch):
+    import gpt_cache
+    from yandex_gpt import ask_gpt_helper_stream
+
+    monkeypatch.setattr(gpt_cache, "GPT_CACHE_MODE", "exact")
+    messages = [{"role": "user", "text": QUESTION + " ещё"}]
+    received = []
+
+    class ChunkError(Exception):
+        pass
+
+    def on_chunk(text: str):
+        received.append(text)
+        if len(received) == 2:
+            raise ChunkError("ошибка в on_chunk")
+
+    with pytest.raises(ChunkError):
+        ask_gpt_helper_stream(messages, on_chunk)
+    assert len(received) == 2, "после ошибки on_chunk получал части"
+    cached = gpt_cache.get(messages)
+    assert cached is not None and cached[0].startswith(received[-1]), "полный ответ не сохранён в кэш"
@@ -0,0 +1,80 @@
+import pytest
+
+# Подсчёт токенов: результат токенизатора кэшируется в памяти и в БД по хэшу сообщения,
+# а оценка без запроса к API калибруется по реальным подсчётам
+
+
+@pytest.fixture
+def tokenizer_calls(bot_module, monkeypatch):
+    """Сообщения, которые ушли в токенизатор (фейковый GPT считает 4 символа на токен)"""
+    import tokens
+
+    calls = []
+    count_gpt_tokens = tokens.count_gpt_tokens
+
+    def counting(messages):
+        calls.append(messages)
+        return count_gpt_tokens(messages)
+
+    monkeypatch.setattr(tokens, "count_gpt_tokens", counting)
+    monkeypatch.setattr(tokens, "_cache", type(tokens._cache)())
+    return calls
+
+
+def test_count_is_cached_in_memory(tokenizer_calls):
+    import tokens
+
+    message = {"role": "user", "text": "Сколько токенов в этом сообщении?"}
+    first = tokens.count_message_tokens(message)
+    assert first > 0 and len(tokenizer_calls) == 1
+    assert tokens.count_message_tokens(message) == first
+    assert len(tokenizer_calls) == 1
+
+
+def test_count_is_saved_in_db(tokenizer_calls):
+    import db
+    import tokens
+
+    user_id = 301
+    message = {"role": "user", "text": "Сообщение, которое уже есть в истории"}
+    assert db.add_new_user(user_id)
+    db.add_message(user_id, [message["text"], "user", 0, 0, 0])
+    first = tokens.count_message_tokens(message)
+
+    tokens._cache.clear()  # как после перезапуска: в памяти ничего нет
+    assert tokens.count_message_tokens(message) == first
+    assert len(tokenizer_calls) == 1
+
+
+def test_only_new_message_is_counted(tokenizer_calls):
+    import tokens
+
+    history = [{"role": "user", "text": f"вопрос {n}"} for n in range(4)]
+    tokens.count_messages_tokens(history, estimate=False)
+    tokens.count_messages_tokens(history + [{"role": "assistant", "text": "новый ответ"}], estimate=False)
+    assert len(tokenizer_calls) == len(history) + 1
+
+
+def test_estimate_does_not_call_tokenizer(tokenizer_calls):
+    import tokens
+
+    message = {"role": "user", "text": "Оценка без запроса к токенизатору"}
+    assert tokens.count_message_tokens(message, estimate=True) == tokens.estimate_tokens(message)
+    assert not tokenizer_calls
+    tokens.count_message_tokens(message)  # оценка не кэшируется - потом считается точно
+    assert len(tokenizer_calls) == 1
+
+
+def test_calibration_moves_estimate_to_real_count(monkeypatch):
+    import tokens
+
+    monkeypatch.setattr(tokens, "_chars_per_token", 2.0)
+    text = "x" * 400
+    for _ in range(100):
+        tokens.calibrate(text, 100)  # реально 4 символа на токен
+    assert tokens._chars_per_token == pytest.approx(4.0, abs=0.01)
+    assert tokens.estimate_tokens({"role": "user", "text": text}) in (100, 101)  # оценка округляется вверх
+
+    tokens.calibrate("", 10)  # пустой текст и нулевой подсчёт калибровку не меняют
+    tokens.calibrate(text, 0)
+    assert tokens._chars_per_token == pytest.approx(4.0, abs=0.01)
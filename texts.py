@@ -0,0 +1,29 @@
+# Тексты ответов бота, общие для синхронного и асинхронного режимов
+
+USERS_LIMIT_TEXT = "К сожалению, лимит пользователей исчерпан🙅‍♂️. Вы не сможете воспользоваться ботом😔"
+
+START_TEXT = (
+    "Привет👋🏿, {user_name}! Я бот собеседник, и мы вместе можем решить любой твой вопрос,"
+    " или просто поговорить 🎇.\n\n"
+    "Так же я могу работать с голосовыми сообщениями просто запиши мне ГС🔊, "
+    "и я c  удовольствием поговорю с тобой🗣️.\n\n"
+    "Если возникнут вопросы используй команду /help\n"
+    "что бы проверить работоспособность бота можешь использовать команды /stt и /tts.\n\n"
+    "Ну что, начнём?"
+)
+
+HELP_TEXT = (
+    "👋 Я твой цифровой собеседник.\n\n"
+    "Что бы воспользоваться функцией gpt помощника 🕵‍♀️ следуй инструкциям бота .\n\n"
+    "Этот бот сделан на базе нейронной сети YandexGPT Lite,  \n"
+    "а так же в нём используется технология распознавания и синтеза речи Yandex SpeechKit\n"
+    "Это мой первый опыт знакомства с gpt, "
+    "поэтому не переживай если возникла какая-то ошибка. Просто сообщи мне об этом)\n"
+    "И я постараюсь её решить.\n\n"
+    " P.S. мои контакты можно найти в описании бота"
+)
+
+ECHO_TEXT = (
+    "Вы отправили ({text}).\n"
+    "Но к сожалению я вас не понял😔, Отправь мне голосовое или текстовое сообщение, и я тебе отвечу🤗"
+)
@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import math
+import threading
+from collections import OrderedDict
+
+import db
+import metrics
+from config import (
+    GPT_CHARS_PER_TOKEN,
+    GPT_TOKENS_CACHE_SIZE,
+    GPT_TOKENS_CALIBRATION_WEIGHT,
+    GPT_TOKENS_COUNT_MODE,
+)
+from yandex_gpt import count_gpt_tokens, count_gpt_tokens_async
+
+_cache = OrderedDict()  # хэш сообщения -> количество токенов
+_lock = threading.Lock()
+_chars_per_token = GPT_CHARS_PER_TOKEN  # калибруется по реальным подсчётам
+
+
+def _get_cached(text_hash: str) -> int | None:
+    with _lock:
+        if text_hash in _cache:
+            _cache.move_to_end(text_hash)
+            return _cache[text_hash]
+    return None
+
+
+def _put_cached(text_hash: str, tokens: int):
+    with _lock:
+        _cache[text_hash] = tokens
+        _cache.move_to_end(text_hash)
+        while len(_cache) > GPT_TOKENS_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def calibrate(text: str, tokens: int):
+    """Функция для уточнения оценки символов на токен по реальному подсчёту"""
+    global _chars_per_token
+    if not text or tokens <= 0:
+        return
+    with _lock:
+        _chars_per_token += GPT_TOKENS_CALIBRATION_WEIGHT * (
+            len(text) / tokens - _chars_per_token
+        )
+
+
+def estimate_tokens(message: dict) -> int:
+    """Функция для локальной оценки количества токенов в сообщении без запроса к API"""
+    return math.ceil(len(message["text"]) / _chars_per_token)
+
+
+def remember(message: dict, tokens: int):
+    """Функция для сохранения уже известного количества токенов в сообщении"""
+    if not tokens:
+        return
+    _put_cached(db.get_message_hash(message["role"], message["text"]), tokens)
+    calibrate(message["text"], tokens)
+
+
+def _get_memory_tokens(text_hash: str) -> int | None:
+    tokens = _get_cached(text_hash)
+    if tokens is not None:
+        metrics.count_cache("tokens", "hit")
+    return tokens
+
+
+def _get_db_tokens(text_hash: str) -> int | None:
+    tokens = db.get_message_tokens(text_hash)
+    if tokens is not None:
+        metrics.count_cache("tokens", "db_hit")
+        _put_cached(text_hash, tokens)
+        return tokens
+    metrics.count_cache("tokens", "miss")
+    return None
+
+
+def _save_counted(message: dict, text_hash: str, tokens: int) -> int:
+    """Функция для сохранения результата токенизатора. Если его нет, возвращает оценку"""
+    if tokens:
+        _put_cached(text_hash, tokens)
+        db.save_message_tokens(text_hash, tokens)
+        calibrate(message["text"], tokens)
+    else:
+        logging.error("Токенизатор не вернул результат, используем оценку")
+        tokens = estimate_tokens(message)
+    return tokens
+
+
+def count_message_tokens(message: dict, estimate: bool = False) -> int:
+    """
+    Функция для подсчёта токенов в одном сообщении.
+    Сначала ищет результат в памяти, затем в БД и только потом считает:
+    локально (estimate=True) или запросом к токенизатору
+    """
+    text_hash = db.get_message_hash(message["role"], message["text"])
+
+    tokens = _get_memory_tokens(text_hash)
+    if tokens is None:
+        tokens = _get_db_tokens(text_hash)
+    if tokens is not None:
+        return tokens
+
+    if estimate:
+        return estimate_tokens(message)  # оценку не кэшируем, чтобы потом посчитать точно
+    return _save_counted(message, text_hash, count_gpt_tokens([message]))
+
+
+async def count_message_tokens_async(message: dict, estimate: bool = False) -> int:
+    """
+    Асинхронная версия count_message_tokens: токенизатор вызывается асинхронно,
+    а запросы к БД выполняются в пуле потоков
+    """
+    text_hash = db.get_message_hash(message["role"], message["text"])
+
+    tokens = _get_memory_tokens(text_hash)
+    if tokens is None:
+        tokens = await asyncio.to_thread(_get_db_tokens, text_hash)
+    if tokens is not None:
+        return tokens
+
+    if estimate:
+        return estimate_tokens(message)
+    tokens = await count_gpt_tokens_async([message])
+    return await asyncio.to_thread(_save_counted, message, text_hash, tokens)
+
+
+def count_messages_tokens(messages: list, estimate: bool | None = None) -> int:
+    """Функция для подсчёта токенов в списке сообщений"""
+    if estimate is None:
+        estimate = GPT_TOKENS_COUNT_MODE == "estimate"
+    return sum(count_message_tokens(message, estimate) for message in messages)
+
+
+async def count_messages_tokens_async(messages: list, estimate: bool | None = None) -> int:
+    """Асинхронная версия count_messages_tokens: сообщения считаются одновременно"""
+    if estimate is None:
+        estimate = GPT_TOKENS_COUNT_MODE == "estimate"
+    counts = await asyncio.gather(
+        *(count_message_tokens_async(message, estimate) for message in messages)
+    )
+    return sum(counts)
@@ -0,0 +1,166 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import metrics
+from config import RUS, TTS_CACHE_DIR, TTS_CACHE_MAX_BYTES, TTS_VOICE
+
+INDEX_NAME = "index.json"  # порядок LRU и file_id уже отправленных ГС
+
+_index = OrderedDict()  # ключ -> {"size": размер файла, "file_id": file_id в Telegram}
+_lock = threading.Lock()
+_total_bytes = 0
+_loaded = False
+
+
+def get_key(text: str, voice: str = TTS_VOICE, lang: str = RUS) -> str:
+    """Функция для получения ключа кэша по тексту, голосу и языку"""
+    return hashlib.sha256(f"{voice}\n{lang}\n{text}".encode("utf-8")).hexdigest()
+
+
+def _get_path(key: str) -> str:
+    return os.path.join(TTS_CACHE_DIR, f"{key}.ogg")
+
+
+def _load_index():
+    """Восстанавливает индекс по сохранённому файлу и содержимому папки кэша"""
+    global _total_bytes, _loaded
+    if _loaded:
+        return
+    _loaded = True
+    os.makedirs(TTS_CACHE_DIR, exist_ok=True)
+
+    try:
+        with open(os.path.join(TTS_CACHE_DIR, INDEX_NAME), encoding="utf-8") as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        saved = {}
+
+    # Файлы, которых нет в индексе, считаем самыми старыми
+    files = sorted(
+        (entry for entry in os.scandir(TTS_CACHE_DIR) if entry.name.endswith(".ogg")),
+        key=lambda entry: entry.stat().st_mtime,
+    )
+    sizes = {entry.name[:-4]: entry.stat().st_size for entry in files}
+    for key, size in sizes.items():
+        if key not in saved:
+            _index[key] = {"size": size, "file_id": None}
+    for key, item in saved.items():
+        if key in sizes:
+            _index[key] = {"size": sizes[key], "file_id": item.get("file_id")}
+    _total_bytes = sum(item["size"] for item in _index.values())
+
+
+def _save_index():
+    """Атомарно сохраняет индекс, чтобы не потерять его при падении"""
+    fd, tmp_path = tempfile.mkstemp(dir=TTS_CACHE_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(_index, f)
+        os.replace(tmp_path, os.path.join(TTS_CACHE_DIR, INDEX_NAME))
+    except OSError as e:
+        logging.error(f"Не удалось сохранить индекс кэша озвучки: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _evict():
+    """Удаляет давно не использованные ГС, пока кэш не станет меньше TTS_CACHE_MAX_BYTES"""
+    global _total_bytes
+    while _total_bytes > TTS_CACHE_MAX_BYTES and _index:
+        key, item = _index.popitem(last=False)
+        _total_bytes -= item["size"]
+        try:
+            os.remove(_get_path(key))
+        except OSError:
+            pass
+
+
+def get(text: str) -> bytes | None:
+    """Функция для получения уже озвученного текста. None - текста нет в кэше"""
+    key = get_key(text)
+    with _lock:
+        _load_index()
+        if key not in _index:
+            metrics.count_cache("tts", "miss")
+            return None
+        _index.move_to_end(key)
+    metrics.count_cache("tts", "hit")
+
+    try:
+        with open(_get_path(key), "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as mapped:
+            return mapped[:]
+    except (OSError, ValueError) as e:
+        # файл удалили или он пустой - забываем о нём
+        logging.error(f"Не удалось прочитать ГС из кэша озвучки: {e}")
+        with _lock:
+            _forget(key)
+        return None
+
+
+def _forget(key: str):
+    global _total_bytes
+    item = _index.pop(key, None)
+    if item is not None:
+        _total_bytes -= item["size"]
+
+
+def put(text: str, content: bytes):
+    """Функция для сохранения озвученного текста в кэш"""
+    global _total_bytes
+    if not content or len(content) > TTS_CACHE_MAX_BYTES:
+        return
+    key = get_key(text)
+    with _lock:
+        _load_index()
+        if key in _index:
+            _index.move_to_end(key)
+            return
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=TTS_CACHE_DIR, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, _get_path(key))
+        except OSError as e:
+            logging.error(f"Не удалось сохранить ГС в кэш озвучки: {e}")
+            return
+        _index[key] = {"size": len(content), "file_id": None}
+        _total_bytes += len(content)
+        _evict()
+        _save_index()
+
+
+def get_file_id(text: str) -> str | None:
+    """Функция для получения file_id ГС, которое уже отправляли в Telegram"""
+    key = get_key(text)
+    with _lock:
+        _load_index()
+        item = _index.get(key)
+        if item is None or not item["file_id"]:
+            metrics.count_cache("tts_file_id", "miss")
+            return None
+        _index.move_to_end(key)
+        metrics.count_cache("tts_file_id", "hit")
+        return item["file_id"]
+
+
+def remember_file_id(text: str, sent_message):
+    """Функция для запоминания file_id из результата send_voice"""
+    voice = getattr(sent_message, "voice", None)
+    if voice is None:
+        return
+    key = get_key(text)
+    with _lock:
+        _load_index()
+        item = _index.get(key)
+        if item is None or item["file_id"] == voice.file_id:
+            return  # без файла на диске file_id не храним, чтобы индекс не рос без предела
+        item["file_id"] = voice.file_id
+        _save_index()
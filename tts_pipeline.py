@@ -0,0 +1,150 @@
+import logging
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from config import TTS_MIN_CHUNK_SYMBOLS, TTS_PARALLEL_REQUESTS
+from speechkit import text_to_speech
+from utils import is_tts_symbol_limit
+import sessions
+import tts_cache
+
+# Конец предложения: знаки препинания, закрывающие кавычки/скобки и пробелы после них
+SENTENCE_END = re.compile(r"[.!?…]+[\"»)]*\s+")
+
+_executor = ThreadPoolExecutor(
+    max_workers=TTS_PARALLEL_REQUESTS, thread_name_prefix="tts"
+)
+
+
+def split_sentences(text: str) -> tuple[list[str], str]:
+    """
+    Функция для выделения законченных предложений из начала текста.
+    Короткие предложения склеиваются до TTS_MIN_CHUNK_SYMBOLS символов.
+    Возвращает список готовых кусков и незаконченный остаток
+    """
+    chunks = []
+    chunk_start = 0
+    for match in SENTENCE_END.finditer(text):
+        end = match.end()
+        if end - chunk_start >= TTS_MIN_CHUNK_SYMBOLS:
+            chunks.append(text[chunk_start:end].strip())
+            chunk_start = end
+    return chunks, text[chunk_start:]
+
+
+class TtsPipeline:
+    """
+    Озвучивание ответа по предложениям: каждое законченное предложение
+    сразу отправляется в SpeechKit (несколько запросов параллельно),
+    а готовые ГС передаются в send_voice строго в порядке текста
+    """
+
+    def __init__(self, user_id: int, send_voice):
+        self.user_id = user_id
+        self.send_voice = send_voice
+        self.consumed = 0  # сколько символов ответа уже отдано на озвучивание
+        self.tts_symbols = 0  # сколько символов зарезервировано и озвучено
+        self.error_message = ""
+        self.sent = 0  # сколько ГС отправлено пользователю
+        self._results = []  # результаты синтеза по порядку кусков (None - ещё не готов)
+        self._next_to_send = 0
+        self._futures = []
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()  # ГС отправляет один поток за раз, чтобы сохранить порядок
+
+    def feed(self, text: str):
+        """Принимает весь полученный на данный момент текст ответа"""
+        chunks, _ = split_sentences(text[self.consumed:])
+        for chunk in chunks:
+            self.consumed = text.index(chunk, self.consumed) + len(chunk)
+            self._submit(chunk)
+
+    def finish(self, text: str) -> tuple[int, str]:
+        """
+        Озвучивает остаток ответа и ждёт отправки всех ГС.
+        Возвращает количество потраченных символов и текст ошибки лимита
+        """
+        self.feed(text)
+        tail = text[self.consumed:].strip()
+        self.consumed = len(text)
+        if tail:
+            self._submit(tail)
+        for future in self._futures:
+            future.result()
+        return self.tts_symbols, self.error_message
+
+    def _submit(self, chunk: str):
+        if self.error_message:
+            return  # лимит уже исчерпан, дальше не озвучиваем
+        tts_symbols, error_message = is_tts_symbol_limit(self.user_id, chunk)
+        if tts_symbols is None:
+            self.error_message = error_message
+            return
+        with self._lock:
+            self.tts_symbols += tts_symbols
+            index = len(self._results)
+            self._results.append(None)
+        self._futures.append(_executor.submit(self._synthesize, index, chunk))
+
+    def _synthesize(self, index: int, chunk: str):
+        try:
+            file_id = tts_cache.get_file_id(chunk)
+            if file_id:
+                status, content = True, file_id  # ГС уже есть в Telegram
+            else:
+                status, content = text_to_speech(chunk)
+        except Exception as e:
+            logging.error(f"Ошибка при озвучивании куска ответа: {e}")
+            status, content = False, None
+        if not status:
+            sessions.release_limit(self.user_id, "tts_symbols", len(chunk))
+            with self._lock:
+                self.tts_symbols -= len(chunk)
+        with self._lock:
+            self._results[index] = (status, content, chunk)
+        self._send_ready()
+
+    def _send_ready(self):
+        """
+        Отправляет готовые ГС, перед которыми все предыдущие уже отправлены.
+        Загрузка ГС идёт вне self._lock; если другой поток уже отправляет,
+        он же отправит и этот результат
+        """
+        while self._send_lock.acquire(blocking=False):
+            try:
+                while (result := self._take_ready()) is not None:
+                    self._send(*result)
+            finally:
+                self._send_lock.release()
+            # результат мог стать готовым, пока отправитель отпускал блокировку
+            with self._lock:
+                if not self._is_ready():
+                    return
+
+    def _is_ready(self) -> bool:
+        return (
+            self._next_to_send < len(self._results)
+            and self._results[self._next_to_send] is not None
+        )
+
+    def _take_ready(self):
+        """Забирает следующий по порядку готовый результат или возвращает None"""
+        with self._lock:
+            if not self._is_ready():
+                return None
+            result = self._results[self._next_to_send]
+            self._results[self._next_to_send] = True  # освобождаем память
+            self._next_to_send += 1
+            return result
+
+    def _send(self, status: bool, content, chunk: str):
+        if not status:
+            return
+        try:
+            sent_message = self.send_voice(content)
+            self.sent += 1
+            if isinstance(content, bytes):
+                tts_cache.remember_file_id(chunk, sent_message)
+        except Exception as e:
+            logging.error(f"Не удалось отправить ГС: {e}")
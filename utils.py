@@ -1,23 +1,25 @@
+import asyncio
 import json
-import logging
 import math
 
+import metrics
 from config import (
-    LOGS_PATH,
+    MAX_MODEL_TOKENS,
     MAX_USER_GPT_TOKENS,
     MAX_USER_STT_BLOCKS,
     MAX_USER_TTS_SYMBOLS,
     MAX_USERS,
+    STT_LONG_AUDIO,
+    STT_MAX_DURATION,
+    STT_SEGMENT_SECONDS,
+    STT_SHORT_AUDIO_LIMIT,
+    STT_SILENCE_WINDOW,
 )
-from db import count_all_limits, count_users
-from yandex_gpt import count_gpt_tokens
-
-logging.basicConfig(
-    filename=LOGS_PATH,
-    level=logging.ERROR,
-    format="%(asctime)s FILE: %(filename)s IN: %(funcName)s MESSAGE: %(message)s",
-    filemode="w",
-)
+from sessions import count_users, get_user_limits, release_limit, reserve_limit
+from tokens import count_messages_tokens, count_messages_tokens_async
+
+
+USER_NOT_FOUND_MESSAGE = "Сначала зарегистрируйся командой /start"
 
 
 def load_data(path: str) -> dict:
@@ -50,56 +52,142 @@ def check_number_of_users(user_id: int) -> tuple[bool | None, str]:
     if count is None:
         return None, "Ошибка при работе с БД"
     if count > MAX_USERS:
+        metrics.count_rejection("users")
         return None, "Превышено максимальное количество пользователей"
     return True, ""
 
 
-def is_gpt_token_limit(
-    messages: list, total_spent_tokens: int
-) -> tuple[int | None, str]:
-    """Функция для проверки не превысил ли пользователь лимиты на общение с GPT"""
-    all_tokens = count_gpt_tokens(messages) + total_spent_tokens
-    if all_tokens > MAX_USER_GPT_TOKENS:
-        return None, f"Превышен общий лимит GPT-токенов {MAX_USER_GPT_TOKENS}"
-    return all_tokens, ""
+def is_gpt_token_limit(user_id: int, messages: list) -> tuple[int | None, str]:
+    """
+    Функция для проверки не превысил ли пользователь лимиты на общение с GPT.
+    Резервирует токены запроса и максимальный размер ответа,
+    возвращает количество токенов в запросе
+    """
+    return reserve_gpt_tokens(user_id, count_messages_tokens(messages))
+
 
+async def is_gpt_token_limit_async(user_id: int, messages: list) -> tuple[int | None, str]:
+    """
+    Асинхронная версия is_gpt_token_limit: токены считаются без блокировки event loop,
+    в пуле потоков выполняется только резервирование
+    """
+    prompt_tokens = await count_messages_tokens_async(messages)
+    return await asyncio.to_thread(reserve_gpt_tokens, user_id, prompt_tokens)
 
-def is_stt_block_limit(user_id: int, duration: int) -> tuple[int | None, str]:
-    """Функция для проверки не превысил ли пользователь лимиты на преобразование аудио в текст"""
 
-    # Переводим секунды в аудиоблоки
+def reserve_gpt_tokens(user_id: int, prompt_tokens: int) -> tuple[int | None, str]:
+    """Функция для резервирования токенов запроса и максимального размера ответа"""
+    if reserve_limit(
+        user_id, "total_gpt_tokens", prompt_tokens + MAX_MODEL_TOKENS, MAX_USER_GPT_TOKENS
+    ):
+        return prompt_tokens, ""
+    metrics.count_rejection("gpt_tokens")
+
+    limits = get_user_limits(user_id)
+    if limits is None:
+        return None, USER_NOT_FOUND_MESSAGE
+    return None, f"Превышен общий лимит GPT-токенов {MAX_USER_GPT_TOKENS}"
+
+
+def settle_gpt_tokens(
+    user_id: int, prompt_tokens: int, tokens_in_answer: int | None
+) -> int:
+    """
+    Функция для возврата неиспользованной части резерва GPT-токенов.
+    Если ответа нет (tokens_in_answer=None), возвращается весь резерв.
+    Возвращает количество реально потраченных токенов
+    """
+    if tokens_in_answer is None:
+        release_limit(user_id, "total_gpt_tokens", prompt_tokens + MAX_MODEL_TOKENS)
+        return 0
+    release_limit(user_id, "total_gpt_tokens", MAX_MODEL_TOKENS - tokens_in_answer)
+    return prompt_tokens + tokens_in_answer
+
+
+def count_stt_blocks(duration: int) -> int:
+    """
+    Функция для подсчёта аудиоблоков (по 15 секунд) для ГС длительностью duration секунд.
+    Длинное ГС распознаётся по кускам, и каждый кусок округляется до блоков отдельно,
+    поэтому для него это только оценка до скачивания: точное количество
+    считает settle_stt_blocks по длительностям кусков
+    """
     audio_blocks = math.ceil(duration / 15)  # округляем в большую сторону
-    # Функция из БД для подсчёта всех потраченных пользователем аудиоблоков
-    all_blocks = count_all_limits(user_id, "stt_blocks") + audio_blocks
+    if duration < STT_SHORT_AUDIO_LIMIT:
+        return audio_blocks
+    segments = math.ceil(duration / (STT_SEGMENT_SECONDS - STT_SILENCE_WINDOW))
+    return audio_blocks + segments - 1
 
-    # Проверяем, что аудио длится меньше 30 секунд
-    if duration >= 30:
-        return None, "SpeechKit STT работает с голосовыми сообщениями меньше 30 секунд"
 
-    # Сравниваем all_blocks с количеством доступных пользователю аудиоблоков
-    if all_blocks >= MAX_USER_STT_BLOCKS:
-        msg = (
-            f"Превышен общий лимит SpeechKit STT {MAX_USER_STT_BLOCKS}."
-            f" Использовано {all_blocks} блоков. Доступно: {MAX_USER_STT_BLOCKS - all_blocks}"
-        )
-        return None, msg
-    return all_blocks, ""
+def count_segment_blocks(durations: list[float]) -> int:
+    """Функция для подсчёта аудиоблоков для кусков длинного ГС длительностью durations секунд"""
+    return sum(math.ceil(duration / 15) for duration in durations)
 
 
-def is_tts_symbol_limit(user_id: int, text: str) -> tuple[int | None, str]:
-    """Функция для проверки не превысил ли пользователь лимиты на преобразование текста в аудио"""
-    text_symbols = len(text)
+def settle_stt_blocks(user_id: int, stt_blocks: int, durations: list[float]) -> tuple[int | None, str]:
+    """
+    Функция для исправления резерва аудиоблоков, когда длинное ГС уже разрезано на куски
+    длительностью durations: лишнее возвращается, недостающее резервируется.
+    Вызывается до распознавания. Возвращает новый резерв или None и сообщение,
+    если недостающие блоки не помещаются в лимит (тогда резерв stt_blocks не меняется)
+    """
+    used = count_segment_blocks(durations)
+    if used > stt_blocks:
+        if not reserve_limit(user_id, "stt_blocks", used - stt_blocks, MAX_USER_STT_BLOCKS):
+            metrics.count_rejection("stt_blocks")
+            return None, _get_stt_limit_message(user_id)
+    else:
+        release_limit(user_id, "stt_blocks", stt_blocks - used)
+    return used, ""
+
+
+def is_stt_block_limit(user_id: int, duration: int) -> tuple[int | None, str]:
+    """
+    Функция для проверки не превысил ли пользователь лимиты на преобразование аудио в текст.
+    Резервирует аудиоблоки и возвращает их количество
+    """
+
+    # Проверяем, что аудио не слишком длинное
+    if duration >= STT_SHORT_AUDIO_LIMIT and not STT_LONG_AUDIO:
+        return None, "SpeechKit STT работает с голосовыми сообщениями меньше 30 секунд"
+    if duration > STT_MAX_DURATION:
+        return None, f"Я распознаю голосовые сообщения не длиннее {STT_MAX_DURATION} секунд"
+
+    # Переводим секунды в аудиоблоки
+    audio_blocks = count_stt_blocks(duration)
+    if reserve_limit(user_id, "stt_blocks", audio_blocks, MAX_USER_STT_BLOCKS):
+        return audio_blocks, ""
+    metrics.count_rejection("stt_blocks")
+    return None, _get_stt_limit_message(user_id)
 
-    # Функция из БД для подсчёта всех потраченных пользователем символов
-    all_symbols = count_all_limits(user_id, "tts_symbols") + text_symbols
 
-    # Сравниваем all_symbols с количеством доступных пользователю символов
-    if all_symbols >= MAX_USER_TTS_SYMBOLS:
-        msg = (
-            f"Превышен общий лимит SpeechKit TTS {MAX_USER_TTS_SYMBOLS}."
-            f" Использовано: {all_symbols} символов. Доступно: {MAX_USER_TTS_SYMBOLS - all_symbols}"
-        )
+def _get_stt_limit_message(user_id: int) -> str:
+    limits = get_user_limits(user_id)
+    if limits is None:
+        return USER_NOT_FOUND_MESSAGE
+    all_blocks = limits["stt_blocks"]
+    return (
+        f"Превышен общий лимит SpeechKit STT {MAX_USER_STT_BLOCKS}."
+        f" Использовано {all_blocks} блоков. Доступно: {MAX_USER_STT_BLOCKS - all_blocks}"
+    )
 
-        return None, msg
 
-    return all_symbols, ""
+def is_tts_symbol_limit(user_id: int, text: str) -> tuple[int | None, str]:
+    """
+    Функция для проверки не превысил ли пользователь лимиты на преобразование текста в аудио.
+    Резервирует символы и возвращает их количество
+    """
+    text_symbols = len(text)
+    if reserve_limit(user_id, "tts_symbols", text_symbols, MAX_USER_TTS_SYMBOLS):
+        return text_symbols, ""
+    metrics.count_rejection("tts_symbols")
+
+    limits = get_user_limits(user_id)
+    if limits is None:
+        return None, USER_NOT_FOUND_MESSAGE
+    all_symbols = limits["tts_symbols"]
+    msg = (
+        f"Превышен общий лимит SpeechKit TTS {MAX_USER_TTS_SYMBOLS}."
+        f" Использовано: {all_symbols} символов. Доступно: {MAX_USER_TTS_SYMBOLS - all_symbols}"
+    )
+
+    return None, msg
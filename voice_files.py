@@ -0,0 +1,122 @@
+import logging
+import math
+from contextlib import contextmanager
+
+import aiohttp
+import requests
+from telebot import apihelper
+
+import http_client
+import metrics
+import ogg
+from config import BOT_TOKEN, OGG_DURATION_TOLERANCE, OGG_TAIL_BYTES, STT_STREAM_CHUNK_SIZE
+
+PARTIAL_CONTENT = 206  # сервер отдал только запрошенный диапазон байтов
+
+
+class FileDownloadError(Exception):
+    """Не удалось скачать файл из Telegram. В тексте ошибки ссылка без токена бота"""
+
+
+def hide_token(text) -> str:
+    """Функция для удаления токена бота из текста (он есть в ссылках на файлы)"""
+    text = str(text)
+    return text.replace(BOT_TOKEN, "<BOT_TOKEN>") if BOT_TOKEN else text
+
+
+@contextmanager
+def _hidden_token_errors():
+    """Ошибки запросов к файлам Telegram с адресом в тексте заменяются на FileDownloadError без токена"""
+    try:
+        yield
+    except (requests.RequestException, aiohttp.ClientError) as e:
+        raise FileDownloadError(f"Не удалось скачать файл: {hide_token(e)}") from None
+
+
+def get_file_url(file_path: str) -> str:
+    """Функция для получения ссылки на файл на серверах Telegram"""
+    file_url = apihelper.FILE_URL or "https://api.telegram.org/file/bot{0}/{1}"
+    return file_url.format(BOT_TOKEN, file_path)
+
+
+def parse_duration(tail: bytes, duration: int) -> int:
+    """
+    Функция для уточнения длительности ГС по последней странице OGG.
+    Длительность из сообщения присылает клиент, поэтому берём большую из двух.
+    Короткое ГС помещается в tail целиком вместе с OpusHead, для длинного pre-skip - обычный для libopus
+    """
+    granule = ogg.find_last_granule(tail)
+    if granule is None:
+        logging.error("Не удалось найти позицию в конце ГС, берём длительность из сообщения")
+        return duration
+    pre_skip = ogg.find_pre_skip(tail)
+    seconds = ogg.get_duration(granule, ogg.DEFAULT_PRE_SKIP if pre_skip is None else pre_skip)
+    return max(duration, math.ceil(seconds - OGG_DURATION_TOLERANCE))
+
+
+@metrics.timed()
+def get_voice_duration(file_url: str, duration: int) -> int:
+    """Функция для проверки длительности ГС до скачивания: читает только конец файла"""
+    try:
+        response = http_client.get(
+            file_url, headers={"Range": f"bytes=-{OGG_TAIL_BYTES}"}, stream=True
+        )
+        with response:
+            if response.status_code != PARTIAL_CONTENT:
+                return duration  # сервер не поддерживает Range - не скачиваем файл целиком ради проверки
+            return parse_duration(response.content, duration)
+    except Exception as e:
+        logging.error(f"Не удалось проверить длительность ГС: {hide_token(e)}")
+        return duration
+
+
+@metrics.timed()
+async def get_voice_duration_async(file_url: str, duration: int) -> int:
+    """Асинхронная версия get_voice_duration"""
+    try:
+        async with http_client.get_async_session().get(
+            file_url, headers={"Range": f"bytes=-{OGG_TAIL_BYTES}"}
+        ) as response:
+            if response.status != PARTIAL_CONTENT:
+                return duration
+            return parse_duration(await response.read(), duration)
+    except Exception as e:
+        logging.error(f"Не удалось проверить длительность ГС: {hide_token(e)}")
+        return duration
+
+
+@metrics.timed()
+def download_file(file_url: str) -> bytes:
+    """Функция для скачивания файла целиком (длинное ГС нужно целиком, чтобы разрезать)"""
+    with _hidden_token_errors():
+        response = http_client.get(file_url)
+        response.raise_for_status()
+        return response.content
+
+
+@metrics.timed()
+async def download_file_async(file_url: str) -> bytes:
+    """Асинхронная версия download_file"""
+    with _hidden_token_errors():
+        async with http_client.get_async_session().get(file_url) as response:
+            response.raise_for_status()
+            return await response.read()
+
+
+def iter_file(file_url: str):
+    """
+    Генератор для скачивания файла по частям: части можно сразу отправлять
+    в тело другого запроса, не держа весь файл в памяти
+    """
+    with _hidden_token_errors(), http_client.get(file_url, stream=True) as response:
+        response.raise_for_status()
+        yield from response.iter_content(chunk_size=STT_STREAM_CHUNK_SIZE)
+
+
+async def iter_file_async(file_url: str):
+    """Асинхронная версия iter_file"""
+    with _hidden_token_errors():
+        async with http_client.get_async_session().get(file_url) as response:
+            response.raise_for_status()
+            async for chunk in response.content.iter_chunked(STT_STREAM_CHUNK_SIZE):
+                yield chunk
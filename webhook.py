@@ -0,0 +1,213 @@
+import json
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+import telebot
+
+import db
+from config import (
+    WEBHOOK_HOST,
+    WEBHOOK_MAX_CONNECTIONS,
+    WEBHOOK_PATH,
+    WEBHOOK_PORT,
+    WEBHOOK_PROCESSES,
+    WEBHOOK_RECORD_PATH,
+    WEBHOOK_SECRET,
+    WEBHOOK_URL,
+    WORKER_STOP_TIMEOUT,
+)
+
+WORKER_ENV = "WEBHOOK_WORKER"  # переменная окружения с номером дочернего процесса (у главного её нет)
+SECRET_HEADER = "HTTP_X_TELEGRAM_BOT_API_SECRET_TOKEN"
+UPDATE_STATUS_HEADER = "X-Update-Status"  # processed или duplicate - для проверки через replay_updates.py
+
+_record_lock = threading.Lock()
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    """WSGI-сервер из стандартной библиотеки, который обрабатывает каждый запрос в своём потоке"""
+
+    daemon_threads = True
+    reuse_port = False
+
+    def server_bind(self):
+        # несколько процессов слушают один порт, ядро распределяет соединения между ними
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+
+class ReusePortWSGIServer(ThreadingWSGIServer):
+    """Сервер для порта webhook, который слушают WEBHOOK_PROCESSES процессов (SO_REUSEPORT)"""
+
+    reuse_port = True
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        logging.debug(f"webhook: {format % args}")
+
+
+def _respond(start_response, status: str, headers: tuple = ()):
+    start_response(status, [("Content-Type", "text/plain"), ("Content-Length", "0"), *headers])
+    return [b""]
+
+
+def _record(body: bytes):
+    """Дописывает обновление в WEBHOOK_RECORD_PATH, чтобы потом проиграть его через replay_updates.py"""
+    with _record_lock:
+        with open(WEBHOOK_RECORD_PATH, "ab") as f:
+            f.write(body.strip() + b"\n")
+
+
+def read_update(environ) -> tuple[str, bytes | None]:
+    """
+    Функция для проверки запроса с обновлением: путь, метод и секрет.
+    Возвращает HTTP-статус и тело запроса (None, если запрос отклонён)
+    """
+    if environ.get("PATH_INFO") != WEBHOOK_PATH:
+        return "404 Not Found", None
+    if environ["REQUEST_METHOD"] != "POST":
+        return "405 Method Not Allowed", None
+    if WEBHOOK_SECRET and environ.get(SECRET_HEADER) != WEBHOOK_SECRET:
+        return "403 Forbidden", None
+    try:
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+    except ValueError:
+        return "400 Bad Request", None
+    return "200 OK", environ["wsgi.input"].read(length)
+
+
+def create_app(bot: telebot.TeleBot):
+    """
+    Функция для создания WSGI-приложения, которое принимает обновления от Telegram
+    и передаёт их обработчикам бота. Повторно присланные обновления (с тем же update_id)
+    пропускаются, поэтому приложение можно запускать в нескольких процессах
+    """
+
+    def app(environ, start_response):
+        status, body = read_update(environ)
+        if body is None:
+            return _respond(start_response, status)
+
+        try:
+            update = telebot.types.Update.de_json(json.loads(body))
+        except (ValueError, KeyError, TypeError) as e:
+            logging.error(f"Некорректное обновление от Telegram: {e}")
+            return _respond(start_response, "400 Bad Request")
+
+        if not db.mark_update(update.update_id):
+            logging.info(f"Обновление {update.update_id} уже получено, пропускаем")
+            return _respond(start_response, "200 OK", ((UPDATE_STATUS_HEADER, "duplicate"),))
+
+        if WEBHOOK_RECORD_PATH:
+            _record(body)
+        try:
+            bot.process_new_updates([update])
+        except Exception as e:
+            # Telegram повторит запрос при ошибке, но обновление уже отмечено - отвечаем 200
+            logging.error(f"Ошибка при обработке обновления {update.update_id}: {e}")
+        return _respond(start_response, "200 OK", ((UPDATE_STATUS_HEADER, "processed"),))
+
+    return app
+
+
+def get_worker_index() -> int | None:
+    """Функция для получения номера дополнительного процесса webhook (None - это главный процесс)"""
+    worker = os.environ.get(WORKER_ENV)
+    return int(worker) if worker is not None else None
+
+
+def start_workers() -> list[subprocess.Popen]:
+    """
+    Запускает WEBHOOK_PROCESSES - 1 дополнительных процессов с тем же скриптом.
+    Номера процессов (1, 2, ...) не меняются между перезапусками, поэтому и файлы логов те же
+    """
+    return [
+        subprocess.Popen([sys.executable, *sys.argv], env=dict(os.environ, **{WORKER_ENV: str(worker)}))
+        for worker in range(1, WEBHOOK_PROCESSES)
+    ]
+
+
+def handle_sigterm():
+    """
+    Функция для остановки процесса по SIGTERM так же, как по Ctrl+C: в главном потоке
+    выбрасывается SystemExit, поэтому срабатывают finally и atexit (sessions.flush, logs.stop).
+    Без этого SIGTERM завершает процесс сразу, и накопленные сообщения и записи лога теряются
+    """
+
+    def stop(signum, frame):
+        raise SystemExit(128 + signum)
+
+    signal.signal(signal.SIGTERM, stop)
+
+
+def stop_workers(workers: list[subprocess.Popen], timeout: float = WORKER_STOP_TIMEOUT):
+    """
+    Функция для остановки дочерних процессов: SIGTERM всем сразу, затем ожидание
+    до timeout секунд на всех. Кто не успел завершиться, убивается
+    """
+    for worker in workers:
+        worker.terminate()
+    deadline = time.monotonic() + timeout
+    for worker in workers:
+        try:
+            worker.wait(max(deadline - time.monotonic(), 0))
+        except subprocess.TimeoutExpired:
+            logging.error(f"Процесс {worker.pid} не завершился за {timeout} с, останавливаем принудительно")
+            worker.kill()
+            worker.wait()
+
+
+def set_webhook(bot: telebot.TeleBot):
+    """Функция для регистрации webhook в Telegram"""
+    bot.remove_webhook()
+    bot.set_webhook(
+        url=WEBHOOK_URL + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+    )
+
+
+def serve(app, host: str, port: int, server_class=ThreadingWSGIServer):
+    """
+    Функция для запуска встроенного сервера с приложением app.
+    Порт делят несколько процессов, только если server_class - ReusePortWSGIServer
+    """
+    server = make_server(
+        host,
+        port,
+        app,
+        server_class=server_class,
+        handler_class=QuietRequestHandler,
+    )
+    logging.info(f"Webhook слушает {host}:{port}{WEBHOOK_PATH}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def run(bot: telebot.TeleBot, app):
+    """
+    Функция для запуска встроенного сервера. Главный процесс регистрирует webhook
+    в Telegram и запускает дополнительные процессы, которые слушают тот же порт
+    """
+    workers = []
+    if get_worker_index() is None:
+        set_webhook(bot)
+        workers = start_workers()
+
+    server_class = ReusePortWSGIServer if WEBHOOK_PROCESSES > 1 else ThreadingWSGIServer
+    try:
+        serve(app, WEBHOOK_HOST, WEBHOOK_PORT, server_class)
+    finally:
+        stop_workers(workers)
@@ -1,39 +1,47 @@
+import json
 import logging
+from contextlib import nullcontext
 
-import requests
-
-from iam_token import get_iam_token
+import gpt_cache
+import http_client
+import metrics
+from coalesce import SingleFlight
+from dispatcher import BUSY_MESSAGE
+from iam_token import get_iam_token, get_iam_token_async
 
 from config import (
     FOLDER_ID,
     GPT_MODEL,
-    LOGS_PATH,
     MAX_MODEL_TOKENS,
     SYSTEM_PROMPT,
     URL_GPT,
     URL_TOKENS
 )
 
-logging.basicConfig(
-    filename=LOGS_PATH,
-    level=logging.ERROR,
-    format="%(asctime)s FILE: %(filename)s IN: %(funcName)s MESSAGE: %(message)s",
-    filemode="w",
-)
 
 
-def count_gpt_tokens(messages: list) -> int:
-    """Функция для подсчёта токенов в сообщении"""
-    iam_token = get_iam_token()
+GPT_ERROR = "Ошибка при обращении к GPT"
+
+gpt_flight = SingleFlight("gpt", is_failure=lambda result: not result[0])  # одинаковые диалоги отправляем в GPT одним запросом
 
+
+def get_tokens_request(messages: list, iam_token: str) -> tuple[dict, dict]:
+    """Функция для получения заголовков и тела запроса к токенизатору"""
     headers = {
         "Authorization": f"Bearer {iam_token}",
         "Content-Type": "application/json",
     }
     data = {"modelUri": f"gpt://{FOLDER_ID}/{GPT_MODEL}-lite", "messages": messages}
+    return headers, data
+
+
+@metrics.timed()
+def count_gpt_tokens(messages: list) -> int:
+    """Функция для подсчёта токенов в сообщении"""
+    headers, data = get_tokens_request(messages, get_iam_token())
     try:
         return len(
-            requests.post(url=URL_TOKENS, json=data, headers=headers).json()["tokens"]
+            http_client.post(url=URL_TOKENS, json=data, headers=headers).json()["tokens"]
         )
 
     except Exception as e:
@@ -43,13 +51,41 @@ def count_gpt_tokens(messages: list) -> int:
         return 0
 
 
-def ask_gpt_helper(messages):
+@metrics.timed()
+async def count_gpt_tokens_async(messages: list) -> int:
+    """Асинхронная версия count_gpt_tokens"""
+    headers, data = get_tokens_request(messages, await get_iam_token_async())
+    try:
+        response = await http_client.async_post(url=URL_TOKENS, json=data, headers=headers)
+        return len(response.json()["tokens"])
+
+    except Exception as e:
+        logging.error(
+            f"Ошибка при подсчёте токенов{e}"
+        )
+        return 0
+
+
+def get_completion_tokens(result: dict) -> int | None:
     """
-    Отправляет запрос к модели GPT с задачей и предыдущими ответами
-    для получения ответа или следующего шага
+    Функция для получения количества токенов в ответе GPT из блока usage.
+    Возвращает None, если usage в ответе нет
     """
-    iam_token = get_iam_token()
+    usage = result.get("usage") or {}
+    completion_tokens = usage.get("completionTokens")
+    if completion_tokens is None:
+        return None
+    try:
+        return int(completion_tokens)  # API отдаёт число строкой
+    except (TypeError, ValueError):
+        logging.error(f"Некорректный блок usage в ответе GPT: {usage}")
+        return None
+
 
+def get_gpt_request(
+    messages: list, iam_token: str, stream: bool = False
+) -> tuple[dict, dict]:
+    """Функция для получения заголовков и тела запроса к GPT"""
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {iam_token}",
@@ -58,27 +94,197 @@ def ask_gpt_helper(messages):
     data = {
         "modelUri": f"gpt://{FOLDER_ID}/{GPT_MODEL}-lite",
         "completionOptions": {
-            "stream": False,
+            "stream": stream,
             "temperature": 0.7,
             "maxTokens": MAX_MODEL_TOKENS,
         },
         "messages": SYSTEM_PROMPT
         + messages,  # добавляем к системному сообщению предыдущие сообщения
     }
+    return headers, data
+
+
+def parse_gpt_response(response) -> tuple[bool, str, int | None]:
+    """
+    Функция для разбора ответа GPT.
+    Возвращает статус, текст ответа (или ошибки) и токены в ответе из usage
+    """
+    if response.status_code != 200:
+        logging.error(f"Получена ошибка: {response.content}")
+        return False, f"Ошибка GPT. Статус-код: {response.status_code}", None
+
+    result = response.json()["result"]
+    answer = result["alternatives"][0]["message"]["text"]
+    return True, answer, get_completion_tokens(result)
+
+
+def _free_slot():
+    """Место в очереди к GPT, когда очереди нет"""
+    return nullcontext(True)
+
+
+@metrics.timed()
+def ask_gpt_helper(messages, slot=_free_slot):
+    """
+    Отправляет запрос к модели GPT с задачей и предыдущими ответами
+    для получения ответа или следующего шага.
+    slot() - место в очереди к GPT (например, scheduler.slot): его занимает только запрос,
+    который действительно уходит в GPT, а не ответ из кэша и не ожидание такого же запроса
+    """
+    cached = gpt_cache.get(messages)
+    if cached is not None:
+        return True, *cached  # на такой диалог уже отвечали
+
     try:
-        response = requests.post(url=URL_GPT, headers=headers, json=data)
+        return gpt_flight.do(gpt_cache.get_fingerprint(messages), _ask_gpt, messages, slot)
+    except TimeoutError as e:
+        logging.error(f"Не дождались ответа GPT: {e}")
+        return False, GPT_ERROR, None
+
+
+def _ask_gpt(messages, slot):
+    with slot() as granted:
+        if not granted:
+            return False, BUSY_MESSAGE, None
+        return _request_gpt(messages)
+
+
+def _request_gpt(messages):
+    headers, data = get_gpt_request(messages, get_iam_token())
+    try:
+        response = http_client.post(url=URL_GPT, headers=headers, json=data)
 
     except Exception as e:
-        print(f"Произошла непредвиденная ошибка: {e}.")
         logging.error(f"Произошла непредвиденная ошибка: {e}.")
-        return False, "Ошибка при обращении к GPT", None
-    else:
-        if response.status_code != 200:
-            print("Не удалось получить ответ :(")
-            logging.error(f"Получена ошибка: {response.json()}")
-            return False, f"Ошибка GPT. Статус-код: {response.status_code}", None
-
-        else:
-            answer = response.json()["result"]["alternatives"][0]["message"]["text"]
-            tokens_in_answer = count_gpt_tokens([{"role": "assistant", "text": answer}])
-            return True, answer, tokens_in_answer
+        return False, GPT_ERROR, None
+
+    status, answer, tokens_in_answer = parse_gpt_response(response)
+    if status and tokens_in_answer is None:
+        # В ответе нет блока usage - считаем токены отдельным запросом
+        tokens_in_answer = count_gpt_tokens([{"role": "assistant", "text": answer}])
+    if status:
+        gpt_cache.put(messages, answer, tokens_in_answer)
+    return status, answer, tokens_in_answer
+
+
+@metrics.timed()
+async def ask_gpt_helper_async(messages):
+    """Асинхронная версия ask_gpt_helper"""
+    cached = gpt_cache.get(messages)
+    if cached is not None:
+        return True, *cached  # на такой диалог уже отвечали
+
+    try:
+        return await gpt_flight.do_async(
+            gpt_cache.get_fingerprint(messages), _ask_gpt_async, messages
+        )
+    except TimeoutError as e:
+        logging.error(f"Не дождались ответа GPT: {e}")
+        return False, GPT_ERROR, None
+
+
+async def _ask_gpt_async(messages):
+    headers, data = get_gpt_request(messages, await get_iam_token_async())
+    try:
+        response = await http_client.async_post(url=URL_GPT, headers=headers, json=data)
+
+    except Exception as e:
+        logging.error(f"Произошла непредвиденная ошибка: {e}.")
+        return False, GPT_ERROR, None
+
+    status, answer, tokens_in_answer = parse_gpt_response(response)
+    if status and tokens_in_answer is None:
+        # В ответе нет блока usage - считаем токены отдельным запросом
+        tokens_in_answer = await count_gpt_tokens_async(
+            [{"role": "assistant", "text": answer}]
+        )
+    if status:
+        gpt_cache.put(messages, answer, tokens_in_answer)
+    return status, answer, tokens_in_answer
+
+
+@metrics.timed()
+def ask_gpt_helper_stream(messages, on_chunk, slot=_free_slot):
+    """
+    Потоковая версия ask_gpt_helper: GPT присылает ответ частями,
+    и on_chunk вызывается с уже полученным текстом после каждой части.
+    Возвращает то же, что и ask_gpt_helper, когда ответ получен полностью.
+    Если on_chunk выбросил исключение, оно выбрасывается отсюда после конца ответа
+    """
+    cached = gpt_cache.get(messages)
+    if cached is not None:
+        on_chunk(cached[0])  # на такой диалог уже отвечали - отдаём ответ целиком
+        return True, *cached
+
+    received = []
+    errors = []
+
+    def forward(text: str):
+        # Ответ этого запроса ждут такие же запросы других пользователей и кэш, поэтому
+        # ошибка on_chunk не обрывает чтение ответа, а только прекращает передачу частей
+        if errors:
+            return
+        received.append(text)
+        try:
+            on_chunk(text)
+        except Exception as e:
+            errors.append(e)
+
+    try:
+        status, answer, tokens_in_answer = gpt_flight.do(
+            gpt_cache.get_fingerprint(messages), _ask_gpt_stream, messages, forward, slot
+        )
+    except TimeoutError as e:
+        logging.error(f"Не дождались ответа GPT: {e}")
+        return False, GPT_ERROR, None
+    if errors:
+        raise errors[0]
+    if status and not received:
+        # такой же диалог уже отправлял другой пользователь - отдаём его ответ целиком
+        on_chunk(answer)
+    return status, answer, tokens_in_answer
+
+
+def _ask_gpt_stream(messages, on_chunk, slot):
+    with slot() as granted:
+        if not granted:
+            return False, BUSY_MESSAGE, None
+        return _request_gpt_stream(messages, on_chunk)
+
+
+def _request_gpt_stream(messages, on_chunk):
+    headers, data = get_gpt_request(messages, get_iam_token(), stream=True)
+    try:
+        response = http_client.post(url=URL_GPT, headers=headers, json=data, stream=True)
+    except Exception as e:
+        logging.error(f"Произошла непредвиденная ошибка: {e}.")
+        return False, GPT_ERROR, None
+
+    if response.status_code != 200:
+        with response:
+            return parse_gpt_response(response)
+
+    answer = ""
+    tokens_in_answer = None
+    try:
+        with response:
+            # Каждая строка - JSON с полным текстом, полученным на данный момент
+            for line in response.iter_lines(chunk_size=None):
+                if not line:
+                    continue
+                result = json.loads(line)["result"]
+                text = result["alternatives"][0]["message"]["text"]
+                tokens_in_answer = get_completion_tokens(result)
+                if text != answer:
+                    answer = text
+                    on_chunk(answer)
+    except Exception as e:
+        # оборванный ответ - ошибка: его нельзя сохранять в историю и списывать как полный
+        logging.error(f"Ошибка при чтении потокового ответа GPT: {e}")
+        return False, GPT_ERROR, None
+
+    if tokens_in_answer is None:
+        # В ответе нет блока usage - считаем токены отдельным запросом
+        tokens_in_answer = count_gpt_tokens([{"role": "assistant", "text": answer}])
+    gpt_cache.put(messages, answer, tokens_in_answer)
+    return True, answer, tokens_in_answer